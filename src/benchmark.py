@@ -0,0 +1,198 @@
+# Benchmarks of the simulator, the summarizer and the estimator
+
+#   python benchmark.py [--quick] [--engine jags|numpy|ez] [--save] [--tolerance 0.25]
+#   python benchmark.py [--quick] --engines jags,numpy
+#
+#   Times, for every cell of the P x T grid of para.py (of main.py with
+#   --quick), the simulation of a data set, Hddm_Data.to_jags, building the
+#   model (JAGS compiles the code of ez_jags_code and adapts), estimate end to
+#   end and one replicate of Hddm_Design.run.  Every case reports latency
+#   percentiles, throughput and the peak memory allocated by Python and numpy
+#   (JAGS allocates outside of tracemalloc's view).  All inputs are drawn from
+#   seeded generators, so runs are comparable.
+#
+#   Results are compared with ../benchmarks/baseline.json if it exists; cases
+#   whose median latency or peak memory grew by more than the tolerance are
+#   flagged, and the exit status is 1.  --save makes the results the baseline.
+#
+#   With --engines, the engines are compared instead: every cell's data set is
+#   fitted once with each engine, and the walltime of each fit is reported
+#   with the largest difference between the hyperparameter posterior means,
+#   in pooled posterior standard deviations (see ezhbddm.compare_samples).
+#   A faster engine, or shorter chains, must keep that difference small.
+
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import ezhbddm
+import simulation
+from data_set import Hddm_Data
+from prior import Hddm_Prior
+
+HERE     = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, '..', 'benchmarks', 'baseline.json')
+SEED     = 20240917
+
+GRIDS    = {'main': ([20, 40], [20, 40]),
+            'para': ([20, 40, 80, 160, 320], [20, 40, 80, 160, 320])}
+
+# Repeats per case in full and quick runs
+REPEATS  = {'simulate': (20, 5), 'to_jags': (20, 5), 'compile': (5, 2), 'estimate': (3, 1), 'run': (3, 1)}
+
+def measure(function, repeats, units = 1, warmup = 1):
+    # Latencies of repeated calls, and the peak memory of one more, traced,
+    # call (tracing slows it down, so it is not timed)
+    for _ in range(warmup):
+        function()
+    times = np.empty(repeats)
+    for k in range(repeats):
+        start    = time.perf_counter()
+        function()
+        times[k] = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"repeats":    repeats,
+            "mean":       float(np.mean(times)),
+            "p50":        float(np.percentile(times, 50)),
+            "p90":        float(np.percentile(times, 90)),
+            "p99":        float(np.percentile(times, 99)),
+            "throughput": float(units / np.mean(times)),
+            "peak_mb":    peak / 2**20}
+
+def cell(p, t, engine = 'jags'):
+    # The design of a cell of the grid and its seeded first data set
+    design = simulation.Hddm_Design(p, t, np.arange(p) % 2, 'drift', engine = engine, seed = SEED, name = 'benchmark')
+    design.rng = design.replicate_rng(0)
+    design.sample_parameters()
+    return design, Hddm_Data.sample(design)
+
+def cases(p, t, engine = 'jags'):
+    # (name, function, units) of one cell of the grid; units are trials for
+    # the simulator and summarizer, participants for the estimator and
+    # replicates for the design
+    design, data = cell(p, t, engine)
+    jags, _   = data.to_jags()
+    prior     = Hddm_Prior()
+    rng       = np.random.default_rng(SEED)
+    init      = {"drift": rng.normal(0, 0.1, len(jags['nTrials']))}
+    name      = f'P{p}_T{t}'
+
+    result = [(f'simulate/{name}', lambda: Hddm_Data.sample(design), p * t),
+              (f'to_jags/{name}',  lambda: data.to_jags(), p * t)]
+    if ezhbddm.ENGINES[engine] is not None:
+        result.append((f'compile/{name}', lambda: ezhbddm.ENGINES[engine](jags, prior, 'drift', init, rng), p))
+    result += [(f'estimate/{name}', lambda: ezhbddm.estimate(data, prior, 'drift', True, engine, rng = rng), p),
+               (f'run/{name}',      lambda: design.fork(0).run(1, showProgress = False), 1)]
+    return result
+
+def run(quick = False, engine = 'jags'):
+    P, T    = GRIDS['main' if quick else 'para']
+    results = {"meta": {"engine":    engine,
+                        "grid":      'main' if quick else 'para',
+                        "python":    platform.python_version(),
+                        "numpy":     np.__version__,
+                        "machine":   platform.machine(),
+                        "processor": platform.processor(),
+                        "cpus":      os.cpu_count(),
+                        "date":      time.strftime('%Y-%m-%dT%H:%M:%S')},
+               "cases": {}}
+    for p in P:
+        for t in T:
+            for name, function, units in cases(p, t, engine):
+                repeats = REPEATS[name.split('/')[0]][quick]
+                results["cases"][name] = measure(function, repeats, units)
+                print(f"{name:<24}{results['cases'][name]['p50']:>10.4f}s"
+                      f"{results['cases'][name]['throughput']:>14.1f}/s"
+                      f"{results['cases'][name]['peak_mb']:>10.1f}MB")
+    return results
+
+def agreement(p, t, engines = ('jags', 'numpy')):
+    # Walltimes of fits of a cell's data set with every engine, and the
+    # largest posterior mean difference of each engine from the first
+    _, data = cell(p, t)
+    prior   = Hddm_Prior()
+    samples = []
+    result  = {"walltime": {}, "max_diff_sd": {}}
+    for engine in engines:
+        start = time.perf_counter()
+        samples.append(ezhbddm.estimate(data, prior, 'drift', True, engine, rng = np.random.default_rng(SEED))[1])
+        result["walltime"][engine] = time.perf_counter() - start
+    for engine, other in zip(engines[1:], samples[1:]):
+        comparison = ezhbddm.compare_samples(samples[0], other)
+        result["max_diff_sd"][engine] = None if comparison is None else \
+                                        float(max(abs(z) for _, _, z in comparison.values()))
+    return result
+
+def compare_engines(quick = False, engines = ('jags', 'numpy')):
+    P, T    = GRIDS['main' if quick else 'para']
+    results = {}
+    for p in P:
+        for t in T:
+            name = f'P{p}_T{t}'
+            results[name] = agreement(p, t, engines)
+            print(f"{name:<12}" + ''.join(f"{engine:>8}{results[name]['walltime'][engine]:>9.3f}s"
+                                          for engine in engines) +
+                  ''.join(f"{'diff/sd':>10}{z:>7.3f}" if z is not None else f"{'failed':>17}"
+                          for z in results[name]['max_diff_sd'].values()))
+    return results
+
+def compare(results, baseline, tolerance = 0.25):
+    # Cases whose median latency or peak memory exceed the baseline by more
+    # than the tolerance: list of (case, metric, baseline, current)
+    regressions = []
+    for name, current in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        for metric in ['p50', 'peak_mb']:
+            if current[metric] > (1 + tolerance) * baseline["cases"][name][metric]:
+                regressions.append((name, metric, baseline["cases"][name][metric], current[metric]))
+    return regressions
+
+def save(results, path = BASELINE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return path
+
+def open_baseline(path = BASELINE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    if '--engines' in sys.argv:
+        compare_engines(quick = '--quick' in sys.argv, engines = sys.argv[sys.argv.index('--engines') + 1].split(','))
+        sys.exit()
+
+    engine    = sys.argv[sys.argv.index('--engine') + 1] if '--engine' in sys.argv else 'jags'
+    tolerance = float(sys.argv[sys.argv.index('--tolerance') + 1]) if '--tolerance' in sys.argv else 0.25
+
+    results  = run(quick = '--quick' in sys.argv, engine = engine)
+    baseline = open_baseline()
+
+    regressions = []
+    if baseline is not None:
+        if baseline["meta"]["engine"] != engine:
+            print(f"Baseline is for engine '{baseline['meta']['engine']}'; not comparing.")
+        else:
+            regressions = compare(results, baseline, tolerance)
+            for name, metric, before, after in regressions:
+                print(f"REGRESSION {name} {metric}: {before:.4g} -> {after:.4g} ({after / before - 1:+.0%})")
+            if not regressions:
+                print(f"No regressions beyond {tolerance:.0%}.")
+
+    if '--save' in sys.argv:
+        print(f"Saved baseline to {save(results)}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,220 @@
+# Content-addressed cache of simulated data sets and fits
+
+#   Entries are compressed .npz files in <root>/<ab>/<hash>.npz, named by the
+#   SHA-256 of everything that determines their contents: for a data set the
+#   design, seed and replicate, and for a fit the data summaries, prior,
+#   criterion, engine settings and the model code or sampler source.  Reruns
+#   of a study with some settings changed thus only recompute what changed.
+#   Reads touch an entry, and when the entries exceed max_bytes the least
+#   recently used ones are removed, down to LOW_WATER of max_bytes so that the
+#   store is not scanned on every put.  Several processes may share a cache.
+#
+#   Hddm_Design(cache = Hddm_Cache(...)) memoizes sample_data and
+#   estimate_parameters.  Only seeded designs are cached; the state of the
+#   replicate generator after a step is cached with it, so that a run from
+#   the cache continues exactly as the computed run did.  Cached data sets
+#   hold the per-person summaries, not the trials.
+
+import hashlib
+import importlib
+import json
+import os
+import uuid
+import numpy as np
+
+import parameter_set
+from posterior import Hddm_Posterior, _jsonable
+
+def _update(h, value):
+    # Feeds value to the hash, tagged with its type so that e.g. 1 and '1' differ
+    if isinstance(value, dict):
+        h.update(b'dict')
+        for key in sorted(value):
+            _update(h, key)
+            _update(h, value[key])
+    elif isinstance(value, (list, tuple, np.ndarray)) and np.asarray(value).dtype != object:
+        value = np.ascontiguousarray(value)
+        h.update(f'array{value.dtype.str}{value.shape}'.encode())
+        h.update(value.tobytes())
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        h.update(f'list{len(value)}'.encode())
+        for item in value:
+            _update(h, item)
+    else:
+        h.update(f'{type(value).__name__}:{value}'.encode())
+    h.update(b'\0')
+
+# Modules whose code determines data sets and fits; editing one of them
+# invalidates the entries made with the old code
+DATA_SOURCES = ['data_set', 'wdm']
+FIT_SOURCES  = ['ezhbddm', 'mcmc', 'ez', 'posterior', 'diagnostics', 'parameter_set']
+
+LOW_WATER    = 0.9
+
+_sources = {}
+
+def sources(names):
+    # Hashes of the source files of the named modules
+    for name in names:
+        if name not in _sources:
+            with open(importlib.import_module(name).__file__, 'rb') as f:
+                _sources[name] = hashlib.sha256(f.read()).hexdigest()
+    return [_sources[name] for name in names]
+
+class Hddm_Cache:
+    def __init__(self, root, max_bytes = 2**30):
+        self.root      = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.size      = None   # bytes in the store, scanned on the first put
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha256()
+        for part in parts:
+            _update(h, part)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npz')
+
+    def _entries(self):
+        # (last use, size, path) of every entry
+        entries = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.npz'):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:   # evicted by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        # Dict of the arrays of the entry, or None
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                arrays = {name: f[name] for name in f.files}
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError):   # damaged, e.g. by a crash of another process
+            self.misses += 1
+            self.remove(key)
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self._entries())
+        tmp = path + f'.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        try:
+            self.size -= os.path.getsize(path)   # overwritten
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+        return key
+
+    def remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        # Removes least recently used entries until the cache fills at most
+        # LOW_WATER of max_bytes
+        entries   = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= LOW_WATER * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __getstate__(self):
+        return {"root": self.root, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        # Cheap, as designs holding a cache are unpickled in every worker
+        self.__init__(state["root"], state["max_bytes"])
+
+# Entries of data sets and fits
+
+def _rng_state(rng):
+    return None if rng is None else rng.bit_generator.state
+
+def _set_rng_state(rng, state):
+    if rng is not None and state is not None:
+        rng.bit_generator.state = state
+
+def data_arrays(data, rng):
+    summaries = data.summarize()
+    arrays = {name: np.asarray(summaries[name]) for name in ['person', 'nTrials', 'correct', 'meanRT', 'varRT']}
+    arrays['meta'] = np.array(json.dumps({"n_TrialsPerPerson": data.n_TrialsPerPerson,
+                                          "rng": _jsonable(_rng_state(rng))}))
+    return arrays
+
+def data_from_arrays(arrays, X, rng):
+    from data_set import Hddm_Data
+    meta = json.loads(str(arrays['meta']))
+    _set_rng_state(rng, meta["rng"])
+    return Hddm_Data(n_TrialsPerPerson = meta["n_TrialsPerPerson"], X = X,
+                     summaries = {name: arrays[name] for name in ['person', 'nTrials', 'correct', 'meanRT', 'varRT']})
+
+def fit_arrays(estimate, posterior, rng):
+    # estimate is None for a failed fit, posterior None for the 'ez' engine
+    arrays = {}
+    names  = []
+    if estimate is not None:
+        names = [name for name in vars(estimate) if getattr(estimate, name) is not None]
+        for name in names:
+            arrays['est_' + name] = np.asarray(getattr(estimate, name), dtype=float)
+    meta = {"estimate": estimate is not None, "names": names, "posterior": posterior is not None,
+            "rng": _jsonable(_rng_state(rng))}
+    if posterior is not None:
+        arrays.update({"hyper": posterior.hyper, "individual": posterior.individual,
+                       "participants": posterior.participants})
+        meta.update({"hyper_names":      posterior.hyper_names,
+                     "individual_names": posterior.individual_names,
+                     "diagnostics":      _jsonable(posterior.diagnostics)})
+    arrays['meta'] = np.array(json.dumps(meta))
+    return arrays
+
+def fit_from_arrays(arrays, rng):
+    meta = json.loads(str(arrays['meta']))
+    _set_rng_state(rng, meta["rng"])
+    estimate = posterior = None
+    if meta["estimate"]:
+        estimate = parameter_set.Hddm_Parameter_Set()
+        for name in meta["names"]:
+            value = arrays['est_' + name]
+            setattr(estimate, name, value.item() if value.ndim == 0 else value.tolist())
+    if meta["posterior"]:
+        posterior = Hddm_Posterior(arrays['hyper'], meta["hyper_names"], arrays['individual'],
+                                   meta["individual_names"], arrays['participants'], meta["diagnostics"])
+    return estimate, posterior
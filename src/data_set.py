@@ -5,121 +5,304 @@
 
 import numpy as np
 import pandas as pd
-import pyjags
 import copy
-
-from wdm import wdmrnd
+import json
+import os
+
+import timing
+from wdm import wdmrnd, wdmrnd_batch, ezrnd
+
+def _moments(n, sum_x, sum_x2, shift = 0.0):
+    # Mean and (ddof=0) variance from grouped sums of x - shift
+    n = np.asarray(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sum_x / n
+        var  = np.maximum(sum_x2 / n - mean**2, 0.0)
+    return np.where(n > 0, mean + shift, np.nan), np.where(n > 0, var, np.nan)
+
+def prefix_summaries(rt, accuracy, n_TrialsPerPerson, prefixes):
+    # Summaries of the first t trials of every person, for each t in
+    # prefixes, as a dict by t.  Trials are ordered by person, with
+    # n_TrialsPerPerson each.  The sums are accumulated over the blocks of
+    # trials between consecutive prefixes, so every trial is read once.
+    T       = n_TrialsPerPerson
+    rt      = np.asarray(rt, dtype=float).reshape(-1, T)
+    correct = np.asarray(accuracy).reshape(-1, T) == 1
+    shift   = rt[correct][0] if correct.any() else 0.0
+    rt_c    = np.where(correct, rt - shift, 0.0)
+
+    P = rt.shape[0]
+    n_c, sum_rt, sum_rt2 = np.zeros(P, dtype=int), np.zeros(P), np.zeros(P)
+    summaries, start = {}, 0
+    for t in sorted(prefixes):
+        n_c     = n_c + np.sum(correct[:, start:t], axis=1)
+        sum_rt  = sum_rt + np.sum(rt_c[:, start:t], axis=1)
+        sum_rt2 = sum_rt2 + np.sum(rt_c[:, start:t]**2, axis=1)
+        start   = t
+        mean_rt, var_rt = _moments(n_c, sum_rt, sum_rt2, shift)
+        summaries[t] = {"person":  np.arange(P),
+                        "nTrials": np.full(P, t),
+                        "correct": n_c,
+                        "meanRT":  mean_rt,
+                        "varRT":   var_rt}
+    return summaries
 
 class Hddm_Data():
     def __init__(self, person = None, rt = None, accuracy = None,
-                       n_TrialsPerPerson = None, X = None):
+                       n_TrialsPerPerson = None, X = None, summaries = None):
         self.person            = person
         self.rt                = rt
         self.accuracy          = accuracy
         self.n_TrialsPerPerson = n_TrialsPerPerson
         self.X                 = X
+        # Per-person summary statistics, for data sets without trials
+        self.summaries         = summaries
+        self.summarized        = None   # summarize() of the trials, computed once
+        # Set when the trials are memory-mapped from disk (see save/open)
+        self.offsets           = None
+        self.path              = None
 
     @staticmethod
     def read_rr_data():
         url = "https://osf.io/download/28ahk/"
 
     @staticmethod
-    def sample(design):
+    def sample(design, simulator = 'numpy'):
         T = design.n_TrialsPerPerson
         P = design.n_Participants
         parameters = design.parameter_set
 
-        person_list   = []
-        rt_list       = []
-        accuracy_list = []
+        with timing.timer('wdmrnd'):
+            if simulator == 'numpy':
+                rt, accuracy, person = wdmrnd_batch(parameters.bound[:P],
+                                                    parameters.drift[:P],
+                                                    parameters.nondt[:P], T, rng = design.rng)
+            elif simulator == 'c':
+                # The C simulator keeps its own random state and is not reproducible
+                person   = np.repeat(np.arange(P), T)
+                rt       = np.empty(P * T)
+                accuracy = np.empty(P * T, dtype=bool)
+                for p in range(P):
+                    rt[p*T:(p+1)*T], accuracy[p*T:(p+1)*T] = wdmrnd(parameters.bound[p],
+                                                                    parameters.drift[p],
+                                                                    parameters.nondt[p], T)
+            else:
+                raise ValueError(f"Unknown simulator '{simulator}'.")
+        timing.count('trials', P * T)
+
+        with timing.timer('Hddm_Data'):
+            return Hddm_Data(person, rt, accuracy, T, design.predictor)
 
-        for p in range(P):
-            accuracy = 0
-            rt, accuracy = wdmrnd(parameters.bound[p],
-                                  parameters.drift[p],
-                                  parameters.nondt[p], T)
-            person_list.extend([p] * T)
-            rt_list.extend(rt)
-            accuracy_list.extend(accuracy)
+    @staticmethod
+    def sample_summaries(design):
+        T = design.n_TrialsPerPerson
+        P = design.n_Participants
+        parameters = design.parameter_set
 
-        person   = np.array(person_list)
-        rt       = np.array(rt_list)
-        accuracy = np.array(accuracy_list)
+        with timing.timer('ezrnd'):
+            correct, mean_rt, var_rt = ezrnd(parameters.bound[:P],
+                                             parameters.drift[:P],
+                                             parameters.nondt[:P], T, rng = design.rng)
+
+        return Hddm_Data(n_TrialsPerPerson = T, X = design.predictor,
+                         summaries = {"person":  np.arange(P),
+                                      "nTrials": np.full(P, T),
+                                      "correct": correct,
+                                      "meanRT":  mean_rt,
+                                      "varRT":   var_rt})
+
+    def participants(self):
+        if self.summaries is not None:
+            return self.summaries["person"]
+        if self.offsets is not None:
+            return np.asarray(self.person[self.offsets[:-1]], dtype=np.int64)
+        return np.unique(self.person)
+
+    def person_trials(self, k):
+        # RT and accuracy of the k-th participant, as views on the data
+        if self.offsets is None:
+            raise ValueError("Person offsets are only available for data opened from disk.")
+        start, stop = self.offsets[k], self.offsets[k+1]
+        return self.rt[start:stop], self.accuracy[start:stop]
+
+    def save(self, path):
+        # Columnar layout: int32 person, float32 RT and accuracy, sorted by
+        # person, plus CSR offsets so each person is a slice.  Accuracy is
+        # stored as bytes, which can be memory mapped (format 1 packed it
+        # into accuracy.bits, which open still reads).
+        if self.person is None or self.rt is None or self.accuracy is None:
+            raise ValueError("Only trial-level data can be saved.")
+
+        person = np.asarray(self.person)
+        if not np.issubdtype(person.dtype, np.integer) or \
+           (person.size and (person.min() < np.iinfo(np.int32).min or person.max() > np.iinfo(np.int32).max)):
+            raise ValueError("Person IDs must be integers that fit in int32.")
+
+        rt       = np.asarray(self.rt)
+        accuracy = np.asarray(self.accuracy) == 1
+        if np.any(person[1:] < person[:-1]):
+            order    = np.argsort(person, kind='stable')
+            person, rt, accuracy = person[order], rt[order], accuracy[order]
+
+        ids, counts = np.unique(person, return_counts=True)
+        offsets     = np.concatenate([[0], np.cumsum(counts)])
+
+        os.makedirs(path, exist_ok=True)
+        person.astype(np.int32).tofile(os.path.join(path, 'person.i4'))
+        rt.astype(np.float32).tofile(os.path.join(path, 'rt.f4'))
+        accuracy.astype(np.uint8).tofile(os.path.join(path, 'accuracy.u1'))
+        if os.path.exists(os.path.join(path, 'accuracy.bits')):   # from a format 1 data set
+            os.remove(os.path.join(path, 'accuracy.bits'))
+        offsets.astype(np.int64).tofile(os.path.join(path, 'offsets.i8'))
+        if self.X is not None:
+            np.asarray(self.X, dtype=float).tofile(os.path.join(path, 'X.f8'))
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({"format":            2,
+                       "n_Trials":          int(person.size),
+                       "n_Participants":    int(ids.size),
+                       "n_TrialsPerPerson": self.n_TrialsPerPerson if self.n_TrialsPerPerson is None
+                                            else int(self.n_TrialsPerPerson),
+                       "X":                 self.X is not None}, f)
+        return path
 
-        return Hddm_Data(person, rt, accuracy, T, design.predictor)
+    @staticmethod
+    def open(path):
+        # Read-only memory maps, shared by all processes that open the data;
+        # accuracy of format 1 data sets is unpacked
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        N = meta['n_Trials']
+        P = meta['n_Participants']
+
+        def column(name, dtype, n):
+            if n == 0:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(os.path.join(path, name), dtype=dtype, mode='r', shape=(n,))
+
+        if meta['format'] >= 2:
+            accuracy = column('accuracy.u1', bool, N)
+        else:
+            bits     = np.fromfile(os.path.join(path, 'accuracy.bits'), dtype=np.uint8)
+            accuracy = np.unpackbits(bits, count=N).view(bool)
+        data     = Hddm_Data(person            = column('person.i4', np.int32, N),
+                             rt                = column('rt.f4', np.float32, N),
+                             accuracy          = accuracy,
+                             n_TrialsPerPerson = meta['n_TrialsPerPerson'],
+                             X                 = column('X.f8', np.float64, P) if meta['X'] else None)
+        data.offsets = np.fromfile(os.path.join(path, 'offsets.i8'), dtype=np.int64)
+        data.path    = path
+        return data
+
+    def __getstate__(self):
+        # Data opened from disk is pickled as its path and reopened
+        if self.path is not None:
+            return {"path": self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if set(state) == {"path"}:
+            self.__dict__.update(Hddm_Data.open(state["path"]).__dict__)
+        else:
+            self.__dict__.update({"summaries": None, "summarized": None, "offsets": None, "path": None})
+            self.__dict__.update(state)
+
+    def summarize(self):
+        # Per-person trial counts, number correct and mean and (ddof=0)
+        # variance of the correct RTs, from grouped sums in one pass over the
+        # trials.  Person IDs need not be contiguous; they are returned sorted.
+        if self.summaries is not None:
+            return self.summaries
+        if self.summarized is not None:
+            return self.summarized
 
+        if self.person is None or self.rt is None or self.accuracy is None:
+            return None
+
+        person  = np.asarray(self.person)
+        rt      = np.asarray(self.rt, dtype=float)
+        correct = np.asarray(self.accuracy) == 1
+
+        if self.offsets is not None:
+            ids   = self.participants()
+            group = np.repeat(np.arange(ids.size), np.diff(self.offsets))
+        elif np.issubdtype(person.dtype, np.integer) and person.size and \
+             person.min() >= 0 and person.max() < 4 * person.size:
+            group = person
+        else:
+            ids, group = np.unique(person, return_inverse=True)
+
+        # Shift by one RT so the sums of squares do not lose precision
+        shift   = rt[np.argmax(correct)] if correct.any() else 0.0
+        rt_c    = np.where(correct, rt - shift, 0.0)
+
+        nTrials = np.bincount(group)
+        n_c     = np.bincount(group, weights=correct, minlength=nTrials.size)
+        sum_rt  = np.bincount(group, weights=rt_c,        minlength=nTrials.size)
+        sum_rt2 = np.bincount(group, weights=rt_c * rt_c, minlength=nTrials.size)
+
+        if group is person:
+            ids = np.flatnonzero(nTrials)
+            nTrials, n_c, sum_rt, sum_rt2 = nTrials[ids], n_c[ids], sum_rt[ids], sum_rt2[ids]
+
+        mean_rt, var_rt = _moments(n_c, sum_rt, sum_rt2, shift)
+
+        self.summarized = {"person":  ids,
+                           "nTrials": nTrials,
+                           "correct": n_c.astype(int),
+                           "meanRT":  mean_rt,
+                           "varRT":   var_rt}
+        return self.summarized
 
     def summary(self):
-        if self.person is None or self.rt is None or self.accuracy is None:
+        summaries = self.summarize()
+        if summaries is None:
             print("Data not available.")
             return
 
-        unique_persons = np.unique(np.array(self.person))
         print("{:<10} {:<20} {:<20} {:<20}".format("Person",
                                                    "Mean Accuracy",
                                                    "Mean RT (Correct)",
                                                    "Variance RT (Correct)"))
 
-        for person_id in unique_persons:
-            person_indices  = np.where(self.person == person_id)
-            person_rts      = np.array(self.rt)[person_indices]
-            person_accuracy = np.array(self.accuracy)[person_indices]
-
-            mean_accuracy       = np.mean(person_accuracy)
-            correct_rts         = person_rts[person_accuracy == 1]
-            mean_rt_correct     = np.mean(correct_rts) if len(correct_rts) > 0 else np.nan
-            variance_rt_correct = np.var(correct_rts) if len(correct_rts) > 0 else np.nan
-
+        for person_id, n, correct, mean_rt, var_rt in zip(summaries["person"],
+                                                          summaries["nTrials"],
+                                                          summaries["correct"],
+                                                          summaries["meanRT"],
+                                                          summaries["varRT"]):
             print("{:<10} {:<20.3f} {:<20.3f} {:<20.3f}".format(person_id,
-                                                                mean_accuracy,
-                                                                mean_rt_correct,
-                                                                variance_rt_correct))
+                                                                correct / n,
+                                                                mean_rt,
+                                                                var_rt))
 
     def to_jags(self):
-        if self.person is None or self.rt is None or self.accuracy is None:
+        summaries = self.summarize()
+        if summaries is None:
             return None
 
-        unique_persons = np.unique(np.array(self.person)).astype(int)
-        nParticipants  = len(unique_persons)
-        nTrials        = np.repeat(int(self.n_TrialsPerPerson), nParticipants)
-
-        sum_accuracy        = np.zeros(nParticipants, dtype=int)
-        mean_rt_correct     = np.full(nParticipants, np.nan)
-        variance_rt_correct = np.full(nParticipants, np.nan)
-
-        for person_id in unique_persons:
-            person_indices  = self.person == person_id
-            person_rts      = self.rt[person_indices]
-            person_accuracy = self.accuracy[person_indices]
-
-            sum_accuracy[person_id] = np.sum(person_accuracy)
-            correct_rts = person_rts[person_accuracy == 1]
-
-            if correct_rts.size > 1:
-                mean_rt_correct[person_id]     = np.mean(correct_rts)
-                variance_rt_correct[person_id] = np.var(correct_rts)
-
-        valid_indices = ~(
-            np.isnan(mean_rt_correct) |
-            np.isnan(variance_rt_correct)
+        correct = np.asarray(summaries["correct"])
+        valid_indices = (correct > 1) & ~(
+            np.isnan(summaries["meanRT"]) |
+            np.isnan(summaries["varRT"])
         )
 
-        nTrials             = nTrials[valid_indices].tolist()
-        sum_accuracy        = sum_accuracy[valid_indices].tolist()
-        mean_rt_correct     = mean_rt_correct[valid_indices].tolist()
-        variance_rt_correct = variance_rt_correct[valid_indices].tolist()
-        X                   = self.X[valid_indices].tolist()
-
         return {
-            "nTrials": nTrials,
-            "meanRT":  mean_rt_correct,
-            "varRT":   variance_rt_correct,
-            "correct": sum_accuracy,
-            "X":       X,
-        }, unique_persons[valid_indices]
-
+            "nTrials": np.asarray(summaries["nTrials"])[valid_indices].tolist(),
+            "meanRT":  np.asarray(summaries["meanRT"])[valid_indices].tolist(),
+            "varRT":   np.asarray(summaries["varRT"])[valid_indices].tolist(),
+            "correct": correct[valid_indices].tolist(),
+            "X":       np.asarray(self.X)[valid_indices].tolist(),
+        }, np.asarray(summaries["person"])[valid_indices]
 
     def __str__(self):
+        if self.summaries is not None:
+            return '\n'.join([
+                "Hddm_Data Details:",
+                f"Person:    {self.summaries['person']}",
+                f"Correct:   {self.summaries['correct']}",
+                f"Mean RT:   {self.summaries['meanRT']}",
+                f"Var RT:    {self.summaries['varRT']}"
+            ])
         output = [
             "Hddm_Data Details:",
             f"Person:    {self.person}",
@@ -130,36 +313,97 @@ class Hddm_Data():
 
 
 
+# Accumulates per person x condition trial counts, number correct, and sums
+# and sums of squares of the correct RTs.  Accumulators built from different
+# chunks or files can be merged.
+class Hddm_Summary_Accumulator():
+    columns = ['nTrials', 'correct', 'sum_rt', 'sum_rt2']
+
+    def __init__(self):
+        self.table = pd.DataFrame(columns = self.columns, dtype = float,
+                                  index = pd.MultiIndex.from_arrays([[], []], names = ['person', 'condition']))
+
+    def add(self, person, condition, rt, accuracy):
+        correct = np.asarray(accuracy) == 1
+        rt_c    = np.where(correct, np.asarray(rt, dtype=float), 0.0)
+        chunk   = pd.DataFrame({'person':    np.asarray(person),
+                                'condition': np.asarray(condition),
+                                'nTrials':   1.0,
+                                'correct':   correct.astype(float),
+                                'sum_rt':    rt_c,
+                                'sum_rt2':   rt_c * rt_c})
+        other = Hddm_Summary_Accumulator()
+        other.table = chunk.groupby(['person', 'condition'], sort = False)[self.columns].sum()
+        return self.merge(other)
+
+    def merge(self, other):
+        if len(self.table) == 0:
+            self.table = other.table
+        elif len(other.table):
+            self.table = pd.concat([self.table, other.table]).groupby(level = [0, 1], sort = False).sum()
+        return self
+
+    def to_data(self, X = None):
+        # X maps a condition to its predictor value (dict or function); the
+        # default is a zero predictor.  Rows are sorted by person and condition.
+        table = self.table.sort_index()
+        person    = table.index.get_level_values('person').to_numpy()
+        condition = table.index.get_level_values('condition').to_numpy()
+        correct   = table['correct'].to_numpy()
+        mean_rt, var_rt = _moments(correct, table['sum_rt'].to_numpy(), table['sum_rt2'].to_numpy())
+
+        if X is None:
+            X = np.zeros(len(table))
+        else:
+            X = np.array([X(c) if callable(X) else X[c] for c in condition], dtype=float)
+
+        return Hddm_Data(X = X,
+                         summaries = {"person":    np.arange(len(table)),
+                                      "nTrials":   table['nTrials'].to_numpy().astype(int),
+                                      "correct":   correct.astype(int),
+                                      "meanRT":    mean_rt,
+                                      "varRT":     var_rt,
+                                      "subject":   person,
+                                      "condition": condition})
+
+
+# Censoring rules of the metastudy: no response given, or not the test phase
+def metastudy_censor(chunk):
+    return ((chunk['respX'] == 0) & (chunk['respY'] == 0)) | (chunk['phase'] != 1)
+
+# Reads a trial-level CSV/TSV file in chunks and accumulates per person x
+# condition summaries without holding the file in memory.  person may be None
+# for single-participant files; accuracy may be a column name or a function of
+# the chunk; censor is a function of the chunk returning the rows to drop.
+# rt_scale converts the RT column to seconds (0.001 for milliseconds), and
+# rt_bounds are in seconds.
+def read_trials(file_path, person = 'session', condition = 'cond', rt = 'rt', accuracy = 'acc',
+                rt_bounds = (0.15, 2.5), rt_scale = 1.0, censor = metastudy_censor,
+                chunksize = 1000000, accumulator = None, **read_csv_args):
+    accumulator = Hddm_Summary_Accumulator() if accumulator is None else accumulator
+
+    for chunk in pd.read_csv(file_path, chunksize = chunksize, **read_csv_args):
+        rts  = chunk[rt].to_numpy(dtype=float) * rt_scale
+        drop = (rts > rt_bounds[1]) | (rts < rt_bounds[0])
+        if censor is not None:
+            drop |= np.asarray(censor(chunk), dtype=bool)
+
+        keep = ~drop
+        acc  = accuracy(chunk) if callable(accuracy) else chunk[accuracy]
+        accumulator.add(chunk[person].to_numpy()[keep] if person is not None else np.zeros(keep.sum(), dtype=int),
+                        chunk[condition].to_numpy()[keep],
+                        rts[keep],
+                        np.asarray(acc)[keep])
+
+    return accumulator
+
 # https://osf.io/download/28ahk/
 
 # Function to read and process the metastudy data
-def process_data(file_path):
-    # Reading the CSV file
-    data = pd.read_csv(file_path)
-
-    # Selecting only the relevant columns
+def process_data(file_path, X = None):
     selected_columns = ['phase', 'acc', 'rt', 'cond', 'session', 'respX', 'respY']
-    data = data[selected_columns]
-
-    # Applying the censor/filter conditions
-    censor_conditions = (data['rt'] > 2.5) | (data['rt'] < 0.15) | ((data['respX'] == 0) & (data['respY'] == 0)) | (data['phase'] != 1)
-    filtered_data = data[~censor_conditions]
-
-    # Selecting the independent variable (iv), dependent variable (dv), and facet
-    iv = filtered_data['cond']
-    dv = filtered_data['acc']
-    facet = filtered_data['session']
-
-    # Printing the results
-    print("Independent Variable (iv):", iv.head())
-    print("Dependent Variable (dv):", dv.head())
-    print("Facet:", facet.head())
-    print('done.')
+    return read_trials(file_path, usecols = selected_columns).to_data(X)
 
 #url = "https://osf.io/download/28ahk/"
 
 #process_data(file_path)
-
-
-
-
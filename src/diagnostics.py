@@ -0,0 +1,75 @@
+# Convergence diagnostics for MCMC samples
+
+#   Split-R-hat and bulk/tail effective sample sizes after Vehtari, Gelman,
+#   Simpson, Carpenter & Buerkner (2021).  All functions take arrays shaped
+#   (..., draws, chains), as returned by pyjags, and reduce the last two axes.
+
+import numpy as np
+from scipy.special import ndtri
+
+def split_chains(x):
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-2] // 2
+    return np.concatenate([x[..., :n, :], x[..., x.shape[-2] - n:, :]], axis=-1)
+
+def _rank_normalize(x):
+    shape = x.shape
+    flat  = x.reshape(shape[:-2] + (-1,))
+    ranks = np.argsort(np.argsort(flat, axis=-1), axis=-1) + 1
+    return ndtri((ranks - 0.375) / (flat.shape[-1] + 0.25)).reshape(shape)
+
+def _rhat(x):
+    n = x.shape[-2]
+    chain_mean = x.mean(axis=-2)
+    W = x.var(axis=-2, ddof=1).mean(axis=-1)
+    B = n * chain_mean.var(axis=-1, ddof=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(((n - 1) / n * W + B / n) / W)
+
+def rhat(x):
+    # Maximum of the rank-normalized split-R-hat of the draws and of their
+    # distance from the median
+    s = split_chains(x)
+    folded = np.abs(s - np.median(s, axis=(-2, -1), keepdims=True))
+    return np.fmax(_rhat(_rank_normalize(s)), _rhat(_rank_normalize(folded)))
+
+def _ess(x):
+    n, m = x.shape[-2], x.shape[-1]
+    centered = x - x.mean(axis=-2, keepdims=True)
+    f     = np.fft.rfft(centered, n=2 * n, axis=-2)
+    acov  = np.fft.irfft(f * np.conj(f), n=2 * n, axis=-2)[..., :n, :] / n
+    chain_var = acov[..., 0, :] * n / (n - 1)
+    mean_var  = chain_var.mean(axis=-1)
+    var_plus  = mean_var * (n - 1) / n
+    if m > 1:
+        var_plus = var_plus + x.mean(axis=-2).var(axis=-1, ddof=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = 1 - (mean_var[..., None] - acov.mean(axis=-1)) / var_plus[..., None]
+    rho[..., 0] = 1
+
+    # Geyer's initial monotone sequence of paired autocorrelations
+    pairs = rho[..., 0:n - n % 2:2] + rho[..., 1:n - n % 2:2]
+    keep  = np.cumprod(pairs > 0, axis=-1).astype(bool)
+    pairs = np.minimum.accumulate(np.where(keep, pairs, 0), axis=-1)
+    tau   = -1 + 2 * np.sum(np.where(keep, pairs, 0), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(np.isfinite(tau) & (tau > 0), n * m / np.maximum(tau, 1 / np.log10(n * m)), np.nan)
+
+def ess_bulk(x):
+    return _ess(_rank_normalize(split_chains(x)))
+
+def ess_tail(x):
+    s  = split_chains(x)
+    lo = np.quantile(s, 0.05, axis=(-2, -1), keepdims=True)
+    hi = np.quantile(s, 0.95, axis=(-2, -1), keepdims=True)
+    return np.fmin(_ess((s <= lo).astype(float)), _ess((s <= hi).astype(float)))
+
+def summarize(samples, varnames):
+    # Diagnostics of each named variable: scalars for pyjags' (1, draws,
+    # chains) scalar nodes, arrays for vector nodes
+    squeeze = lambda value: value[0] if value.shape == (1,) else value
+    return {varname: {"rhat":     squeeze(rhat(samples[varname])),
+                      "ess_bulk": squeeze(ess_bulk(samples[varname])),
+                      "ess_tail": squeeze(ess_tail(samples[varname]))}
+            for varname in varnames}
@@ -0,0 +1,82 @@
+# Closed-form EZ Diffusion estimates
+
+#   Inverts the EZ Diffusion equations on the summary statistics of each
+#   participant (as in DataSet.to_jags) and estimates the hyperparameters from
+#   the moments of the individual estimates, with the betaweight as the slope
+#   of the criterion parameter on X.  Cheap enough to screen very large data
+#   sets, and used as initial values of the chains by ezhbddm.estimate.
+
+import numpy as np
+
+import parameter_set
+from mcmc import LOWER, UPPER
+from wdm import ez_moments
+
+INDIVIDUAL = parameter_set.INDIVIDUAL
+
+def inverse(correct, nTrials, meanRT, varRT):
+    # Per participant (bound, drift, nondt).  Since logit(Pc) = a*v, the
+    # moments of a unit bound with drift logit(Pc) give VRT = a^4 * VRT1 and
+    # MRT = a^2 * MDT1 + t.  This is the classic inverse, but it stays finite at
+    # Pc = 0.5 (drift 0, bound (24 VRT)^(1/4)); Pc of 0 and 1 are corrected by
+    # half a trial.
+    correct = np.asarray(correct, dtype=float)
+    nTrials = np.asarray(nTrials, dtype=float)
+    Pc      = np.clip(correct / nTrials, 0.5 / nTrials, 1 - 0.5 / nTrials)
+    L       = np.log(Pc) - np.log1p(-Pc)
+
+    _, MDT1, VRT1 = ez_moments(1.0, L, 0.0)
+    bound = (np.asarray(varRT, dtype=float) / VRT1) ** 0.25
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drift = np.where(bound > 0, L / bound, np.nan)
+    nondt = np.asarray(meanRT, dtype=float) - bound**2 * MDT1
+    return bound, drift, nondt
+
+def _clip(values, lower, upper, margin = 0.01):
+    # Strictly inside the bounds, so that the values are valid initial values
+    return np.clip(values, lower + margin, upper - margin)
+
+def estimate(data, criterion = 'drift'):
+    # data as returned by DataSet.to_jags(); returns an Hddm_Parameter_Set
+    # with the individual parameters of the participants in data
+    x = np.stack(inverse(data['correct'], data['nTrials'], data['meanRT'], data['varRT']), axis=-1)
+    x = np.where(np.isfinite(x), x, (LOWER + np.minimum(UPPER, 3.0)) / 2)
+    x = _clip(x, LOWER, UPPER)
+    X = np.asarray(data['X'], dtype=float)
+    P = len(x)
+
+    # With several criteria (the bBDN model), each has its own betaweight
+    single = criterion is None or isinstance(criterion, str)
+    est    = parameter_set.Hddm_Parameter_Set()
+    for name in parameter_set.hyperparameters(criterion):
+        if name.startswith('betaweight'):
+            setattr(est, name, 0.0)
+    for k, name in enumerate(INDIVIDUAL):
+        y = x[:, k]
+        setattr(est, name, y)
+        if name in parameter_set.criteria(criterion) and P > 2 and np.var(X) > 0:
+            slope, mean = np.polyfit(X, y, 1)
+            residual = y - mean - slope * X
+            sdev     = np.sqrt(np.sum(residual**2) / (P - 2))
+            setattr(est, 'betaweight' if single else 'betaweight_' + name, slope)
+        else:
+            mean = np.mean(y)
+            sdev = np.std(y, ddof=1) if P > 1 else 0.0
+        setattr(est, name + '_mean', mean)
+        setattr(est, name + '_sdev', sdev)
+    return est
+
+def init(data, prior, criterion = 'drift'):
+    # Initial values for either engine, inside the truncation bounds of the
+    # individual parameters and the support of the priors
+    est  = estimate(data, criterion)
+    init = {name: np.asarray(getattr(est, name)) for name in INDIVIDUAL}
+    for k, name in enumerate(INDIVIDUAL):
+        init[name + '_mean'] = float(_clip(getattr(est, name + '_mean'), LOWER[k], min(UPPER[k], 3.0)))
+        init[name + '_sdev'] = float(_clip(getattr(est, name + '_sdev'),
+                                           getattr(prior, name + '_sdev_lower'), getattr(prior, name + '_sdev_upper'),
+                                           0.001))
+    for name in parameter_set.hyperparameters(criterion):
+        if name.startswith('betaweight'):
+            init[name] = float(_clip(getattr(est, name), prior.betaweight_lower, prior.betaweight_upper, 0.001))
+    return init
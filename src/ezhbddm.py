@@ -2,10 +2,24 @@
 
 import numpy as np
 import pandas as pd
-import pyjags
 import copy
+import collections
 
 import parameter_set
+import mcmc
+import ez
+from posterior import Hddm_Posterior
+import diagnostics
+import timing
+from wdm import ez_moments
+
+try:
+    import pyjags
+except ImportError:     # only the 'jags' engine needs JAGS; results can be read without it
+    pyjags = None
+
+HYPERPARAMETERS = parameter_set.HYPERPARAMETERS
+INDIVIDUAL      = parameter_set.INDIVIDUAL
 
 def ez_jags_code(prior, criterion, version = 'base'):
     if version == 'base':
@@ -41,6 +55,40 @@ def ez_jags_code(prior, criterion, version = 'base'):
             }}
         }}
         """
+    if version == 'batch':
+        # Independent copies of the base model, one per block of participants
+        code = f"""
+        model {{
+            # Priors for the hierarchical diffusion model parameters of each block
+            for (b in 1:B) {{
+                betaweight[b] ~ dunif({prior.betaweight_lower}, {prior.betaweight_upper})
+                bound_mean[b] ~ dnorm({prior.bound_mean_mean},  {prior.bound_mean_sdev**-2}) T( 0.10, 3.00)
+                drift_mean[b] ~ dnorm({prior.drift_mean_mean},  {prior.drift_mean_sdev**-2}) T(-3.00, 3.00)
+                nondt_mean[b] ~ dnorm({prior.nondt_mean_mean},  {prior.nondt_mean_sdev**-2}) T( 0.05,)
+                bound_sdev[b] ~ dunif({prior.bound_sdev_lower}, {prior.bound_sdev_upper})
+                drift_sdev[b] ~ dunif({prior.drift_sdev_lower}, {prior.drift_sdev_upper})
+                nondt_sdev[b] ~ dunif({prior.nondt_sdev_lower}, {prior.nondt_sdev_upper})
+            }}
+
+            for (p in 1:length(meanRT)) {{
+                bound[p] ~ dnorm(bound_mean[block[p]]{' + betaweight[block[p]] * X[p]' if criterion == 'bound' else ''}, pow(bound_sdev[block[p]], -2)) T( 0.10, 3.00)
+                drift[p] ~ dnorm(drift_mean[block[p]]{' + betaweight[block[p]] * X[p]' if criterion == 'drift' else ''}, pow(drift_sdev[block[p]], -2)) T(-3.00, 3.00)
+                nondt[p] ~ dnorm(nondt_mean[block[p]]{' + betaweight[block[p]] * X[p]' if criterion == 'nondt' else ''}, pow(nondt_sdev[block[p]], -2)) T( 0.05,)
+
+                # Forward equations from EZ Diffusion
+                ey[p]  = exp(-bound[p] * drift[p])
+                Pc[p]  = 1 / (1 + ey[p])
+                PRT[p] = 2 * pow(drift[p], 3) / bound[p] * pow(ey[p] + 1, 2) / (2 * -bound[p] * drift[p] * ey[p] - ey[p]*ey[p] + 1)
+                MDT[p] = (bound[p] / (2 * drift[p])) * (1 - ey[p]) / (1 + ey[p])
+                MRT[p] = MDT[p] + nondt[p]
+
+                # Loss functions using MRT, PRT, and Pc
+                correct[p] ~ dbin(Pc[p], nTrials[p])
+                varRT[p]   ~ dnorm(1/PRT[p], 0.5 * (correct[p]-1) * PRT[p] * PRT[p])
+                meanRT[p]  ~ dnorm(MRT[p], PRT[p] * correct[p])
+            }}
+        }}
+        """
     if version == 'bBDN':
         code = f"""
         model {{
@@ -77,28 +125,180 @@ def ez_jags_code(prior, criterion, version = 'base'):
         """
     return code
 
-def estimate(dataObject, priorObject, criterion = 'drift', silent = False):
+# Hyperparameters are always monitored; individual parameters may be dropped
+# to save memory, at the cost of NaN individual estimates
+MONITORED = ['bound_mean', 'drift_mean', 'nondt_mean',
+             'bound_sdev', 'drift_sdev', 'nondt_sdev',  'betaweight',
+             'bound',      'drift',      'nondt']
 
-    code = ez_jags_code(priorObject, criterion, 'base')
+def monitored_variables(monitored = None, hyperparameters = HYPERPARAMETERS):
+    monitored = [varname for varname in (MONITORED if monitored is None else monitored) if varname != 'betaweight']
+    return list(dict.fromkeys(hyperparameters + monitored))
 
-    data, valid_indices = dataObject.to_jags()
+# Settings of the adaptive run length: draws are taken in increments until
+# every hyperparameter reaches the R-hat and ESS targets, or max_draws is hit
+ADAPTIVE = {"increment": 200, "max_draws": 4000, "rhat": 1.01, "ess_bulk": 400, "ess_tail": 400}
 
-    n_Original_Participants = len(np.unique(dataObject.person))
-    n_Participants = len(data['nTrials'])
-    #print(f"{n_Original_Participants} participants originally. {len(valid_indices)} valid indices. {n_Participants} participants remain.")
+def seeded_init(init, rng, chains = 4):
+    # One init per chain, each with its own JAGS seed drawn from the generator
+    if rng is None:
+        return init
+    return [dict(init, **{".RNG.name": "base::Mersenne-Twister", ".RNG.seed": int(seed)})
+            for seed in rng.integers(1, 2**31 - 1, chains)]
 
-    # Initial values
-    init = { "drift" : np.random.normal(0, 0.1, n_Participants) }
+# Suffixes of the design matrices and betaweights of the bBDN model
+BBDN = {'bound': 'B', 'drift': 'D', 'nondt': 'N'}
 
-    try:
-        model = pyjags.Model(
+class _Bbdn:
+    # The pyjags model of the bBDN code, with its betaweights sampled under
+    # the names of parameter_set.hyperparameters: betaweightD is 'betaweight_drift'
+    def __init__(self, model, criteria):
+        self.model = model
+        self.nodes = {'betaweight_' + varname: 'betaweight' + BBDN[varname] for varname in criteria}
+
+    def sample(self, iterations, vars = None):
+        samples = self.model.sample(iterations, vars = None if vars is None else [self.nodes.get(v, v) for v in vars])
+        for varname, node in self.nodes.items():
+            if node in samples:
+                samples[varname] = samples.pop(node)[0]     # betaweightD[1,b]: (1, B, draws, chains)
+        return samples
+
+def jags_model(data, priorObject, criterion, init, rng = None):
+    if criterion is None or isinstance(criterion, str):
+        return pyjags.Model(
                 progress_bar = False,
-                code    = code,
+                code    = ez_jags_code(priorObject, criterion, 'base'),
                 data    = data,
-                init    = init,
+                init    = seeded_init(init, rng),
                 adapt   = 100,
                 chains  = 4,
-                threads = 4)
+                threads = THREADS['jags'])
+
+    # Several criteria: the bBDN model, with X as the single row of the
+    # design matrix of every criterion and a zero row for the others
+    X    = np.asarray(data['X'], dtype=float)[None, :]
+    data = {key: value for key, value in data.items() if key != 'X'}
+    data.update({'X' + BBDN[varname]: X if varname in criterion else np.zeros_like(X) for varname in INDIVIDUAL})
+    data['B'] = 1
+    init = {('betaweight' + BBDN[varname[len('betaweight_'):]] if varname.startswith('betaweight_') else varname):
+            (np.full((1, 1), value) if varname.startswith('betaweight_') else value) for varname, value in init.items()}
+    return _Bbdn(pyjags.Model(
+            progress_bar = False,
+            code    = ez_jags_code(priorObject, criterion, 'bBDN'),
+            data    = data,
+            init    = seeded_init(init, rng),
+            adapt   = 100,
+            chains  = 4,
+            threads = THREADS['jags']), criterion)
+
+# Adaptation iterations of the 'numpy' engine, before its DRAWS per chain.
+# Against fits with 4000 adaptation iterations and 10000 draws, 500 and 1000
+# keep the largest hyperparameter posterior mean difference within 0.25
+# posterior standard deviations from P=20 to P=320, as 1000 and 1000 do, in
+# three quarters of the time; 500 draws double the difference at P=20.
+# python benchmark.py --engines jags,numpy compares the engines per cell.
+NUMPY_ADAPT = 500
+
+def numpy_model(data, priorObject, criterion, init, rng = None):
+    return mcmc.Model(data, priorObject, criterion, init = init, adapt = NUMPY_ADAPT, rng = rng)
+
+# Models of the 'warm' engine, kept per process by (prior, criterion, trial
+# counts, predictor) and least recently used first, with proposal scales
+# adapted once on reference data: participants at the prior means, whose
+# summaries are the EZ moments.  A fit with a cached model restarts the
+# chains on the new data from those scales (see mcmc.Model.reset), which
+# skips most of the adaptation.  The scales do not depend on earlier fits, so
+# each fit is a function of its replicate alone, whichever process runs it.
+# JAGS models cannot take new data once compiled, so there is no warm JAGS.
+WARM_MODELS = 8
+WARM_ADAPT  = 200
+_warm       = collections.OrderedDict()
+
+def _reference(data, priorObject, criterion):
+    n  = np.asarray(data['nTrials'], dtype=float)
+    X  = np.asarray(data['X'], dtype=float)
+    bw = (priorObject.betaweight_lower + priorObject.betaweight_upper) / 2
+    x  = np.stack([getattr(priorObject, name + '_mean_mean') + (bw * X if name in parameter_set.criteria(criterion) else 0 * X)
+                   for name in INDIVIDUAL], axis=-1)
+    x  = ez._clip(x, mcmc.LOWER, np.minimum(mcmc.UPPER, 3.0))
+    Pc, MRT, VRT = ez_moments(x[:, 0], x[:, 1], x[:, 2])
+    return {"nTrials": n, "correct": np.clip(np.round(Pc * n), 1, n - 1), "meanRT": MRT, "varRT": VRT, "X": X}
+
+def warm_model(data, priorObject, criterion, init, rng = None):
+    key = (str(vars(priorObject)), str(criterion),
+           np.asarray(data['nTrials'], dtype=float).tobytes(), np.asarray(data['X'], dtype=float).tobytes())
+    if key not in _warm:
+        model = numpy_model(_reference(data, priorObject, criterion), priorObject, criterion, None,
+                            np.random.default_rng(0))
+        _warm[key] = (model, model.tuning())
+    _warm.move_to_end(key)
+    while len(_warm) > WARM_MODELS:
+        _warm.popitem(last = False)
+    model, tuning = _warm[key]
+    return model.reset(data, tuning, init, rng, WARM_ADAPT)
+
+# The 'ez' engine does no sampling: it returns the closed-form estimates of ez.py
+ENGINES = {'jags': jags_model, 'numpy': numpy_model, 'warm': warm_model, 'ez': None}
+DRAWS   = {'jags': 400, 'numpy': 1000, 'warm': 1000, 'ez': 0}
+THREADS = {'jags': 4, 'numpy': 1, 'warm': 1, 'ez': 1}
+
+def sample_adaptive(model, settings = None, silent = False, monitored = None, hyperparameters = HYPERPARAMETERS):
+    settings  = dict(ADAPTIVE, **(settings or {}))
+    monitored = monitored_variables(monitored, hyperparameters)
+    with timing.timer('sample'):
+        samples = model.sample(settings["increment"], vars = monitored)
+    while True:
+        with timing.timer('diagnostics'):
+            diag = diagnostics.summarize(samples, hyperparameters)
+        converged = all(np.all(d["rhat"] < settings["rhat"]) and
+                        np.all(d["ess_bulk"] >= settings["ess_bulk"]) and
+                        np.all(d["ess_tail"] >= settings["ess_tail"]) for d in diag.values())
+        draws = samples[hyperparameters[0]].shape[-2]
+        if converged or draws >= settings["max_draws"]:
+            break
+        with timing.timer('sample'):
+            more    = model.sample(min(settings["increment"], settings["max_draws"] - draws), vars = monitored)
+            samples = {varname: np.concatenate([samples[varname], more[varname]], axis = -2) for varname in samples}
+
+    timing.count('draws', draws)
+    diag.update({"draws": draws, "converged": converged})
+    if not converged and not silent:
+        print(f"Warning: no convergence after {draws} draws.")
+    samples['diagnostics'] = diag
+    return samples
+
+def estimate(dataObject, priorObject, criterion = 'drift', silent = False, engine = 'jags',
+             adaptive = False, monitored = None, dtype = np.float64, rng = None):
+    # rng: a numpy Generator makes the fit reproducible, including the JAGS
+    # chains; by default the global numpy state is used and JAGS seeds itself.
+    # criterion: a list of criteria fits the bBDN model, with one betaweight
+    # per criterion (see parameter_set.hyperparameters).
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}'; choose from {list(ENGINES)}.")
+    if engine == 'jags' and pyjags is None:
+        raise ValueError("The 'jags' engine needs pyjags; choose the 'numpy' engine or install pyjags.")
+
+    with timing.timer('to_jags'):
+        data, valid_indices = dataObject.to_jags()
+
+    n_Participants = len(data['nTrials'])
+    timing.count('participants', n_Participants)
+
+    if engine == 'ez':
+        with timing.timer('ez'):
+            return _collect_ez(data, valid_indices, dataObject.participants(), criterion)
+
+    # Initial values from the closed-form estimates, with drifts jittered as
+    # before so that the chains do not all start at the same point
+    with timing.timer('init'):
+        init = ez.init(data, priorObject, criterion)
+        init["drift"] = np.clip(init["drift"] + (np.random if rng is None else rng).normal(0, 0.1, n_Participants), -2.99, 2.99)
+
+    try:
+        # Includes the adaptation phase, which pyjags runs when building the model
+        with timing.timer('compile'):
+            model = ENGINES[engine](data, priorObject, criterion, init, rng)
     except Exception as e:
         if not silent:
             error_message = str(e)
@@ -107,49 +307,140 @@ def estimate(dataObject, priorObject, criterion = 'drift', silent = False):
             print(data)
         return None, None
 
-    samples = model.sample(400,
-                           vars = ['bound_mean', 'drift_mean', 'nondt_mean',
-                                   'bound_sdev', 'drift_sdev', 'nondt_sdev',  'betaweight',
-                                   'bound',      'drift',      'nondt'])
-
-    # Annoying management of sample object...  First move individual parameters to their own fields
-    for i in range(n_Participants):
-        samples.update({'bound_'+str(valid_indices[i]): samples['bound'][i,:,:],
-                        'drift_'+str(valid_indices[i]): samples['drift'][i,:,:],
-                        'nondt_'+str(valid_indices[i]): samples['nondt'][i,:,:], })
-
-    # ... remove the old unwieldy matrices
-    for s in ["bound", "drift", "nondt"]:
-        samples.pop(s)
-
-    # Start a new dict with estimates only
-    estimate = { "bound": [np.nan] * n_Original_Participants,
-                 "drift": [np.nan] * n_Original_Participants,
-                 "nondt": [np.nan] * n_Original_Participants
-               }
-
-    for varname in ['bound_mean', 'drift_mean', 'nondt_mean', 'betaweight',
-                    'bound_sdev', 'drift_sdev', 'nondt_sdev']:
-        estimate.update({varname: np.mean(samples[varname])})
-
-    # ... make new, wieldy matrices
-    for i in valid_indices:
-        estimate['bound'][i] = np.mean(samples['bound_'+str(i)])
-        estimate['drift'][i] = np.mean(samples['drift_'+str(i)])
-        estimate['nondt'][i] = np.mean(samples['nondt_'+str(i)])
-
-    # Copy estimate to design object
+    hyperparameters = parameter_set.hyperparameters(criterion)
+    if adaptive:
+        samples = sample_adaptive(model, adaptive if isinstance(adaptive, dict) else None, silent, monitored, hyperparameters)
+    else:
+        with timing.timer('sample'):
+            samples = model.sample(DRAWS[engine], vars = monitored_variables(monitored, hyperparameters))
+        timing.count('draws', DRAWS[engine])
+
+    with timing.timer('collect'):
+        return _collect(samples, valid_indices, dataObject.participants(), dtype, hyperparameters)
+
+def _collect(samples, valid_indices, participants, dtype = np.float64, hyperparameters = HYPERPARAMETERS):
+    # Keep the samples as one compact posterior object, and summarize
+    # individual parameters per original participant (IDs need not be 0..P-1)
+    posterior = Hddm_Posterior.from_samples(samples, valid_indices, hyperparameters, INDIVIDUAL, dtype)
+    positions = np.searchsorted(participants, valid_indices)
+
     est = parameter_set.Hddm_Parameter_Set()
-    est.bound_mean = estimate['bound_mean']
-    est.drift_mean = estimate['drift_mean']
-    est.nondt_mean = estimate['nondt_mean']
-    est.bound_sdev = estimate['bound_sdev']
-    est.drift_sdev = estimate['drift_sdev']
-    est.nondt_sdev = estimate['nondt_sdev']
-    est.bound      = estimate['bound']
-    est.drift      = estimate['drift']
-    est.nondt      = estimate['nondt']
-    est.betaweight = estimate['betaweight']
-
-    return est, samples
+    for varname in hyperparameters:
+        setattr(est, varname, posterior.mean(varname))
+    for varname in INDIVIDUAL:
+        values = [np.nan] * len(participants)
+        if varname in posterior.individual_names:
+            for k, value in zip(positions, posterior.mean(varname)):
+                values[k] = value
+        setattr(est, varname, values)
+
+    return est, posterior
+
+def _collect_ez(data, valid_indices, participants, criterion):
+    # Closed-form estimates; there is no posterior
+    if len(valid_indices) == 0:
+        return None, None
+    est       = ez.estimate(data, criterion)
+    positions = np.searchsorted(participants, valid_indices)
+    for varname in INDIVIDUAL:
+        values = np.full(len(participants), np.nan)
+        values[positions] = getattr(est, varname)
+        setattr(est, varname, values.tolist())
+    return est, None
+
+
+# Fits K independent data sets in one JAGS model, so that compilation and
+# adaptation are paid once.  Returns a list of (estimate, samples) pairs.
+def estimate_batch(dataObjects, priorObject, criterion = 'drift', silent = False, engine = 'jags',
+                   adaptive = False, monitored = None, dtype = np.float64, rngs = None):
+    # rngs: the generator of each data set's replicate, or None
+    rngs = [None] * len(dataObjects) if rngs is None else rngs
+    if engine != 'jags' or len(dataObjects) == 1 or not (criterion is None or isinstance(criterion, str)):
+        return [estimate(d, priorObject, criterion, silent, engine, adaptive, monitored, dtype, rng)
+                for d, rng in zip(dataObjects, rngs)]
+
+    with timing.timer('to_jags'):
+        blocks = [d.to_jags() for d in dataObjects]
+    data   = {key: sum((block[key] for block, _ in blocks), []) for key in ['nTrials', 'meanRT', 'varRT', 'correct', 'X']}
+    sizes  = [len(block['nTrials']) for block, _ in blocks]
+    data['block'] = np.repeat(np.arange(1, len(blocks) + 1), sizes).tolist()
+    data['B']     = len(blocks)
+
+    # Closed-form initial values of the individual parameters of each block,
+    # jittered by the block's own generator.  The chains of the batch share
+    # their JAGS seeds, which are drawn from a seed of every block
+    inits = [ez.init(block, priorObject, criterion) for block, _ in blocks if len(block['nTrials'])]
+    for i, rng in zip(inits, [rng for (block, _), rng in zip(blocks, rngs) if len(block['nTrials'])]):
+        i["drift"] = np.clip(i["drift"] + (np.random if rng is None else rng).normal(0, 0.1, len(i["drift"])), -2.99, 2.99)
+    init  = {varname: np.concatenate([i[varname] for i in inits]) for varname in INDIVIDUAL}
+    seeds = [rng.integers(2**63) for rng in rngs if rng is not None]
+    init  = seeded_init(init, np.random.default_rng(seeds) if len(seeds) == len(rngs) else None)
+
+    try:
+        with timing.timer('compile'):
+            model = pyjags.Model(
+                    progress_bar = False,
+                    code    = ez_jags_code(priorObject, criterion, 'batch'),
+                    data    = data,
+                    init    = init,
+                    adapt   = 100,
+                    chains  = 4,
+                    threads = THREADS['jags'])
+    except Exception as e:
+        if not silent:
+            print(f"Batched model failed, fitting data sets separately: {e}")
+        return [estimate(d, priorObject, criterion, silent, engine, adaptive, monitored, dtype, rng)
+                for d, rng in zip(dataObjects, rngs)]
+
+    if adaptive:
+        samples = sample_adaptive(model, adaptive if isinstance(adaptive, dict) else None, silent, monitored)
+    else:
+        with timing.timer('sample'):
+            samples = model.sample(DRAWS[engine], vars = monitored_variables(monitored))
+        timing.count('draws', DRAWS[engine])
+
+    results = []
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    for k, (d, (_, valid_indices)) in enumerate(zip(dataObjects, blocks)):
+        if sizes[k] == 0:
+            results.append((None, None))
+            continue
+        block = {varname: samples[varname][k:k+1] for varname in HYPERPARAMETERS}
+        for varname in INDIVIDUAL:
+            if varname in samples:
+                block[varname] = samples[varname][offsets[k]:offsets[k+1]]
+        if 'diagnostics' in samples:
+            block['diagnostics'] = {varname: {stat: value[k] for stat, value in samples['diagnostics'][varname].items()}
+                                    for varname in HYPERPARAMETERS}
+            block['diagnostics'].update({"draws":     samples['diagnostics']["draws"],
+                                         "converged": samples['diagnostics']["converged"]})
+        results.append(_collect(block, valid_indices, d.participants(), dtype))
+    return results
+
+# Fits the same data with two engines and compares the hyperparameter
+# posteriors: means, and their difference in pooled posterior standard deviations
+def compare_engines(dataObject, priorObject, criterion = 'drift', engines = ('jags', 'numpy'), silent = False):
+    _, samples_a = estimate(dataObject, priorObject, criterion, True, engines[0])
+    _, samples_b = estimate(dataObject, priorObject, criterion, True, engines[1])
+    comparison   = compare_samples(samples_a, samples_b)
+    if comparison is None:
+        return None
+
+    if not silent:
+        print(f"  {'':<12}{engines[0]:>10}{engines[1]:>10}{'diff/sd':>10}")
+        for varname, (mean_a, mean_b, z) in comparison.items():
+            print(f"  {varname:<12}{mean_a:>10.4f}{mean_b:>10.4f}{z:>10.3f}")
+
+    return comparison
 
+def compare_samples(samples_a, samples_b):
+    # (mean a, mean b, difference in pooled standard deviations) of every
+    # hyperparameter of two fits of the same data; None if either failed
+    if samples_a is None or samples_b is None:
+        return None
+    comparison = {}
+    for varname in HYPERPARAMETERS:
+        a, b = np.ravel(samples_a[varname]), np.ravel(samples_b[varname])
+        sdev = np.sqrt((np.var(a) + np.var(b)) / 2)
+        comparison[varname] = (np.mean(a), np.mean(b), (np.mean(a) - np.mean(b)) / sdev if sdev > 0 else 0.0)
+    return comparison
@@ -1,52 +1,166 @@
 # This script creates production figures for the EZBHDDM simulation studies
 
-import numpy as np
-import pickle
+#   First every ../cache/<criterion>_<design>.pkl grid is reduced to a small
+#   summary in ../cache/summaries/, then the figures are rendered from the
+#   summaries by parallel worker processes.  ../figures/manifest.json records
+#   the content hash of the inputs of every summary and figure, and only those
+#   whose inputs changed are rebuilt.  Use --force to rebuild everything.
+#
+#   With --nested, the grids of nested simulations (para.py --nested) are
+#   plotted instead, from ../cache/<criterion>_<design>_nested.pkl into
+#   figures named <design>_nested_<criterion>_*.eps.  With --joint, those of
+#   joint runs (para.py --joint) are plotted, from <criterion>_<design>_joint.pkl
+#   (or _joint_nested.pkl with --nested as well).
+
+import concurrent.futures
+import hashlib
+import json
 import os
-import matplotlib.pyplot as plt
+import pickle
+import sys
+import numpy as np
 
-os.chdir('/srv/host/src/')
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 
 import simulation
 from plots import *
 
-parameter = "betaweight"
+HERE      = os.path.dirname(os.path.abspath(__file__))
+CACHE     = os.path.join(HERE, '..', 'cache')
+SUMMARIES = os.path.join(CACHE, 'summaries')
+FIGURES   = os.path.join(HERE, '..', 'figures')
+MANIFEST  = os.path.join(FIGURES, 'manifest.json')
+
+DESIGNS    = ['ttest', 'linreg']
+CRITERIA   = ['nondt', 'drift', 'bound']
+LABELS     = [("betaweight", r"$\beta$"),
+              ("bound_mean", r"$\mu_\alpha$"),
+              ("drift_mean", r"$\mu_\nu$"),
+              ("nondt_mean", r"$\mu_\tau$")]
+
+def content_hash(paths):
+    # Hash of the contents of files and of all files in directories
+    h = hashlib.sha256()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else \
+                sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for name in files:
+            h.update(os.path.relpath(name, path).encode())
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+    return h.hexdigest()
+
+def summary_hash(path):
+    # Hash of the arrays in a summary, so that figures are not rebuilt when a
+    # summary is recomputed with the same contents
+    h = hashlib.sha256()
+    with np.load(path) as f:
+        for key in sorted(f.files):
+            h.update(key.encode())
+            h.update(np.ascontiguousarray(f[key]).tobytes())
+    return h.hexdigest()
+
+def results_path(design, criterion, variant = ''):
+    # Directory of the results of the cells; joint runs keep those of every
+    # criterion under joint_<design>
+    if variant.startswith('_joint'):
+        return os.path.join(CACHE, f"joint_{design}{variant[len('_joint'):]}", criterion)
+    return os.path.join(CACHE, f'{criterion}_{design}{variant}')
+
+def summarize(design, criterion, variant = ''):
+    # The grid pickle only holds the paths of the results of its cells
+    with open(os.path.join(CACHE, f'{criterion}_{design}{variant}.pkl'), 'rb') as f:
+        s = pickle.load(f)
+    return Hddm_Grid_Summary.from_grid(s).save(os.path.join(SUMMARIES, f'{criterion}_{design}{variant}.npz'))
+
+def biasfigure(design, criterion, parameter, variant = ''):
+    s = Hddm_Grid_Summary.open(os.path.join(SUMMARIES, f'{criterion}_{design}{variant}.npz'))
+    fig, axes = plt.subplots(s.shape[0], s.shape[1], figsize=(5,5))
+
+    for i in range(s.shape[0]):
+        for j in range(s.shape[1]):
+            biasplot(s, parameter, i, j, axes[i,j])
+
+    plt.savefig(os.path.join(FIGURES, f'{design}{variant}_{criterion}_{parameter}.eps'), format='eps', bbox_inches='tight', transparent=True)
+    plt.close()
+
+def rmsefigure(design, criterion, variant = ''):
+    s = Hddm_Grid_Summary.open(os.path.join(SUMMARIES, f'{criterion}_{design}{variant}.npz'))
+    fig, axes = plt.subplots(2, 2, figsize=(5, 5))
+    fig.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=None, hspace=0.5)
+
+    for i, par in enumerate(LABELS):
+        rmseplot(s, par[0], axes[i // 2, i % 2], title=par[1], axlbl=i%2)
 
-for design in ['ttest','linreg']:
-    for criterion in ['nondt','drift','bound']:
+    axes[1,1].legend(loc="upper right", prop={'size': 8})
 
-        print(f'{criterion}_{design}.pkl ...')
+    plt.savefig(os.path.join(FIGURES, f'{design}{variant}_{criterion}_rmse.eps'), format='eps', bbox_inches='tight', transparent=True)
+    plt.close()
 
-        s = pickle.load(open(f'../cache/{criterion}_{design}.pkl', 'rb'))
+def build(force = False, max_workers = None, variant = ''):
+    # variant: '' for the grids of independent draws, '_nested' for nested
+    # ones, '_joint' and '_joint_nested' for those of joint runs
+    os.makedirs(SUMMARIES, exist_ok=True)
+    manifest = {}
+    if os.path.exists(MANIFEST) and not force:
+        with open(MANIFEST) as f:
+            manifest = json.load(f)
 
-        # Bias plots
-        for i, par in enumerate([("betaweight",r"$\beta$"),
-                                 ("bound_mean",r"$\mu_\alpha$"),
-                                 ("drift_mean",r"$\mu_\nu$"),
-                                 ("nondt_mean",r"$\mu_\tau$")]):
-            fig, axes = plt.subplots(s.shape[0], s.shape[1], figsize=(5,5))
+    # Summaries, keyed by the hash of the grid pickle and the cell results
+    tasks = []
+    for design in DESIGNS:
+        for criterion in CRITERIA:
+            name   = f'{criterion}_{design}{variant}'
+            inputs = [os.path.join(CACHE, name + '.pkl'), results_path(design, criterion, variant)]
+            if not os.path.exists(inputs[0]):
+                print(f'{name}.pkl is missing; skipping.')
+                continue
+            key = content_hash([path for path in inputs if os.path.exists(path)])
+            if manifest.get(name + '.npz') != key or not os.path.exists(os.path.join(SUMMARIES, name + '.npz')):
+                tasks.append((name + '.npz', key, summarize, (design, criterion, variant)))
 
-            for i in range(s.shape[0]):
-                for j in range(s.shape[1]):
-                    print(f'Bias plot: {par[0]}[{i},{j}]')
-                    biasplot(s, par[0], i, j, axes[i,j])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        manifest.update(_run(executor, tasks))
 
-            plt.savefig(f'../figures/{design}_{criterion}_{par[0]}.eps', format='eps', bbox_inches='tight', transparent=True)
-            plt.close()
+        # Figures, keyed by the hash of their summary
+        tasks = []
+        for design in DESIGNS:
+            for criterion in CRITERIA:
+                summary = os.path.join(SUMMARIES, f'{criterion}_{design}{variant}.npz')
+                if not os.path.exists(summary):
+                    continue
+                key     = summary_hash(summary)
+                figures = [(f'{design}{variant}_{criterion}_{par[0]}.eps', biasfigure, (design, criterion, par[0], variant))
+                           for par in LABELS]
+                figures.append((f'{design}{variant}_{criterion}_rmse.eps', rmsefigure, (design, criterion, variant)))
+                for name, function, args in figures:
+                    if manifest.get(name) != key or not os.path.exists(os.path.join(FIGURES, name)):
+                        tasks.append((name, key, function, args))
+        manifest.update(_run(executor, tasks))
 
-        # RMSE calibration plots
-        
-        fig, axes = plt.subplots(2, 2, figsize=(5, 5))
-        fig.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=None, hspace=0.5)
+    with open(MANIFEST + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(MANIFEST + '.tmp', MANIFEST)
+    return manifest
 
-        for i, par in enumerate([("betaweight",r"$\beta$"),
-                                 ("bound_mean",r"$\mu_\alpha$"),
-                                 ("drift_mean",r"$\mu_\nu$"),
-                                 ("nondt_mean",r"$\mu_\tau$")]):
-            print(f'RMSE plot {par}')
-            rmseplot(s, par[0], axes[i // 2, i % 2], title=par[1], axlbl=i%2)
+def _run(executor, tasks):
+    # Returns the manifest entries of the tasks that succeeded
+    futures = {executor.submit(function, *args): (name, key) for name, key, function, args in tasks}
+    done    = {}
+    for future in concurrent.futures.as_completed(futures):
+        name, key = futures[future]
+        try:
+            future.result()
+            done[name] = key
+            print(f'{name} ... done')
+        except Exception as exc:
+            print(f'{name} ... failed: {exc}')
+    return done
 
-        axes[1,1].legend(loc="upper right", prop={'size': 8})
 
-        plt.savefig(f'../figures/{design}_{criterion}_rmse.eps', format='eps', bbox_inches='tight', transparent=True)
-        plt.close()
+if __name__ == '__main__':
+    variant = ('_joint' if '--joint' in sys.argv else '') + ('_nested' if '--nested' in sys.argv else '')
+    build(force = '--force' in sys.argv, variant = variant)
@@ -0,0 +1,246 @@
+# Native NumPy sampler for the base EZHBDDM
+
+#   Metropolis-within-Gibbs, vectorized across participants and chains.  Each
+#   participant's (bound, drift, nondt) is updated as one block with an adapted
+#   random walk; the means, the standard deviations and the betaweight are
+#   then updated in turn, all three parameter groups at once.  Returns samples
+#   shaped like pyjags output: (1, draws, chains) for scalars and
+#   (participants, draws, chains) for the individual parameters.
+
+import numpy as np
+from scipy.special import log_ndtr
+
+import parameter_set
+from wdm import ez_moments
+
+INDIVIDUAL = ['bound', 'drift', 'nondt']
+LOWER      = np.array([0.10, -3.00, 0.05])
+UPPER      = np.array([3.00,  3.00, np.inf])
+
+def _log_mass(mu, sd, lo, hi):
+    # log(Phi((hi-mu)/sd) - Phi((lo-mu)/sd)), evaluated in the lower tail to
+    # avoid cancellation
+    a = (lo - mu) / sd
+    b = (hi - mu) / sd
+    flip = a > 0
+    a, b = np.where(flip, -b, a), np.where(flip, -a, b)
+    log_b = log_ndtr(b)
+    return log_b + np.log1p(-np.exp(log_ndtr(a) - log_b))
+
+def loglik(x, data):
+    # Log likelihood of the summary statistics of each participant; x has
+    # (bound, drift, nondt) in its last axis
+    a, v, t = x[..., 0], x[..., 1], x[..., 2]
+    n, c, m, s = data['nTrials'], data['correct'], data['meanRT'], data['varRT']
+    _, MRT, VRT = ez_moments(a, v, t)
+    av = a * v
+    return (- c * np.logaddexp(0, -av) - (n - c) * np.logaddexp(0, av)
+            - 1.5 * np.log(VRT)
+            - 0.25 * (c - 1) * (s - VRT)**2 / VRT**2
+            - 0.5 * c * (m - MRT)**2 / VRT)
+
+class _Model:
+    # Constants of the hierarchical part of the model.  Hyperparameters are
+    # held as mean, sdev and betaweight arrays of shape (3, chains); only the
+    # betaweights of the criteria enter the model
+    def __init__(self, prior, criterion, X):
+        self.X        = X
+        self.criteria = np.array([name in parameter_set.criteria(criterion) for name in INDIVIDUAL])
+        self.m0       = np.array([getattr(prior, name + '_mean_mean') for name in INDIVIDUAL])
+        self.s0       = np.array([getattr(prior, name + '_mean_sdev') for name in INDIVIDUAL])
+        self.sd_lower = np.array([getattr(prior, name + '_sdev_lower') for name in INDIVIDUAL])
+        self.sd_upper = np.array([getattr(prior, name + '_sdev_upper') for name in INDIVIDUAL])
+        self.bw_lower = prior.betaweight_lower
+        self.bw_upper = prior.betaweight_upper
+
+    def location(self, mean, bw):
+        return mean[:, :, None] + self.criteria[:, None, None] * bw[:, :, None] * self.X
+
+    def group_logpost(self, x, mean, sdev, bw):
+        # Log density of each group's hyperparameters given the individual
+        # parameters, including the truncation of the individual distributions
+        mu = self.location(mean, bw)
+        sd = sdev[:, :, None]
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            z  = (np.moveaxis(x, -1, 0) - mu) / sd
+            lp = np.sum(-0.5 * z**2 - np.log(sd) - _log_mass(mu, sd, LOWER[:, None, None], UPPER[:, None, None]), axis=2)
+        lp += -0.5 * ((mean - self.m0[:, None]) / self.s0[:, None])**2
+
+        ok  = (mean > LOWER[:, None]) & (mean < UPPER[:, None])
+        ok &= (sdev > self.sd_lower[:, None]) & (sdev < self.sd_upper[:, None])
+        ok &= ~self.criteria[:, None] | ((bw > self.bw_lower) & (bw < self.bw_upper))
+        return np.where(ok, lp, -np.inf)
+
+def initial_state(data, prior, chains, init = None, rng = np.random):
+    init = {} if init is None else init
+    P    = len(data['meanRT'])
+
+    hyper = {
+        'bound_mean': np.clip(prior.bound_mean_mean, 0.2, 2.9),
+        'drift_mean': np.clip(prior.drift_mean_mean, -2.9, 2.9),
+        'nondt_mean': max(prior.nondt_mean_mean, 0.06),
+        'bound_sdev': (prior.bound_sdev_lower + prior.bound_sdev_upper) / 2,
+        'drift_sdev': (prior.drift_sdev_lower + prior.drift_sdev_upper) / 2,
+        'nondt_sdev': (prior.nondt_sdev_lower + prior.nondt_sdev_upper) / 2,
+        'betaweight': (prior.betaweight_lower + prior.betaweight_upper) / 2,
+    }
+    hyper = {name: np.broadcast_to(np.asarray(init.get(name, value), dtype=float), (chains,)).copy()
+             for name, value in hyper.items()}
+
+    x = np.empty((chains, P, 3))
+    x[..., 0] = hyper['bound_mean'][:, None]
+    x[..., 1] = rng.normal(0, 0.1, (chains, P))
+    x[..., 2] = np.maximum(np.minimum(hyper['nondt_mean'][:, None], 0.5 * np.asarray(data['meanRT'])), 0.06)
+    for k, name in enumerate(INDIVIDUAL):
+        if name in init:
+            x[..., k] = np.broadcast_to(np.asarray(init[name], dtype=float), (chains, P))
+
+    mean = np.array([hyper[name + '_mean'] for name in INDIVIDUAL])
+    sdev = np.array([hyper[name + '_sdev'] for name in INDIVIDUAL])
+    bw   = np.array([np.broadcast_to(np.asarray(init.get('betaweight_' + name, hyper['betaweight']), dtype=float), (chains,))
+                     for name in INDIVIDUAL])
+    return x, mean, sdev, bw
+
+class Model:
+    # Mirrors the part of the pyjags.Model interface that estimate() uses:
+    # the constructor adapts, sample() draws and may be called repeatedly
+    def __init__(self, data, prior, criterion = 'drift', init = None, chains = 4, adapt = 1000, rng = None):
+        self.rng    = np.random if rng is None else rng
+        self.data   = {key: np.asarray(data[key], dtype=float) for key in ['nTrials', 'correct', 'meanRT', 'varRT', 'X']}
+        self.P      = self.data['X'].size
+        self.chains = chains
+        if self.P == 0:
+            raise ValueError("No participants with usable data.")
+
+        self.prior     = prior
+        self.criterion = criterion
+        self.model     = _Model(prior, criterion, self.data['X'])
+        self.x, self.mean, self.sdev, self.bw = initial_state(self.data, prior, chains, init, self.rng)
+        self.ll = loglik(self.x, self.data)
+
+        # Proposal scales: per participant a Cholesky factor times an adapted
+        # multiplier, per hyperparameter and chain a log step size
+        self.chol     = np.zeros((self.P, 3, 3))
+        self.chol[:, [0, 1, 2], [0, 1, 2]] = [0.05, 0.10, 0.02]
+        self.log_lam  = np.zeros(self.P)
+        self.log_mean = np.full((3, chains), np.log(0.05))
+        self.log_sdev = np.full((3, chains), np.log(0.02))
+        self.log_bw   = np.full((3, chains), np.log(0.05))
+        self.adapt(adapt)
+
+    def tuning(self):
+        # The adapted proposal scales, for reset()
+        return tuple(np.copy(value) for value in [self.chol, self.log_lam, self.log_mean, self.log_sdev, self.log_bw])
+
+    def reset(self, data, tuning, init = None, rng = None, adapt = 200):
+        # New data with the same number of participants, for the same prior
+        # and criterion.  The chains restart from init with the proposal
+        # scales of tuning, so the fit depends on data, tuning, init and rng
+        # only; a much shorter adaptation than a new model's then suffices.
+        data = {key: np.asarray(data[key], dtype=float) for key in ['nTrials', 'correct', 'meanRT', 'varRT', 'X']}
+        if data['X'].size != self.P:
+            raise ValueError(f"Model has {self.P} participants, data has {data['X'].size}.")
+        self.rng     = np.random if rng is None else rng
+        self.data    = data
+        self.model.X = data['X']
+        self.x, self.mean, self.sdev, self.bw = initial_state(self.data, self.prior, self.chains, init, self.rng)
+        self.ll = loglik(self.x, self.data)
+
+        self.chol, self.log_lam, self.log_mean, self.log_sdev, self.log_bw = [np.copy(value) for value in tuning]
+        self.adapt(adapt)
+        return self
+
+    def adapt(self, iterations):
+        # Robbins-Monro adaptation of all step sizes; halfway, the participant
+        # proposals take the covariance of the preceding quarter of the draws
+        history = []
+        for it in range(iterations):
+            self._step(1 / np.sqrt(it + 1))
+            if iterations // 4 <= it < iterations // 2:
+                history.append(self.x)
+            if it == iterations // 2 and history:
+                h   = np.concatenate(history, axis=0)
+                d   = h - h.mean(axis=0)
+                cov = np.einsum('npi,npj->pij', d, d) / max(h.shape[0] - 1, 1)
+                self.chol    = np.linalg.cholesky(2.38**2 / 3 * cov + 1e-10 * np.eye(3))
+                self.log_lam = np.zeros(self.P)
+                history      = []
+
+    def sample(self, iterations, vars = None):
+        out_mean = np.empty((3, iterations, self.chains))
+        out_sdev = np.empty((3, iterations, self.chains))
+        out_bw   = np.empty((3, iterations, self.chains))
+        out_x    = np.empty((3, self.P, iterations, self.chains))
+
+        for it in range(iterations):
+            self._step(0)
+            out_mean[:, it] = self.mean
+            out_sdev[:, it] = self.sdev
+            out_bw[:, it]   = self.bw
+            out_x[:, :, it] = np.transpose(self.x, (2, 1, 0))
+
+        # One betaweight, or one per criterion as named by parameter_set.hyperparameters
+        if self.criterion is None or isinstance(self.criterion, str):
+            k       = INDIVIDUAL.index(self.criterion) if self.criterion in INDIVIDUAL else 0
+            samples = {'betaweight': out_bw[k][None]}
+        else:
+            samples = {'betaweight_' + name: out_bw[INDIVIDUAL.index(name)][None] for name in self.criterion}
+        for k, name in enumerate(INDIVIDUAL):
+            samples[name + '_mean'] = out_mean[k][None]
+            samples[name + '_sdev'] = out_sdev[k][None]
+            samples[name]           = out_x[k]
+        if vars is not None:
+            samples = {name: samples[name] for name in vars}
+        return samples
+
+    def _step(self, gamma):
+        rng, model, data = self.rng, self.model, self.data
+        x, mean, sdev, bw = self.x, self.mean, self.sdev, self.bw
+
+        # Individual parameters, one block per participant
+        mu     = np.moveaxis(model.location(mean, bw), 0, -1)
+        sd     = sdev.T[:, None, :]
+        x_new  = x + np.exp(self.log_lam)[None, :, None] * np.einsum('pij,cpj->cpi', self.chol, rng.normal(size=x.shape))
+        ok     = np.all((x_new > LOWER) & (x_new < UPPER), axis=-1)
+        x_new  = np.where(ok[..., None], x_new, x)
+        ll_new = np.where(ok, loglik(x_new, data), -np.inf)
+        log_r  = ll_new - self.ll - 0.5 * np.sum(((x_new - mu) / sd)**2 - ((x - mu) / sd)**2, axis=-1)
+        accept = np.log(rng.random(ok.shape)) < log_r
+        x       = np.where(accept[..., None], x_new, x)
+        self.ll = np.where(accept, ll_new, self.ll)
+        self.log_lam += gamma * (accept.mean(axis=0) - 0.3)
+
+        # Hyperparameters: means, standard deviations, betaweight
+        lp = model.group_logpost(x, mean, sdev, bw)
+
+        prop   = mean + np.exp(self.log_mean) * rng.normal(size=mean.shape)
+        lp_new = model.group_logpost(x, prop, sdev, bw)
+        accept = np.log(rng.random(mean.shape)) < lp_new - lp
+        mean   = np.where(accept, prop, mean)
+        lp     = np.where(accept, lp_new, lp)
+        self.log_mean += gamma * (accept - 0.44)
+
+        prop   = sdev + np.exp(self.log_sdev) * rng.normal(size=sdev.shape)
+        lp_new = model.group_logpost(x, mean, prop, bw)
+        accept = np.log(rng.random(sdev.shape)) < lp_new - lp
+        sdev   = np.where(accept, prop, sdev)
+        lp     = np.where(accept, lp_new, lp)
+        self.log_sdev += gamma * (accept - 0.44)
+
+        # Betaweights of the criteria, each against its own group; the others
+        # are not in the model and are drawn from their prior
+        if model.criteria.any():
+            prop   = bw + np.exp(self.log_bw) * rng.normal(size=bw.shape)
+            lp_new = model.group_logpost(x, mean, sdev, prop)
+            accept = model.criteria[:, None] & (np.log(rng.random(bw.shape)) < lp_new - lp)
+            bw     = np.where(accept, prop, bw)
+            self.log_bw += gamma * model.criteria[:, None] * (accept - 0.44)
+        if not model.criteria.all():
+            bw = np.where(model.criteria[:, None], bw,
+                          rng.uniform(self.prior.betaweight_lower, self.prior.betaweight_upper, bw.shape))
+
+        self.x, self.mean, self.sdev, self.bw = x, mean, sdev, bw
+
+def sample(data, prior, criterion = 'drift', chains = 4, warmup = 1000, draws = 1000,
+           init = None, rng = None):
+    return Model(data, prior, criterion, init, chains, warmup, rng).sample(draws)
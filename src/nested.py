@@ -0,0 +1,185 @@
+# Nested simulation of a P x T grid with common random numbers
+
+#   Every replicate is simulated once, at the largest P and T of the grid,
+#   and cell (p, t) is given the first p participants with their first t
+#   trials.  The summary statistics of all trial prefixes are accumulated in
+#   one pass over the trials (see data_set.prefix_summaries).  The cells of a
+#   replicate thus share their data, so that differences between cells show
+#   the effect of P and T rather than that of independent draws, and the
+#   simulation is done once per replicate instead of once per cell.
+#
+#   The predictors must be nested: the predictor of a cell must be the first
+#   p values of that of the largest cell (as np.arange(p) % 2 is, and
+#   np.arange(p) / p is not).  Every cell is fitted with its own replicate
+#   generator, and cells that already have a replicate, e.g. after resuming
+#   from their checkpoints, skip it.  As in scheduler.run, a failed chunk
+#   stops the grid at its first replicate, and run reports it with the
+#   finished replicates dropped behind it: to `failures` if given, so that a
+#   study can carry on, and as an exception otherwise.
+
+import concurrent.futures
+import copy
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+
+import parameter_set
+import scheduler
+import timing
+from data_set import Hddm_Data, prefix_summaries
+from wdm import wdmrnd_batch
+
+class Hddm_Nested_Grid:
+    def __init__(self, cells):
+        self.cells   = cells
+        designs      = list(np.ravel(cells))
+        self.P       = max(design.n_Participants for design in designs)
+        self.T       = max(design.n_TrialsPerPerson for design in designs)
+        self.largest = next(design for design in designs if design.n_Participants == self.P)
+        predictor    = np.asarray(self.largest.predictor)
+
+        for design in designs:
+            if design.seed is None or design.seed != self.largest.seed:
+                raise ValueError("The cells of a nested grid need the same seed.")
+            if (design.name, str(design.criterion), str(design.prior)) != \
+               (self.largest.name, str(self.largest.criterion), str(self.largest.prior)):
+                raise ValueError("The cells of a nested grid need the same name, criterion and prior.")
+            if design.sampling != 'trials':
+                raise ValueError("Nested grids are simulated trial by trial; use sampling = 'trials'.")
+            if not np.array_equal(np.asarray(design.predictor), predictor[:design.n_Participants]):
+                raise ValueError(f"The predictor of P={design.n_Participants} is not a prefix of that of P={self.P}.")
+
+        self.replicate = min(self._next(design) for design in designs)   # next replicate to simulate
+        self.first     = self.replicate
+
+    @staticmethod
+    def _next(design):
+        return design.results.offset + len(design.results)
+
+    def replicate_rng(self, replicate):
+        # Keyed like Hddm_Design.replicate_rng, with P = T = 0 for the grid
+        key = [zlib.crc32(str(self.largest.name).encode()), zlib.crc32(str(self.largest.criterion).encode()),
+               0, 0, replicate]
+        return np.random.default_rng(np.random.SeedSequence(self.largest.seed, spawn_key = key))
+
+    def sample(self, replicate):
+        # Parameters of P participants and the summaries of every trial prefix
+        rng        = self.replicate_rng(replicate)
+        parameters = parameter_set.Hddm_Parameter_Set.random(self.largest.prior, self.P, self.largest.criterion,
+                                                             self.largest.predictor, rng)
+        with timing.timer('wdmrnd'):
+            rt, accuracy, _ = wdmrnd_batch(parameters.bound, parameters.drift, parameters.nondt, self.T, rng = rng)
+        prefixes = {design.n_TrialsPerPerson for design in np.ravel(self.cells)}
+        with timing.timer('prefix_summaries'):
+            summaries = prefix_summaries(rt, accuracy, self.T, prefixes)
+        return parameters, summaries
+
+    def run(self, iterations = 1, showProgress = True, checkpoint = False):
+        designs = list(np.ravel(self.cells))
+        for k in range(iterations):
+            replicate = self.replicate + k
+            with timing.recording(self.largest.timings), timing.timer('simulate'):
+                parameters, summaries = self.sample(replicate)
+
+            for design in designs:
+                if self._next(design) != replicate:
+                    continue
+                p = design.n_Participants
+                with timing.recording(design.timings):
+                    design.parameter_set = copy.copy(parameters)
+                    for varname in parameter_set.INDIVIDUAL:
+                        setattr(design.parameter_set, varname, getattr(parameters, varname)[:p])
+                    design.data = Hddm_Data(n_TrialsPerPerson = design.n_TrialsPerPerson, X = design.predictor,
+                                            summaries = {key: value[:p] for key, value in summaries[design.n_TrialsPerPerson].items()})
+                    design.rng  = design.replicate_rng(replicate)
+                    start_time  = time.time()
+                    with timing.timer('estimate'):
+                        design.estimate_parameters(silent = True)
+                    design.store(time.time() - start_time, replicate)
+
+            if showProgress:
+                sys.stdout.write(f"\rReplicate {replicate + 1} of {self.replicate + iterations}")
+                sys.stdout.flush()
+        if showProgress:
+            sys.stdout.write(f"\n")
+            sys.stdout.flush()
+
+        self.replicate += iterations
+        self.finish(checkpoint)
+        return self
+
+    def finish(self, checkpoint = False):
+        for design in np.ravel(self.cells):
+            design.results.flush()
+            if len(design.results):
+                design.compute_statistics()
+            if checkpoint and design.results.path is not None:
+                design.checkpoint(design.results.directory + '.pkl')
+
+    def fork(self, start):
+        # Copy without results for replicates from `start` on; cells that are
+        # further already start where they are
+        cells = np.empty(np.shape(self.cells), dtype=object)
+        for index, design in np.ndenumerate(np.asarray(self.cells, dtype=object)):
+            cells[index] = design.fork(max(start, self._next(design)))
+        other = copy.copy(self)
+        other.cells     = cells
+        other.largest   = cells.ravel()[list(np.ravel(self.cells)).index(self.largest)]
+        other.replicate = start
+        other.first     = start
+        return other
+
+    def merge(self, other, rows = None):
+        # rows: results of each cell if the forks do not hold them
+        if other.first != self.replicate:
+            raise ValueError(f"Replicates from {other.first} cannot follow {self.replicate} replicates.")
+        rows = [None] * len(np.ravel(self.cells)) if rows is None else rows
+        for design, fork, cell_rows in zip(np.ravel(self.cells), np.ravel(other.cells), rows):
+            design.merge(fork, cell_rows)
+        self.replicate = other.replicate
+        return self
+
+def _run_chunk(grid, n, slabs):
+    grid.run(n, showProgress = False)
+    for design, slab in zip(np.ravel(grid.cells), slabs):
+        scheduler.deposit(design, slab)
+    return grid
+
+def run(grid, replicates, chunksize = 25, cores = None, checkpoint = True, showProgress = True, scratch = None,
+        failures = None):
+    # Runs the grid up to `replicates` replicates in chunks over processes, as
+    # scheduler.run does for independent designs, with the rows of every cell
+    # returned through slabs
+    starts  = range(grid.replicate, replicates, chunksize)
+    pending = {}
+    failed  = []
+    designs = list(np.ravel(grid.cells))
+    with tempfile.TemporaryDirectory(dir = scratch) as root, \
+         concurrent.futures.ProcessPoolExecutor(max_workers = scheduler.workers(designs, cores)) as executor:
+        slabs   = scheduler.allocate(designs, replicates, root)
+        futures = {executor.submit(_run_chunk, grid.fork(start), min(chunksize, replicates - start), slabs): start
+                   for start in starts}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                pending[futures[future]] = future.result()
+            except Exception as exc:
+                print(f'Chunk {futures[future]} of the grid encountered an exception: {exc}')
+                failed.append(futures[future])
+                continue
+            while grid.replicate in pending:
+                other = pending.pop(grid.replicate)
+                grid.merge(other, [scheduler.rows(slab, fork) for slab, fork in zip(slabs, np.ravel(other.cells))])
+                grid.finish(checkpoint)
+            if showProgress:
+                sys.stdout.write(f"\rReplicates: {grid.replicate} of {replicates}")
+                sys.stdout.flush()
+
+        scheduler.release(designs)
+    if showProgress:
+        sys.stdout.write(f"\n")
+    grid.finish(checkpoint)
+    scheduler.incomplete([failed], [sum(other.replicate - other.first for other in pending.values())], ['the grid'],
+                          failures = failures)
+    return grid
@@ -1,96 +1,164 @@
 # Runs the extensive EZBHDDM simulation studies
 
 #   Takes a while to run.  Check out main.py first.
-#   There are much better ways to parallelize this if needed.
+#
+#   Replicates are run in chunks by scheduler.run, largest cells first, with
+#   as many processes as the cores allow given the JAGS threads per fit.
+#   Every cell of the grid stores its results in ../cache/<criterion>_<design>/
+#   and is checkpointed there as chunks come back.  With RESUME, an
+#   interrupted run picks up at the last checkpoint of each cell and only the
+#   missing replicates are simulated; set RESUME = False to start over.
+#   A grid with failed chunks is left at its checkpoints and not saved; the
+#   study carries on with the other grids and reports the failures at the
+#   end, and a rerun with RESUME completes it.
+#
+#   To spread the work over several hosts that share the file system:
+#     python para.py submit                 writes the tasks to ../cache/queue
+#     python work_queue.py ../cache/queue   on each host, as often as wanted
+#     python para.py merge                  collects the results into ../cache
+#
+#   With --joint, each design is run once for all criteria: every data set has
+#   an effect on each parameter, the bBDN model estimates one betaweight per
+#   criterion, and the results are split into per-criterion grids.  Being
+#   another experiment, these are saved as <criterion>_<design>_joint.pkl (or
+#   _joint_nested.pkl), not over the single-criterion grids; python
+#   figures.py --joint plots them.
+#
+#   With --nested, the cells of the ttest grids share their data: each
+#   replicate is simulated once at the largest P and T, and smaller cells take
+#   the first participants and trials (see nested.py).  The results are kept
+#   in ../cache/<criterion>_ttest_nested/ and <criterion>_ttest_nested.pkl,
+#   next to the grids of independent draws; python figures.py --nested plots
+#   them.  The linreg predictor i/p is not nested, so linreg grids are always
+#   simulated per cell.
+#
+#   Data sets and fits are also kept in ../cache/store (see cache.py), so that
+#   after changing e.g. the prior or the engine, only the fits are redone, and
+#   with RESUME = False nothing whose inputs are unchanged is recomputed.
 
 import numpy as np
 import importlib
 import simulation
-import concurrent.futures
+import scheduler
+import work_queue
+import nested
+from cache import Hddm_Cache
 import pickle
-import os, datetime
+import os, sys, datetime, shutil
 
 
 P = np.array([20, 40, 80, 160, 320])
 T = np.array([20, 40, 80, 160, 320])
 
-
-# Run ttest design
-
-for criterion in ['drift', 'nondt', 'bound']:
-
-    print(f"[{datetime.datetime.now().isoformat()}]  Design: ttest     Criterion: {criterion}")
-
-    s = np.empty((len(P), len(T)), dtype=object)
-
-    # Initialize Hddm_Design objects
-    for r, p in enumerate(P):
-        for c, t in enumerate(T):
-            s[r, c] = simulation.Hddm_Design(p, t, np.arange(0, p) % 2, criterion)
-
-    # Function to save the matrix to disk
-    def save_to_disk(matrix, filename=f'../cache/{criterion}_ttest.pkl'):
-        with open(filename, 'wb') as f:
-            pickle.dump(matrix, f)
-
-    # Function to run the simulation and return the updated object
-    def run_simulation(simulation_object):
-        try:
-            simulation_object.run(1000)
-        except Exception as exc:
-            print(f'Simulation run encountered an exception: {exc}')
-        return simulation_object
-
-    # Distribute tasks across processors
-    with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-        futures = [executor.submit(run_simulation, s[r, c]) for r in range(len(P)) for c in range(len(T))]
-
-        for i, (future, (r, c)) in enumerate(zip(futures, [(r, c) for r in range(len(P)) for c in range(len(T))])):
-            try:
-                s[r, c] = future.result()
-            except Exception as exc:
-                print(f'Worker thread for s[{r},{c}] encountered an exception: {exc}')
-
-    # Final save at the end
-    save_to_disk(s)
-
-
-# Run linreg design
-
-for criterion in ['nondt', 'drift', 'bound']:
-
-    print(f"[{datetime.datetime.now().isoformat()}]  Design: linreg     Criterion: {criterion}")
-
-    s = np.empty((len(P), len(T)), dtype=object)
+HERE       = os.path.dirname(os.path.abspath(__file__))
+CACHE      = os.path.join(HERE, '..', 'cache')
+
+CRITERIA   = ['drift', 'nondt', 'bound']
+REPLICATES = 1000
+RESUME     = True
+QUEUE      = os.path.join(CACHE, 'queue')
+STORE      = os.path.join(CACHE, 'store')   # data sets and fits of all runs; None to disable
+STORE_SIZE = 2**34
+
+FAILURES   = []   # reports of the grids with failed chunks
+SEED       = 20240917   # replicates are seeded by (SEED, design, criterion, P, T, replicate)
+
+
+# Function to set up one cell of the grid, from its checkpoint if there is one
+def make_cell(p, t, predictor, criterion, design, variant = ''):
+    # The results path is relative to the cache (see results.py), so that the
+    # grids can be loaded from any working directory
+    path = f'{label(criterion)}_{design}{variant}/P{p}_T{t}'
+    if RESUME and os.path.exists(os.path.join(CACHE, path + '.pkl')):
+        cell = simulation.Hddm_Design.resume(os.path.join(CACHE, path + '.pkl'))
+    else:
+        shutil.rmtree(os.path.join(CACHE, path), ignore_errors=True)
+        cell = simulation.Hddm_Design(p, t, predictor, criterion, results_path = path,
+                                      seed = SEED, name = design)
+    cell.cache = Hddm_Cache(STORE, STORE_SIZE) if STORE is not None else None
+    return cell
+
+def label(criterion):
+    return criterion if isinstance(criterion, str) else 'joint'
+
+# Function to save the matrix to disk (results are stored per cell in
+# ../cache/<criterion>_<design>/; the pickle only holds their paths, relative
+# to ../cache)
+def save_to_disk(matrix, filename):
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(matrix, f)
+    os.replace(filename + '.tmp', filename)
+
+def run_grid(design, criterion, predictor, mode = 'local', nest = False):
+    s       = np.empty((len(P), len(T)), dtype=object)
+    cells   = {}
+    variant = '_nested' if nest else ''
 
     # Initialize Hddm_Design objects
     for r, p in enumerate(P):
         for c, t in enumerate(T):
-            s[r, c] = simulation.Hddm_Design(p, t, np.arange(0, p)/p, criterion)
-
-    # Function to save the matrix to disk
-    def save_to_disk(matrix, filename=f'../cache/{criterion}_linreg.pkl'):
-        with open(filename, 'wb') as f:
-            pickle.dump(matrix, f)
-
-    # Function to run the simulation and return the updated object
-    def run_simulation(simulation_object):
-        try:
-            simulation_object.run(1000)
-        except Exception as exc:
-            print(f'Simulation run encountered an exception: {exc}')
-        return simulation_object
-
-    # Distribute tasks across processors (note each run takes 4 threads)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-        futures = [executor.submit(run_simulation, s[r, c]) for r in range(len(P)) for c in range(len(T))]
-
-        for i, (future, (r, c)) in enumerate(zip(futures, [(r, c) for r in range(len(P)) for c in range(len(T))])):
-            try:
-                s[r, c] = future.result()
-            except Exception as exc:
-                print(f'Worker thread for s[{r},{c}] encountered an exception: {exc}')
+            s[r, c] = make_cell(p, t, predictor(p), criterion, design, variant)
+            cells[f'{label(criterion)}_{design}/P{p}_T{t}'] = s[r, c]
+
+    failures = len(FAILURES)
+    if nest:
+        # One simulation per replicate for the whole grid
+        if mode != 'local':
+            raise ValueError("Nested grids are only run locally.")
+        nested.run(nested.Hddm_Nested_Grid(s), REPLICATES, chunksize = 25, failures = FAILURES)
+    elif mode == 'local':
+        # Distribute chunks of replicates across processors; every cell is
+        # checkpointed as its chunks come back
+        scheduler.run(s.ravel(), REPLICATES, chunksize = 25, failures = FAILURES)
+    elif mode == 'submit':
+        work_queue.submit(QUEUE, cells, REPLICATES, chunksize = 25)
+        return
+    elif mode == 'merge':
+        work_queue.merge(QUEUE, cells)
+    else:
+        raise ValueError(f"Unknown mode '{mode}'.")
+
+    # An incomplete grid is not saved, so that it is not taken for a finished
+    # one; its cells resume from their checkpoints
+    if len(FAILURES) > failures:
+        print(f"Grid {label(criterion)}_{design}{variant} is incomplete and was not saved.")
+        return
 
     # Final save at the end
-    save_to_disk(s)
-
+    if isinstance(criterion, str):
+        save_to_disk(s, os.path.join(CACHE, f'{criterion}_{design}{variant}.pkl'))
+        return
+
+    # A joint run gives the grid of every criterion
+    for name in criterion:
+        split = np.empty_like(s)
+        for r, p in enumerate(P):
+            for c, t in enumerate(T):
+                split[r, c] = s[r, c].split(name, f'joint_{design}{variant}/{name}/P{p}_T{t}')
+        save_to_disk(split, os.path.join(CACHE, f'{name}_{design}_joint{variant}.pkl'))
+
+
+if __name__ == '__main__':
+
+    mode = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('--') else 'local'
+
+    if '--joint' in sys.argv:
+        for design, predictor in [('ttest',  lambda p: np.arange(0, p) % 2),
+                                  ('linreg', lambda p: np.arange(0, p)/p)]:
+            print(f"[{datetime.datetime.now().isoformat()}]  Design: {design}     Criteria: {CRITERIA}")
+            run_grid(design, CRITERIA, predictor, mode, nest = '--nested' in sys.argv and design == 'ttest')
+
+    else:
+        # Run ttest design
+        for criterion in ['drift', 'nondt', 'bound']:
+            print(f"[{datetime.datetime.now().isoformat()}]  Design: ttest     Criterion: {criterion}")
+            run_grid('ttest', criterion, lambda p: np.arange(0, p) % 2, mode, nest = '--nested' in sys.argv)
+
+        # Run linreg design
+        for criterion in ['nondt', 'drift', 'bound']:
+            print(f"[{datetime.datetime.now().isoformat()}]  Design: linreg     Criterion: {criterion}")
+            run_grid('linreg', criterion, lambda p: np.arange(0, p)/p, mode)
+
+    if FAILURES:
+        raise RuntimeError(f"{len(FAILURES)} grids are incomplete; rerun with RESUME to complete them:\n" +
+                           '\n'.join(FAILURES))
@@ -2,16 +2,36 @@
 
 import numpy as np
 import pandas as pd
-import pyjags
 import copy
 
+HYPERPARAMETERS = ['bound_mean', 'drift_mean', 'nondt_mean',
+                   'bound_sdev', 'drift_sdev', 'nondt_sdev', 'betaweight']
+INDIVIDUAL      = ['bound', 'drift', 'nondt']
+BETAWEIGHTS     = ['betaweight_' + varname for varname in INDIVIDUAL]   # of the bBDN model
+
+# The individual parameters with a betaweight: criterion is one name, or a
+# list of names for the bBDN model, in which each has its own betaweight
+def criteria(criterion):
+    if criterion is None or isinstance(criterion, str):
+        return [criterion] if criterion in INDIVIDUAL else []
+    return list(criterion)
+
+def hyperparameters(criterion = None):
+    if criterion is None or isinstance(criterion, str):
+        return HYPERPARAMETERS
+    return HYPERPARAMETERS[:-1] + ['betaweight_' + varname for varname in criterion]
+
 class Hddm_Parameter_Set:
     def __init__(self,
                  bound_mean = None, bound_sdev = None, bound = None,
                  drift_mean = None, drift_sdev = None, drift = None,
                  nondt_mean = None, nondt_sdev = None, nondt = None,
-                 betaweight = None):
+                 betaweight = None,
+                 betaweight_bound = None, betaweight_drift = None, betaweight_nondt = None):
         self.betaweight = betaweight
+        self.betaweight_bound = betaweight_bound
+        self.betaweight_drift = betaweight_drift
+        self.betaweight_nondt = betaweight_nondt
 
         self.bound_mean = bound_mean
         self.bound_sdev = bound_sdev
@@ -25,72 +45,74 @@ class Hddm_Parameter_Set:
         self.drift      = drift
 
     @staticmethod
-    def random(prior, n_Participants = None, criterion = None, predictor = 0):
+    def random(prior, n_Participants = None, criterion = None, predictor = 0, rng = None):
+        rng = np.random if rng is None else rng
         parameter_set = Hddm_Parameter_Set()
-        parameter_set.betaweight = np.random.uniform(prior.betaweight_lower, prior.betaweight_upper)
-        parameter_set.bound_mean = np.random.normal (prior.bound_mean_mean , prior.bound_mean_sdev)
-        parameter_set.drift_mean = np.random.normal (prior.drift_mean_mean , prior.drift_mean_sdev)
-        parameter_set.nondt_mean = np.random.normal (prior.nondt_mean_mean , prior.nondt_mean_sdev)
-        parameter_set.bound_sdev = np.random.uniform(prior.bound_sdev_lower, prior.bound_sdev_upper)
-        parameter_set.drift_sdev = np.random.uniform(prior.drift_sdev_lower, prior.drift_sdev_upper)
-        parameter_set.nondt_sdev = np.random.uniform(prior.nondt_sdev_lower, prior.nondt_sdev_upper)
-
-        Xb = predictor if criterion == 'bound' else 0
-        Xd = predictor if criterion == 'drift' else 0
-        Xn = predictor if criterion == 'nondt' else 0
-
-        parameter_set.bound = np.random.normal(parameter_set.bound_mean + (parameter_set.betaweight * Xb),
-                                               parameter_set.bound_sdev,
-                                               n_Participants)
-        parameter_set.drift = np.random.normal(parameter_set.drift_mean + (parameter_set.betaweight * Xd),
-                                               parameter_set.drift_sdev,
-                                               n_Participants)
-        parameter_set.nondt = np.random.normal(parameter_set.nondt_mean + (parameter_set.betaweight * Xn),
-                                               parameter_set.nondt_sdev,
-                                               n_Participants)
+        if criterion is None or isinstance(criterion, str):
+            parameter_set.betaweight = rng.uniform(prior.betaweight_lower, prior.betaweight_upper)
+            weights = {varname: parameter_set.betaweight for varname in criteria(criterion)}
+        else:
+            weights = {varname: rng.uniform(prior.betaweight_lower, prior.betaweight_upper) for varname in criterion}
+            for varname, weight in weights.items():
+                setattr(parameter_set, 'betaweight_' + varname, weight)
+        parameter_set.bound_mean = rng.normal (prior.bound_mean_mean , prior.bound_mean_sdev)
+        parameter_set.drift_mean = rng.normal (prior.drift_mean_mean , prior.drift_mean_sdev)
+        parameter_set.nondt_mean = rng.normal (prior.nondt_mean_mean , prior.nondt_mean_sdev)
+        parameter_set.bound_sdev = rng.uniform(prior.bound_sdev_lower, prior.bound_sdev_upper)
+        parameter_set.drift_sdev = rng.uniform(prior.drift_sdev_lower, prior.drift_sdev_upper)
+        parameter_set.nondt_sdev = rng.uniform(prior.nondt_sdev_lower, prior.nondt_sdev_upper)
+
+        Xb = weights.get('bound', 0) * np.asarray(predictor)
+        Xd = weights.get('drift', 0) * np.asarray(predictor)
+        Xn = weights.get('nondt', 0) * np.asarray(predictor)
+
+        parameter_set.bound = rng.normal(parameter_set.bound_mean + Xb,
+                                         parameter_set.bound_sdev,
+                                         n_Participants)
+        parameter_set.drift = rng.normal(parameter_set.drift_mean + Xd,
+                                         parameter_set.drift_sdev,
+                                         n_Participants)
+        parameter_set.nondt = rng.normal(parameter_set.nondt_mean + Xn,
+                                         parameter_set.nondt_sdev,
+                                         n_Participants)
         return parameter_set
 
+    def names(self):
+        # The hyperparameters that are set, e.g. parameter_set.hyperparameters(criterion)
+        return [varname for varname in HYPERPARAMETERS + BETAWEIGHTS if getattr(self, varname) is not None]
+
     def __sub__(self, other):
         if other is None:
             return None
 
         if not isinstance(other, Hddm_Parameter_Set):
             raise ValueError("Can only take a difference between two Hddm_Parameter_Set objects.")
+        if self.names() != other.names():
+            raise ValueError(f"Cannot subtract {other.names()} from {self.names()}.")
 
-        return Hddm_Parameter_Set(
-            betaweight = self.betaweight - other.betaweight,
-            bound_mean = self.bound_mean - other.bound_mean,
-            bound_sdev = self.bound_sdev - other.bound_sdev,
-            drift_mean = self.drift_mean - other.drift_mean,
-            drift_sdev = self.drift_sdev - other.drift_sdev,
-            nondt_mean = self.nondt_mean - other.nondt_mean,
-            nondt_sdev = self.nondt_sdev - other.nondt_sdev,
-            bound      = self.bound - other.bound if self.bound is not None and other.bound is not None else None,
-            drift      = self.drift - other.drift if self.drift is not None and other.drift is not None else None,
-            nondt      = self.nondt - other.nondt if self.nondt is not None and other.nondt is not None else None
-        )
+        difference = {varname: getattr(self, varname) - getattr(other, varname) for varname in self.names()}
+        for varname in INDIVIDUAL:
+            if getattr(self, varname) is not None and getattr(other, varname) is not None:
+                difference[varname] = getattr(self, varname) - getattr(other, varname)
+        return Hddm_Parameter_Set(**difference)
 
     def __eq__(self, other):
         if not isinstance(other, Hddm_Parameter_Set):
             return False
 
         return (
-            self.betaweight == other.betaweight and
-            self.bound_mean == other.bound_mean and
-            self.bound_sdev == other.bound_sdev and
-            self.drift_mean == other.drift_mean and
-            self.drift_sdev == other.drift_sdev and
-            self.nondt_mean == other.nondt_mean and
-            self.nondt_sdev == other.nondt_sdev and
-            np.array_equal(self.bound, other.bound) and
-            np.array_equal(self.drift, other.drift) and
-            np.array_equal(self.nondt, other.nondt)
+            all(getattr(self, varname) == getattr(other, varname) for varname in HYPERPARAMETERS + BETAWEIGHTS) and
+            all(np.array_equal(getattr(self, varname), getattr(other, varname)) for varname in INDIVIDUAL)
         )
 
     def __str__(self):
         output = [
             "Hddm_Parameter_Set Details:",
-            f"Betaweight:              {self.betaweight}",
+            f"Betaweight:              {self.betaweight}"
+        ]
+        output += [f"Betaweight {varname.capitalize() + ':':<14}{getattr(self, 'betaweight_' + varname)}"
+                   for varname in INDIVIDUAL if getattr(self, 'betaweight_' + varname) is not None]
+        output += [
             f"Bound Mean:              {self.bound_mean}",
             f"Bound Std Dev:           {self.bound_sdev}",
             f"Drift Mean:              {self.drift_mean}",
@@ -103,3 +125,130 @@ class Hddm_Parameter_Set:
         ]
         return '\n'.join(output)
 
+
+
+# N parameter sets as arrays: hyperparameters of shape (N,), individual
+# parameters of shape (N, P), and a mask of the replicates that are present
+# (e.g. whose fit did not fail).  Missing values are NaN.  Batches of the
+# bBDN model have betaweight_<criterion> instead of betaweight.
+FIELDS = HYPERPARAMETERS + BETAWEIGHTS + INDIVIDUAL
+
+class Hddm_Parameter_Batch:
+    def __init__(self, ok = None, **parameters):
+        for varname in FIELDS:
+            value = parameters.get(varname)
+            setattr(self, varname, None if value is None else np.asarray(value, dtype=float))
+        N = len(getattr(self, HYPERPARAMETERS[0]))
+        self.ok = np.ones(N, dtype=bool) if ok is None else np.asarray(ok, dtype=bool)
+
+    def __len__(self):
+        return self.ok.size
+
+    def names(self):
+        return [varname for varname in HYPERPARAMETERS + BETAWEIGHTS if getattr(self, varname) is not None]
+
+    @staticmethod
+    def random(prior, n_Replicates, n_Participants = None, criterion = None, predictor = 0, rng = None):
+        rng     = np.random if rng is None else rng
+        N       = n_Replicates
+        single  = criterion is None or isinstance(criterion, str)
+        names   = ['betaweight'] if single else ['betaweight_' + varname for varname in criterion]
+        weights = {varname: rng.uniform(prior.betaweight_lower, prior.betaweight_upper, N) for varname in names}
+        batch = Hddm_Parameter_Batch(
+            **weights,
+            bound_mean = rng.normal (prior.bound_mean_mean , prior.bound_mean_sdev , N),
+            drift_mean = rng.normal (prior.drift_mean_mean , prior.drift_mean_sdev , N),
+            nondt_mean = rng.normal (prior.nondt_mean_mean , prior.nondt_mean_sdev , N),
+            bound_sdev = rng.uniform(prior.bound_sdev_lower, prior.bound_sdev_upper, N),
+            drift_sdev = rng.uniform(prior.drift_sdev_lower, prior.drift_sdev_upper, N),
+            nondt_sdev = rng.uniform(prior.nondt_sdev_lower, prior.nondt_sdev_upper, N))
+
+        P = 1 if n_Participants is None else n_Participants
+        X = np.broadcast_to(predictor, (P,))
+        for varname in INDIVIDUAL:
+            weight   = batch.betaweight if single else getattr(batch, 'betaweight_' + varname)
+            location = getattr(batch, varname + '_mean')[:, None] + \
+                       (weight[:, None] * X if varname in criteria(criterion) else 0)
+            value    = rng.normal(location, getattr(batch, varname + '_sdev')[:, None], (N, P))
+            setattr(batch, varname, value[:, 0] if n_Participants is None else value)
+        return batch
+
+    @staticmethod
+    def from_sets(parameter_sets):
+        # None entries, like the estimate of a failed fit, are masked
+        present = [p for p in parameter_sets if p is not None]
+        ok      = np.array([p is not None for p in parameter_sets], dtype=bool)
+        parameters = {}
+        for varname in FIELDS:
+            values = [getattr(p, varname) for p in present]
+            if not present or any(value is None for value in values):
+                continue
+            value = np.full((ok.size,) + np.shape(values[0]), np.nan)
+            value[ok] = values
+            parameters[varname] = value
+        if HYPERPARAMETERS[0] not in parameters:
+            parameters[HYPERPARAMETERS[0]] = np.full(ok.size, np.nan)
+        return Hddm_Parameter_Batch(ok, **parameters)
+
+    @staticmethod
+    def from_results(results, prefix = 'true_'):
+        # From the columns of an Hddm_Results store: prefix 'true_', 'est_' or
+        # 'quantile_'
+        parameters = {varname: results.column(prefix + varname) for varname in FIELDS
+                      if prefix + varname in results.dtype.names}
+        return Hddm_Parameter_Batch(results.column('ok') if prefix != 'true_' else None, **parameters)
+
+    def to_sets(self):
+        return [self[k] for k in range(len(self))]
+
+    def __getitem__(self, k):
+        # An integer gives an Hddm_Parameter_Set (None if masked); slices,
+        # index arrays and masks give a batch
+        if np.ndim(k) == 0 and not isinstance(k, slice):
+            if not self.ok[k]:
+                return None
+            return Hddm_Parameter_Set(**{varname: getattr(self, varname)[k] for varname in FIELDS
+                                         if getattr(self, varname) is not None})
+        return Hddm_Parameter_Batch(self.ok[k], **{varname: getattr(self, varname)[k]
+                                                   for varname in FIELDS
+                                                   if getattr(self, varname) is not None})
+
+    def masked(self, mask):
+        other    = copy.copy(self)
+        other.ok = self.ok & mask
+        return other
+
+    def __sub__(self, other):
+        if not isinstance(other, Hddm_Parameter_Batch):
+            raise ValueError("Can only take a difference between two Hddm_Parameter_Batch objects.")
+        if len(self) != len(other):
+            raise ValueError("Batches must have the same number of replicates.")
+        return Hddm_Parameter_Batch(self.ok & other.ok,
+                                    **{varname: getattr(self, varname) - getattr(other, varname)
+                                       for varname in FIELDS
+                                       if getattr(self, varname) is not None and getattr(other, varname) is not None})
+
+    def __eq__(self, other):
+        if not isinstance(other, Hddm_Parameter_Batch):
+            return False
+        return np.array_equal(self.ok, other.ok) and all(
+            np.array_equal(getattr(self, varname), getattr(other, varname), equal_nan=True)
+            if getattr(self, varname) is not None and getattr(other, varname) is not None
+            else getattr(self, varname) is getattr(other, varname)
+            for varname in FIELDS)
+
+    def metrics(self):
+        # Mean, mean squared, root mean squared and mean absolute value of each
+        # hyperparameter over the replicates present; for a difference of
+        # estimates and true values, these are ME, MSE, RMSE and MAE
+        names  = self.names()
+        values = np.array([getattr(self, varname)[self.ok] for varname in names]).reshape(len(names), -1)
+        mse    = np.mean(values**2, axis=1)
+        return pd.DataFrame({"me":   np.mean(values, axis=1),
+                             "mse":  mse,
+                             "rmse": np.sqrt(mse),
+                             "mae":  np.mean(np.abs(values), axis=1)},
+                            index = names)
+
+    def __str__(self):
+        return f"Hddm_Parameter_Batch({len(self)} replicates, {np.sum(self.ok)} present)"
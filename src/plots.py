@@ -1,29 +1,96 @@
 # Functions to create figures for the EZBHDDM simulation studies
 
+#   The plots take either a grid of Hddm_Design objects, as saved by para.py,
+#   or an Hddm_Grid_Summary of it, which holds only what the plots need and is
+#   cheap to save and load.  The summary of a grid is built once and reused by
+#   the plots of the same grid that follow.
+
 import numpy as np
 import pickle
 import os
+import weakref
 import matplotlib.pyplot as plt
 
-os.chdir('/srv/host/src/')
+from parameter_set import Hddm_Parameter_Batch
+
+PARAMETERS = ["betaweight", "bound_mean", "drift_mean", "nondt_mean"]
+
+class Hddm_Grid_Summary:
+    # Per cell of a P x T grid: true and estimated values of successful fits
+    # (concatenated over cells, with offsets) and the RMSE of each parameter
+    def __init__(self, P, T, offsets, true, est, rmse):
+        self.P       = np.asarray(P)
+        self.T       = np.asarray(T)
+        self.shape   = (self.P.size, self.T.size)
+        self.offsets = offsets
+        self.true    = true
+        self.est     = est
+        self.rmse    = rmse
+
+    @staticmethod
+    def from_grid(s, parameters = PARAMETERS):
+        cells   = [s[i,j] for i in range(s.shape[0]) for j in range(s.shape[1])]
+        oks     = [cell.results.column('ok') for cell in cells]
+        offsets = np.concatenate([[0], np.cumsum([np.sum(ok) for ok in oks])])
+        metrics = [(Hddm_Parameter_Batch.from_results(cell.results, 'est_') -
+                    Hddm_Parameter_Batch.from_results(cell.results, 'true_')).metrics() for cell in cells]
+        true, est, rmse = {}, {}, {}
+        for parameter in parameters:
+            true[parameter] = np.concatenate([cell.results.column('true_' + parameter)[ok] for cell, ok in zip(cells, oks)])
+            est[parameter]  = np.concatenate([cell.results.column('est_' + parameter)[ok] for cell, ok in zip(cells, oks)])
+            rmse[parameter] = np.array([m.loc[parameter, 'rmse'] for m in metrics]).reshape(s.shape)
+        return Hddm_Grid_Summary([s[i,0].n_Participants for i in range(s.shape[0])],
+                                 [s[0,j].n_TrialsPerPerson for j in range(s.shape[1])],
+                                 offsets, true, est, rmse)
+
+    def points(self, parameter, i, j):
+        k = i * self.shape[1] + j
+        return (self.true[parameter][self.offsets[k]:self.offsets[k+1]],
+                self.est[parameter][self.offsets[k]:self.offsets[k+1]])
 
-import simulation
+    def save(self, path):
+        arrays = {"P": self.P, "T": self.T, "offsets": self.offsets}
+        for parameter in self.rmse:
+            arrays.update({"true_" + parameter: self.true[parameter],
+                           "est_"  + parameter: self.est[parameter],
+                           "rmse_" + parameter: self.rmse[parameter]})
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        return path
+
+    @staticmethod
+    def open(path):
+        with np.load(path) as f:
+            parameters = [key[len('rmse_'):] for key in f.files if key.startswith('rmse_')]
+            return Hddm_Grid_Summary(f["P"], f["T"], f["offsets"],
+                                     {parameter: f["true_" + parameter] for parameter in parameters},
+                                     {parameter: f["est_" + parameter] for parameter in parameters},
+                                     {parameter: f["rmse_" + parameter] for parameter in parameters})
+
+_last = (None, None)    # (weak reference to the last grid plotted, its summary)
+
+def _summary(s, parameter):
+    global _last
+    if isinstance(s, Hddm_Grid_Summary):
+        return s
+    grid, summary = _last
+    if grid is None or grid() is not s or parameter not in summary.rmse:
+        summary = Hddm_Grid_Summary.from_grid(s, PARAMETERS + [parameter] * (parameter not in PARAMETERS))
+        _last   = (weakref.ref(s), summary)
+    return summary
 
 def biasplot(s, parameter, i, j, ax):
-    x = [getattr(s[i,j].results[k][0], parameter)
-         for k in range(len(s[i,j].results))
-         if (s[i,j].results[k][0] - s[i,j].results[k][1]) is not None]
-    y = [getattr(s[i,j].results[k][1], parameter)
-         for k in range(len(s[i,j].results))
-         if (s[i,j].results[k][0] - s[i,j].results[k][1]) is not None]
+    s    = _summary(s, parameter)
+    x, y = s.points(parameter, i, j)
 
     ax.scatter(x, y, s=4)
 
     #ax.set_xlabel('simulated value')
     if j==0:
-        ax.set_ylabel(f'P={s[i,j].n_Participants}', fontsize=10)
+        ax.set_ylabel(f'P={s.P[i]}', fontsize=10)
     if i==0:
-        ax.set_title(f'T={s[i,j].n_TrialsPerPerson}', fontsize=10)
+        ax.set_title(f'T={s.T[j]}', fontsize=10)
     if j!=(s.shape[1]-1):
         ax.set_yticklabels([])
     if i!=(s.shape[0]-1):
@@ -48,17 +115,12 @@ def biasplot(s, parameter, i, j, ax):
     ax.grid()
 
 def rmseplot(s, parameter, ax, title, axlbl):
-    v = np.zeros(s.shape)
-    xticklabels = [s[0,i].n_TrialsPerPerson for i in range(s.shape[1])]
-    for i in range(s.shape[0]):
-        for j in range(s.shape[1]):
-            q = [getattr(s[i,j].results[k][1], parameter) - getattr(s[i,j].results[k][0], parameter)
-                 for k in range(len(s[i,j].results))
-                 if (s[i,j].results[k][0] - s[i,j].results[k][1]) is not None]
-            v[i,j] = np.sqrt(np.mean(np.array(q)**2))
+    s = _summary(s, parameter)
+    v = s.rmse[parameter]
+    xticklabels = list(s.T)
 
     for i in range(v.shape[0]):
-        ax.plot(xticklabels, v[i, :], label=f'P = {s[i,0].n_Participants}', marker='o', linestyle='--')
+        ax.plot(xticklabels, v[i, :], label=f'P = {s.P[i]}', marker='o', linestyle='--')
 
     ax.grid()
     ax.set_xlabel('Trials per participant')
@@ -71,4 +133,3 @@ def rmseplot(s, parameter, ax, title, axlbl):
     ax.set_ylim((0,np.maximum(0.25, np.max(v))))
     ax.set_xticks(xticklabels)
     ax.set_xticklabels(xticklabels)
-
@@ -0,0 +1,196 @@
+# Class to hold posterior samples
+
+#   Hyperparameters are stored as one (param, draw, chain) array and the
+#   individual parameters as one (param, participant, draw, chain) array.
+#   Indexing by name gives views in the layout of pyjags output, so code that
+#   used the samples dict of ezhbddm.estimate keeps working; 'bound_17' style
+#   keys give the draws of one participant.  The axes are named by
+#   hyper_dims and individual_dims, and coords() labels them; both are saved
+#   with the samples.
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+HYPER_DIMS      = ('param', 'draw', 'chain')
+INDIVIDUAL_DIMS = ('param', 'participant', 'draw', 'chain')
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+class Hddm_Posterior:
+    def __init__(self, hyper, hyper_names, individual, individual_names, participants, diagnostics = None):
+        self.hyper            = hyper
+        self.hyper_names      = list(hyper_names)
+        self.individual       = individual
+        self.individual_names = list(individual_names)
+        self.participants     = np.asarray(participants)
+        self.diagnostics      = diagnostics
+        self.hyper_dims       = HYPER_DIMS
+        self.individual_dims  = INDIVIDUAL_DIMS
+        self.path             = None
+
+        if self.hyper.shape[0] != len(self.hyper_names) or self.individual.shape[0] != len(self.individual_names):
+            raise ValueError("Parameter names do not match the sample arrays.")
+        if self.individual_names and self.individual.shape[1] != self.participants.size:
+            raise ValueError("Participant IDs do not match the sample arrays.")
+
+    @staticmethod
+    def from_samples(samples, participants, hyper_names, individual_names, dtype = np.float64):
+        # samples as returned by pyjags: (1, draws, chains) for scalars and
+        # (participants, draws, chains) for vector nodes
+        individual_names = [name for name in individual_names if name in samples]
+        draws, chains    = samples[hyper_names[0]].shape[-2:]
+
+        hyper = np.empty((len(hyper_names), draws, chains), dtype=dtype)
+        for k, name in enumerate(hyper_names):
+            hyper[k] = samples[name][0]
+        individual = np.empty((len(individual_names), len(participants), draws, chains), dtype=dtype)
+        for k, name in enumerate(individual_names):
+            individual[k] = samples[name]
+
+        return Hddm_Posterior(hyper, hyper_names, individual, individual_names, participants,
+                              samples.get('diagnostics'))
+
+    def coords(self, individual = False):
+        # Labels of the axes of hyper (or of individual), by dimension name
+        coords = {"param": list(self.individual_names if individual else self.hyper_names)}
+        if individual:
+            coords["participant"] = self.participants
+        coords["draw"]  = np.arange(self.n_Draws)
+        coords["chain"] = np.arange(self.n_Chains)
+        return coords
+
+    @property
+    def n_Draws(self):
+        return self.hyper.shape[1]
+
+    @property
+    def n_Chains(self):
+        return self.hyper.shape[2]
+
+    def person(self, k):
+        # Draws of all individual parameters of participant k, (param, draw, chain)
+        return self.individual[:, self._position(k)]
+
+    def _position(self, k):
+        position = np.searchsorted(self.participants, k)
+        if position >= self.participants.size or self.participants[position] != k:
+            raise KeyError(f"No samples for participant {k}.")
+        return position
+
+    def __getitem__(self, key):
+        if key in self.hyper_names:
+            return self.hyper[self.hyper_names.index(key)][None]
+        if key in self.individual_names:
+            return self.individual[self.individual_names.index(key)]
+        if key == 'diagnostics' and self.diagnostics is not None:
+            return self.diagnostics
+        name, _, k = key.rpartition('_')
+        if name in self.individual_names and k.lstrip('-').isdigit():
+            return self.individual[self.individual_names.index(name), self._position(int(k))]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return self.hyper_names + self.individual_names + (['diagnostics'] if self.diagnostics is not None else [])
+
+    # Summaries over draws and chains: scalars for hyperparameters, one value
+    # per participant for individual parameters
+    def _reduce(self, key, function):
+        value = function(self[key])
+        return value[..., 0] if key in self.hyper_names else value
+
+    def mean(self, key):
+        return self._reduce(key, lambda x: np.mean(x, axis=(-2, -1)))
+
+    def sdev(self, key):
+        return self._reduce(key, lambda x: np.std(x, axis=(-2, -1)))
+
+    def quantile(self, key, q):
+        # Quantiles in the first axis when q is an array
+        return self._reduce(key, lambda x: np.quantile(x, q, axis=(-2, -1)))
+
+    def interval(self, key, width = 0.95):
+        lower, upper = self.quantile(key, [(1 - width) / 2, (1 + width) / 2])
+        return lower, upper
+
+    def summary(self, width = 0.95):
+        lower, upper = np.quantile(self.hyper, [(1 - width) / 2, (1 + width) / 2], axis=(-2, -1))
+        return pd.DataFrame({"mean":  self.hyper.mean(axis=(-2, -1)),
+                             "sdev":  self.hyper.std(axis=(-2, -1)),
+                             "lower": lower,
+                             "upper": upper},
+                            index = self.hyper_names)
+
+    def save(self, path):
+        # A .npz file, or a directory of .npy files that open() memory maps
+        meta = {"format":           1,
+                "hyper_names":      self.hyper_names,
+                "individual_names": self.individual_names,
+                "hyper_dims":       list(self.hyper_dims),
+                "individual_dims":  list(self.individual_dims),
+                "diagnostics":      _jsonable(self.diagnostics)}
+        if path.endswith('.npz'):
+            np.savez(path, hyper = self.hyper, individual = self.individual,
+                     participants = self.participants, meta = json.dumps(meta))
+            return path
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'hyper.npy'), self.hyper)
+        np.save(os.path.join(path, 'individual.npy'), self.individual)
+        np.save(os.path.join(path, 'participants.npy'), self.participants)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return path
+
+    @staticmethod
+    def open(path):
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                meta   = json.loads(str(f['meta']))
+                arrays = [f['hyper'], f['individual'], f['participants']]
+        else:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                      for name in ['hyper', 'individual', 'participants']]
+
+        if tuple(meta.get("hyper_dims", HYPER_DIMS)) != HYPER_DIMS or \
+           tuple(meta.get("individual_dims", INDIVIDUAL_DIMS)) != INDIVIDUAL_DIMS:
+            raise ValueError(f"Samples in {path} have axes {meta.get('hyper_dims')} and {meta.get('individual_dims')}.")
+        posterior = Hddm_Posterior(arrays[0], meta["hyper_names"], arrays[1], meta["individual_names"],
+                                   arrays[2], meta["diagnostics"])
+        posterior.path = path
+        return posterior
+
+    def __getstate__(self):
+        # Posteriors opened from disk are pickled as their path and reopened
+        if self.path is not None:
+            return {"path": self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if set(state) == {"path"}:
+            self.__dict__.update(Hddm_Posterior.open(state["path"]).__dict__)
+        else:
+            self.__dict__.update({"hyper_dims": HYPER_DIMS, "individual_dims": INDIVIDUAL_DIMS})
+            self.__dict__.update(state)
+
+    def __str__(self):
+        return (f"Hddm_Posterior({self.participants.size} participants, {self.n_Draws} draws, "
+                f"{self.n_Chains} chains, {self.hyper.dtype})")
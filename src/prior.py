@@ -2,7 +2,6 @@
 
 import numpy as np
 import pandas as pd
-import pyjags
 import copy
 
 class Hddm_Prior:
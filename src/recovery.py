@@ -0,0 +1,135 @@
+# Streaming parameter recovery statistics
+
+#   Accumulates, for every hyperparameter, the error of the posterior mean
+#   (estimate - truth) with Welford's updates, the coverage of central
+#   credible intervals and a histogram of the posterior quantile of the true
+#   value (as in simulation-based calibration).  Memory does not grow with the
+#   number of replicates, and accumulators of separate workers can be merged
+#   with Chan et al.'s pairwise formulas.
+
+import numpy as np
+import pandas as pd
+
+from parameter_set import HYPERPARAMETERS
+
+class Hddm_Recovery:
+    def __init__(self, names = HYPERPARAMETERS, levels = (0.5, 0.8, 0.95), bins = 20):
+        H = len(names)
+        self.names     = list(names)
+        self.levels    = np.asarray(levels, dtype=float)
+        self.failures  = 0
+        self.n         = np.zeros(H, dtype=np.int64)
+        self.mean      = np.zeros(H)
+        self.m2        = np.zeros(H)
+        self.abs_mean  = np.zeros(H)
+        self.covered   = np.zeros((len(levels), H), dtype=np.int64)
+        self.histogram = np.zeros((bins, H), dtype=np.int64)
+
+    def update(self, truth, estimate, quantile):
+        # One replicate; estimate and quantile are None if the fit failed
+        if estimate is None:
+            self.failures += 1
+            return self
+
+        error = np.array([getattr(estimate, name) - getattr(truth, name) for name in self.names], dtype=float)
+        valid = np.isfinite(error)
+        error = np.where(valid, error, 0)
+
+        self.n        += valid
+        n              = np.maximum(self.n, 1)
+        delta          = error - self.mean
+        self.mean     += valid * delta / n
+        self.m2       += valid * delta * (error - self.mean)
+        self.abs_mean += valid * (np.abs(error) - self.abs_mean) / n
+
+        if quantile is not None:
+            q     = np.array([getattr(quantile, name) for name in self.names], dtype=float)
+            valid = np.isfinite(q)
+            q     = np.where(valid, q, 0.5)
+            self.covered += valid & (np.abs(q - 0.5) <= self.levels[:, None] / 2)
+            bins = np.minimum((q * self.histogram.shape[0]).astype(int), self.histogram.shape[0] - 1)
+            np.add.at(self.histogram, (bins[valid], np.flatnonzero(valid)), 1)
+        return self
+
+    def merge(self, other):
+        if other.names != self.names or not np.array_equal(other.levels, self.levels) or \
+           other.histogram.shape != self.histogram.shape:
+            raise ValueError("Can only merge recovery statistics of the same layout.")
+        n     = self.n + other.n
+        w     = np.divide(other.n, n, out=np.zeros(n.shape), where=n > 0)
+        delta = other.mean - self.mean
+        self.m2        += other.m2 + delta**2 * self.n * w
+        self.mean      += delta * w
+        self.abs_mean  += (other.abs_mean - self.abs_mean) * w
+        self.n          = n
+        self.failures  += other.failures
+        self.covered   += other.covered
+        self.histogram += other.histogram
+        return self
+
+    def select(self, names, rename = None):
+        # The statistics of some of the hyperparameters, optionally renamed
+        k     = [self.names.index(name) for name in names]
+        other = Hddm_Recovery(names if rename is None else rename, self.levels, self.histogram.shape[0])
+        other.failures  = self.failures
+        other.n         = self.n[k].copy()
+        other.mean      = self.mean[k].copy()
+        other.m2        = self.m2[k].copy()
+        other.abs_mean  = self.abs_mean[k].copy()
+        other.covered   = self.covered[:, k].copy()
+        other.histogram = self.histogram[:, k].copy()
+        return other
+
+    # Statistics per hyperparameter
+    def _per_replicate(self, value):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 0, value / self.n, np.nan)
+
+    @property
+    def bias(self):
+        return np.where(self.n > 0, self.mean, np.nan)
+
+    @property
+    def mse(self):
+        return self._per_replicate(self.m2) + self.bias**2
+
+    @property
+    def rmse(self):
+        return np.sqrt(self.mse)
+
+    @property
+    def mae(self):
+        return np.where(self.n > 0, self.abs_mean, np.nan)
+
+    @property
+    def sdev(self):
+        return np.sqrt(self._per_replicate(self.m2))
+
+    @property
+    def coverage(self):
+        # Fraction of true values inside each central interval, (levels, names)
+        n = self.histogram.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, self.covered / n, np.nan)
+
+    @property
+    def uniformity(self):
+        # Chi-square statistic of the quantile histogram against uniformity
+        n        = self.histogram.sum(axis=0)
+        expected = n / self.histogram.shape[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, np.sum((self.histogram - expected)**2 / expected, axis=0), np.nan)
+
+    def summary(self):
+        table = pd.DataFrame({"n":    self.n,
+                              "bias": self.bias,
+                              "rmse": self.rmse,
+                              "mae":  self.mae,
+                              "sdev": self.sdev}, index = self.names)
+        for level, coverage in zip(self.levels, self.coverage):
+            table[f"coverage_{level:g}"] = coverage
+        table["chi2"] = self.uniformity
+        return table
+
+    def __str__(self):
+        return self.summary().to_string(float_format = lambda x: f"{x:.4f}")
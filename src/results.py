@@ -0,0 +1,188 @@
+# Class to store simulation results
+
+#   One row per replicate with the true, estimated and posterior quantile
+#   values of the hyperparameters, and optionally the true and estimated
+#   individual parameters.  With a path, rows are appended in chunks to one
+#   raw file per column, so single columns of single cells can be memory
+#   mapped without reading anything else.  meta.json is written after the
+#   columns and holds the number of complete rows.  A relative path is
+#   relative to ROOT, the cache directory of the repository, rather than to
+#   the working directory, so that pickled designs find their results from
+#   wherever they are loaded.
+
+import json
+import os
+import numpy as np
+
+import parameter_set
+from parameter_set import HYPERPARAMETERS, INDIVIDUAL
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache')
+
+def resolve(path):
+    return None if path is None else os.path.join(ROOT, path)
+
+def row_dtype(n_Participants = None, hyperparameters = HYPERPARAMETERS):
+    # n_Participants adds per-participant columns of the individual parameters;
+    # see parameter_set.hyperparameters for models with several betaweights
+    fields  = [('replicate', np.int32), ('ok', bool), ('walltime', np.float64)]
+    fields += [(prefix + varname, np.float64) for prefix in ['true_', 'est_', 'quantile_']
+               for varname in hyperparameters]
+    if n_Participants is not None:
+        fields += [(prefix + varname, np.float32, (n_Participants,)) for prefix in ['true_', 'est_']
+                   for varname in INDIVIDUAL]
+    return np.dtype(fields)
+
+class Hddm_Results:
+    def __init__(self, path = None, n_Participants = None, chunksize = 100, dtype = None, offset = 0,
+                 hyperparameters = HYPERPARAMETERS):
+        self.path      = path               # as given, and pickled
+        self.directory = resolve(path)      # where the columns are
+        self.dtype     = row_dtype(n_Participants, hyperparameters) if dtype is None else dtype
+        self.hyperparameters = [name[len('quantile_'):] for name in self.dtype.names if name.startswith('quantile_')]
+        self.chunksize = chunksize
+        self.offset    = offset     # replicate number of the first row
+        self.n_Flushed = 0
+        self.buffer    = []
+
+        if path is not None:
+            if os.path.exists(os.path.join(self.directory, 'meta.json')):
+                self._resume()
+            else:
+                os.makedirs(self.directory, exist_ok=True)
+                self._write_meta()
+
+    @staticmethod
+    def open(path):
+        with open(os.path.join(resolve(path), 'meta.json')) as f:
+            meta = json.load(f)
+        dtype = np.dtype([(name, dt, tuple(shape)) for name, dt, shape in meta["columns"]])
+        return Hddm_Results(path, dtype = dtype, offset = meta.get("offset", 0))
+
+    def _resume(self):
+        # Drops bytes of a chunk that was not completely written
+        with open(os.path.join(self.directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if [name for name, _, _ in meta["columns"]] != list(self.dtype.names):
+            raise ValueError(f"Results in {self.directory} have different columns.")
+        self.n_Flushed = meta["n_Rows"]
+        self.offset    = meta.get("offset", self.offset)
+        for name in self.dtype.names:
+            file_name = self._file(name)
+            if os.path.exists(file_name):
+                os.truncate(file_name, min(os.path.getsize(file_name), self.n_Flushed * self.dtype[name].itemsize))
+
+    def _file(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def _write_meta(self):
+        columns = [(name, self.dtype[name].base.str, self.dtype[name].shape) for name in self.dtype.names]
+        with open(os.path.join(self.directory, 'meta.json.tmp'), 'w') as f:
+            json.dump({"format": 1, "n_Rows": self.n_Flushed, "offset": self.offset, "columns": columns}, f)
+        os.replace(os.path.join(self.directory, 'meta.json.tmp'), os.path.join(self.directory, 'meta.json'))
+
+    def append(self, parameter_set, estimate, quantile, walltime = np.nan):
+        row = np.zeros(1, dtype=self.dtype)
+        row['replicate'] = self.offset + len(self)
+        row['ok']        = estimate is not None
+        row['walltime']  = walltime
+        for varname in self.hyperparameters:
+            row['true_' + varname]     = getattr(parameter_set, varname)
+            row['est_' + varname]      = np.nan if estimate is None else getattr(estimate, varname)
+            row['quantile_' + varname] = np.nan if quantile is None else getattr(quantile, varname)
+        for varname in INDIVIDUAL:
+            if 'true_' + varname in self.dtype.names:
+                row['true_' + varname] = getattr(parameter_set, varname)
+                row['est_' + varname]  = np.nan if estimate is None else np.asarray(getattr(estimate, varname), dtype=float)
+
+        self.extend(row)
+
+    def extend(self, rows):
+        # Appends a structured array of rows, e.g. those of another store;
+        # rows of our dtype are not copied until they are flushed
+        self.buffer.append(np.asarray(rows).astype(self.dtype, copy=False))
+        if self.path is not None and sum(chunk.size for chunk in self.buffer) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if self.path is None or not self.buffer:
+            return
+        chunk = np.concatenate(self.buffer)
+        for name in self.dtype.names:
+            with open(self._file(name), 'ab') as f:
+                f.write(np.ascontiguousarray(chunk[name]).tobytes())
+        self.n_Flushed += chunk.size
+        self.buffer     = []
+        self._write_meta()
+
+    def truncate(self, n):
+        # Drops all rows after the first n, e.g. those written after the last
+        # checkpoint of a design
+        if n > len(self):
+            raise ValueError(f"Cannot truncate {len(self)} rows to {n}.")
+        if self.path is None:
+            self.buffer = [self._buffered()[:n]]
+            return
+        self.flush()
+        for name in self.dtype.names:
+            if os.path.exists(self._file(name)):
+                os.truncate(self._file(name), n * self.dtype[name].itemsize)
+        self.n_Flushed = n
+        self._write_meta()
+
+    def _buffered(self):
+        if len(self.buffer) > 1:
+            self.buffer = [np.concatenate(self.buffer)]
+        return self.buffer[0] if self.buffer else np.zeros(0, dtype=self.dtype)
+
+    def column(self, name):
+        # Memory map of the flushed rows, joined with rows still in the buffer
+        field = self.dtype[name]
+        if self.path is None or self.n_Flushed == 0:
+            flushed = np.zeros((0,) + field.shape, dtype=field.base)
+        else:
+            flushed = np.memmap(self._file(name), dtype=field.base, mode='r', shape=(self.n_Flushed,) + field.shape)
+        if not self.buffer:
+            return flushed
+        return np.concatenate([flushed, self._buffered()[name]])
+
+    def read(self, columns = None):
+        columns = list(self.dtype.names) if columns is None else list(columns)
+        table   = np.empty(len(self), dtype=[(name, self.dtype[name]) for name in columns])
+        for name in columns:
+            table[name] = self.column(name)
+        return table
+
+    def __len__(self):
+        return self.n_Flushed + sum(chunk.size for chunk in self.buffer)
+
+    # Rows as (true, estimate, quantile) parameter sets, as in the old list
+    def __getitem__(self, k):
+        row = {name: self.column(name)[k] for name in self.dtype.names}
+        def parameters(prefix):
+            est = parameter_set.Hddm_Parameter_Set()
+            for varname in self.hyperparameters + INDIVIDUAL:
+                if prefix + varname in self.dtype.names:
+                    setattr(est, varname, row[prefix + varname])
+            return est
+        if not row['ok']:
+            return parameters('true_'), None, None
+        return parameters('true_'), parameters('est_'), parameters('quantile_')
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __getstate__(self):
+        # Stores on disk are flushed and pickled as their path
+        if self.path is not None:
+            self.flush()
+            return {"path": self.path, "chunksize": self.chunksize}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "dtype" not in state:
+            self.__dict__.update(Hddm_Results.open(state["path"]).__dict__)
+            self.chunksize = state["chunksize"]
+        else:
+            self.__dict__.update(state)
@@ -0,0 +1,172 @@
+# Replicate-level scheduling of simulation designs over processes
+
+#   The missing replicates of every design are split into chunks, which are
+#   submitted longest first according to a walltime model fitted to the
+#   walltimes the designs recorded so far.  The number of processes is chosen
+#   so that processes times sampler threads stays within the core budget.
+#   Finished chunks are merged into their design in replicate order as soon as
+#   they are available, and designs with a results path are checkpointed.
+#
+#   Result rows do not travel back through the process pool: before
+#   submitting, the parent preallocates one .npy file of rows per design (a
+#   slab, in a scratch directory), each worker writes the rows of its chunk
+#   into its place in the slab, and returns the fork without them.  The
+#   parent merges the rows from a memory map of the slab.
+#
+#   A chunk that fails leaves its design at the last replicate before it;
+#   later chunks of that design are run but cannot be merged.  run reports
+#   them after the other designs were completed, so that an incomplete grid
+#   is not taken for a finished one: it appends the report to `failures` if
+#   given, so that a study can carry on with its other grids, and raises
+#   otherwise.  Checkpointed designs resume at their last merged replicate.
+
+import concurrent.futures
+import os
+import sys
+import tempfile
+import numpy as np
+
+import ezhbddm
+
+# Fallback walltime model, log(seconds) = a + b log(P) + c log(T), used
+# until at least three designs with different sizes have recorded walltimes
+DEFAULT_MODEL = np.array([np.log(0.05), 1.0, 0.2])
+
+def walltime_model(designs):
+    rows = [(1, np.log(d.n_Participants), np.log(d.n_TrialsPerPerson), np.log(np.median(d.walltime)))
+            for d in designs if len(d.walltime) and np.median(d.walltime) > 0]
+    rows = np.unique(np.array(rows).reshape(-1, 4), axis=0)
+    if len(rows) < 3 or np.linalg.matrix_rank(rows[:, :3]) < 3:
+        return DEFAULT_MODEL
+    return np.linalg.lstsq(rows[:, :3], rows[:, 3], rcond=None)[0]
+
+def predict_walltime(model, design):
+    return np.exp(model @ [1, np.log(design.n_Participants), np.log(design.n_TrialsPerPerson)])
+
+def plan(designs, replicates, chunksize = 25):
+    # (design index, first replicate, number of replicates, predicted seconds),
+    # most expensive first
+    model  = walltime_model(designs)
+    chunks = []
+    for i, design in enumerate(designs):
+        done = design.results.offset + len(design.results)
+        for start in range(done, replicates, chunksize):
+            n = min(chunksize, replicates - start)
+            chunks.append((i, start, n, n * predict_walltime(model, design)))
+    return sorted(chunks, key = lambda chunk: -chunk[3])
+
+def workers(designs, cores = None):
+    cores   = os.cpu_count() if cores is None else cores
+    threads = max(ezhbddm.THREADS[design.engine] for design in designs)
+    return max(1, cores // threads)
+
+def allocate(designs, replicates, root):
+    # Slab (path, first replicate) of each design for its missing replicates
+    slabs = []
+    for i, design in enumerate(designs):
+        first = design.results.offset + len(design.results)
+        path  = os.path.join(root, f'{i}.npy')
+        if replicates > first:
+            np.lib.format.open_memmap(path, mode='w+', dtype=design.results.dtype, shape=(replicates - first,))
+        slabs.append((path, first))
+    return slabs
+
+def deposit(design, slab):
+    # In the worker: moves the rows of a finished fork into the slab
+    path, first = slab
+    if len(design.results):
+        rows = np.load(path, mmap_mode='r+')
+        rows[design.results.offset - first:][:len(design.results)] = design.results.read()
+        rows.flush()
+        del rows
+    design.results.buffer = []
+    design.data           = None
+    design.samples        = None
+    return design
+
+def rows(slab, fork):
+    # In the parent: the rows a fork deposited, one per walltime it recorded
+    path, first = slab
+    if not fork.walltime:
+        return np.zeros(0, dtype=fork.results.dtype)
+    return np.load(path, mmap_mode='r')[fork.results.offset - first:][:len(fork.walltime)]
+
+def release(designs):
+    # Before the slabs are removed: flushes the rows, or copies those that
+    # stay in memory
+    for design in designs:
+        design.results.flush()
+        design.results.buffer = [np.array(chunk) for chunk in design.results.buffer]
+
+def _run_chunk(design, n, slab):
+    if design.seed is None:
+        np.random.seed()    # forked processes would share the parent's state
+    design.run(n, showProgress = False)
+    return deposit(design, slab)
+
+def run(designs, replicates, chunksize = 25, cores = None, checkpoint = True, showProgress = True, scratch = None,
+        failures = None):
+    # Runs every design up to `replicates` replicates and returns the designs;
+    # scratch is the directory of the slabs (by default a temporary one), and
+    # failures a list to append the report of failed chunks to
+    designs = list(designs)
+    chunks  = plan(designs, replicates, chunksize)
+    pending = [{} for _ in designs]
+    failed  = [[] for _ in designs]
+    total   = sum(chunk[3] for chunk in chunks)
+    elapsed = 0
+
+    with tempfile.TemporaryDirectory(dir = scratch) as root, \
+         concurrent.futures.ProcessPoolExecutor(max_workers = workers(designs, cores)) as executor:
+        slabs   = allocate(designs, replicates, root)
+        futures = {executor.submit(_run_chunk, designs[i].fork(start), n, slabs[i]): (i, start, cost)
+                   for i, start, n, cost in chunks}
+
+        for future in concurrent.futures.as_completed(futures):
+            i, start, cost = futures[future]
+            try:
+                pending[i][start] = future.result()
+            except Exception as exc:
+                print(f'Chunk {start} of design {i} encountered an exception: {exc}')
+                failed[i].append(start)
+                continue
+
+            design = designs[i]
+            while design.results.offset + len(design.results) in pending[i]:
+                fork = pending[i].pop(design.results.offset + len(design.results))
+                design.merge(fork, rows(slabs[i], fork))
+                if checkpoint and design.results.path is not None:
+                    design.checkpoint(design.results.directory + '.pkl')
+
+            elapsed += cost
+            if showProgress:
+                percent = elapsed / total * 100
+                cplt = int(np.fix(percent/2))
+                sys.stdout.write(f"\rProgress [{'='*cplt}{' '*(50-cplt)}] {percent:6.2f}%")
+                sys.stdout.flush()
+
+        release(designs)
+
+    if showProgress:
+        sys.stdout.write(f"\n")
+        sys.stdout.flush()
+    for design in designs:
+        if len(design.results):
+            design.compute_statistics()
+    incomplete(failed, [sum(len(fork.walltime) for fork in forks.values()) for forks in pending], failures = failures)
+    return designs
+
+def incomplete(failed, dropped, names = None, failures = None):
+    # Reports failed chunks, with the first failed replicate of every design
+    # and the number of finished replicates dropped after it: appends the
+    # report to failures, or raises if failures is None
+    names    = [f'design {i}' for i in range(len(failed))] if names is None else names
+    messages = [f"{name} stops at replicate {min(starts)}; {n} finished replicates after it were dropped"
+                for name, starts, n in zip(names, failed, dropped) if starts]
+    if not messages:
+        return
+    report = f"{sum(map(len, failed))} chunks failed: " + '; '.join(messages) + '.'
+    if failures is None:
+        raise RuntimeError(report)
+    print(report)
+    failures.append(report)
@@ -2,19 +2,28 @@
 
 import numpy as np
 import pandas as pd
-import pyjags
 import copy
 import sys
 import time
 import random
+import os
+import pickle
+import zlib
 
 import parameter_set
 import prior
 import data_set
 import ezhbddm
+import results
+import recovery
+import timing
+import cache
 
 class Hddm_Design:
-    def __init__(self, participants, trials, predictor, criterion = None, prior = prior.Hddm_Prior()):
+    def __init__(self, participants, trials, predictor, criterion = None, prior = prior.Hddm_Prior(),
+                 sampling = 'trials', engine = 'jags', adaptive = False, monitored = None, dtype = np.float64,
+                 results_path = None, results_individual = False, seed = None, name = None, timings = False,
+                 cache = None):
         self.n_Participants    = int(participants)
         self.n_TrialsPerPerson = int(trials)
         self.prior             = prior
@@ -23,68 +32,211 @@ class Hddm_Design:
         self.estimate          = None
         self.predictor         = predictor
         self.criterion         = criterion
-        self.results           = []
+        self.results           = results.Hddm_Results(results_path, self.n_Participants if results_individual else None,
+                                                      hyperparameters = parameter_set.hyperparameters(criterion))
         self.statistics        = {}
+        self.recovery          = recovery.Hddm_Recovery(parameter_set.hyperparameters(criterion))
         self.quantile          = []
         self.walltime          = []
-        self.walltime          = []
         self.errorctr          = 0
         self.discards          = []
+        self.sampling          = sampling   # 'trials' or 'summaries'
+        self.engine            = engine     # see ezhbddm.ENGINES
+        self.adaptive          = adaptive   # False, True or settings for ezhbddm.ADAPTIVE
+        self.diagnostics       = []
+        self.monitored         = monitored  # None for ezhbddm.MONITORED
+        self.dtype             = dtype      # storage type of the posterior samples
+        self.seed              = seed       # with a seed, replicate k is reproducible on its own
+        self.name              = name       # e.g. 'ttest'; part of the replicate seeds
+        self.rng               = None       # generator of the current replicate
+        self.timings           = timing.Hddm_Timings() if timings else None   # see timing.py
+        self.cache             = cache      # an Hddm_Cache memoizes data sets and fits; see cache.py
 
-    def run(self, iterations = 1, showProgress = True):
+    def run(self, iterations = 1, showProgress = True, batch = 1, checkpoint = None, every = 100):
+        # With batch > 1, that many replicates are fitted together in one
+        # model (see ezhbddm.estimate_batch).  With a checkpoint path, the
+        # design is saved there every `every` replicates and at the end.
         start = len(self.results) + 1
         stop  = start + iterations - 1
-        for i in range(iterations):
-            self.sample_parameters()
-            self.sample_data()
-            start_time = time.time()
-            self.estimate_parameters(silent = True)
-            if self.samples is None:
-                self.errorctr += 1
-                self.discards.append(i)
-            self.walltime.append(time.time() - start_time)
-            self.compute_quantile()
-            self.results.append((copy.deepcopy(self.parameter_set),
-                                 copy.deepcopy(self.estimate),
-                                 copy.deepcopy(self.quantile)))
-            if showProgress:
-                percent = ((start+i) / stop) * 100
-                cplt = int(np.fix(percent/2))
-                if self.errorctr:
-                    sys.stdout.write(f"\rProgress [{'='*cplt}{' '*(50-cplt)}] {percent:6.2f}%  (Discarding {self.errorctr})")
-                else:
-                    sys.stdout.write(f"\rProgress [{'='*cplt}{' '*(50-cplt)}] {percent:6.2f}%")
-                sys.stdout.flush()
-        sys.stdout.write(f"\n")
-        sys.stdout.flush()
+        i = 0
+        with timing.recording(self.timings):
+            while i < iterations:
+                replicates = []
+                rngs       = []
+                for k in range(min(batch, iterations - i)):
+                    self.rng = self.replicate_rng(self.results.offset + len(self.results) + k)
+                    with timing.timer('sample_parameters'):
+                        self.sample_parameters()
+                    with timing.timer('sample_data'):
+                        self.sample_data()
+                    replicates.append((self.parameter_set, self.data))
+                    rngs.append(self.rng)
+                start_time = time.time()
+                with timing.timer('estimate'):
+                    if len(replicates) == 1:
+                        self.estimate_parameters(silent = True)
+                        fits = [(self.estimate, self.samples)]
+                    else:
+                        fits = self.estimate_batch([data for _, data in replicates], rngs, silent = True)
+                elapsed = (time.time() - start_time) / len(replicates)
+
+                for (self.parameter_set, self.data), (self.estimate, self.samples) in zip(replicates, fits):
+                    self.store(elapsed, i)
+                    if showProgress:
+                        percent = ((start+i) / stop) * 100
+                        cplt = int(np.fix(percent/2))
+                        if self.errorctr:
+                            sys.stdout.write(f"\rProgress [{'='*cplt}{' '*(50-cplt)}] {percent:6.2f}%  (Discarding {self.errorctr})")
+                        else:
+                            sys.stdout.write(f"\rProgress [{'='*cplt}{' '*(50-cplt)}] {percent:6.2f}%")
+                        sys.stdout.flush()
+                    i += 1
+                    if checkpoint is not None and len(self.results) % every == 0 and i < iterations:
+                        with timing.timer('checkpoint'):
+                            self.checkpoint(checkpoint)
+        if showProgress:
+            sys.stdout.write(f"\n")
+            sys.stdout.flush()
+        self.results.flush()
         self.compute_statistics()
+        if checkpoint is not None:
+            self.checkpoint(checkpoint)
+        return self
+
+    def store(self, elapsed, i = None):
+        # Records the replicate in parameter_set, data, estimate and samples
+        timing.count('replicates')
+        if self.estimate is None:
+            timing.count('failures')
+            self.errorctr += 1
+            self.discards.append(i)
+        self.walltime.append(elapsed)
+        with timing.timer('store'):
+            self.compute_quantile()
+            self.results.append(self.parameter_set, self.estimate, self.quantile, elapsed)
+            self.recovery.update(self.parameter_set, self.estimate, self.quantile)
+        if self.adaptive:
+            self.diagnostics.append(self.samples.get('diagnostics') if self.samples is not None else None)
+
+    def replicate_rng(self, replicate):
+        # Generator of one replicate, keyed by (name, criterion, P, T,
+        # replicate), so any replicate can be recomputed on its own.  Without
+        # a seed, the global numpy state is used.
+        if self.seed is None:
+            return None
+        key = [zlib.crc32(str(self.name).encode()), zlib.crc32(str(self.criterion).encode()),
+               self.n_Participants, self.n_TrialsPerPerson, replicate]
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key = key))
+
+    def fork(self, start):
+        # Copy of the design without results, for running replicates from
+        # number `start` on elsewhere; see merge()
+        other = copy.copy(self)
+        other.results       = results.Hddm_Results(dtype = self.results.dtype, offset = start)
+        other.statistics    = {}
+        other.recovery      = recovery.Hddm_Recovery(self.recovery.names, self.recovery.levels,
+                                                     self.recovery.histogram.shape[0])
+        other.walltime      = []
+        other.errorctr      = 0
+        other.discards      = []
+        other.diagnostics   = []
+        other.parameter_set = None
+        other.data          = None
+        other.estimate      = None
+        other.samples       = None
+        other.rng           = None
+        other.timings       = None if self.timings is None else timing.Hddm_Timings(self.timings.max_events)
+        return other
+
+    def merge(self, other, rows = None):
+        # Appends the replicates of a fork, which must follow on ours; rows
+        # are its results if the fork does not hold them (see scheduler.run)
+        if other.results.offset != self.results.offset + len(self.results):
+            raise ValueError(f"Replicates from {other.results.offset} cannot follow "
+                             f"{self.results.offset + len(self.results)} replicates.")
+        self.results.extend(other.results.read() if rows is None else rows)
+        self.walltime    += other.walltime
+        self.errorctr    += other.errorctr
+        self.discards    += other.discards
+        self.diagnostics += other.diagnostics
+        self.recovery.merge(other.recovery)
+        if self.timings is not None and other.timings is not None:
+            self.timings.merge(other.timings)
         return self
 
+    def split(self, criterion, results_path = None):
+        # The replicates of a design with several criteria, as a design with
+        # the one criterion: rows and recovery statistics of its betaweight
+        # only.  All criteria of a joint run are evaluated from the same data
+        # sets, so one run stands in for one run per criterion.
+        if isinstance(self.criterion, str) or criterion not in parameter_set.criteria(self.criterion):
+            raise ValueError(f"Design has no separate criterion '{criterion}'.")
+        other = self.fork(self.results.offset)
+        other.criterion = criterion
+        rename = lambda name: name.replace('betaweight', 'betaweight_' + criterion) if name.endswith('betaweight') else name
+        n_Participants = self.results.dtype['true_bound'].shape[0] if 'true_bound' in self.results.dtype.names else None
+        other.results   = results.Hddm_Results(results_path, n_Participants, offset = self.results.offset)
+        other.results.truncate(0)
+        table = self.results.read()
+        rows  = np.zeros(len(table), dtype = other.results.dtype)
+        for name in rows.dtype.names:
+            rows[name] = table[rename(name)]
+        other.results.extend(rows)
+        other.results.flush()
+        names = parameter_set.hyperparameters(criterion)
+        other.recovery    = self.recovery.select([rename(name) for name in names], names)
+        other.walltime    = list(self.walltime)
+        other.errorctr    = self.errorctr
+        other.discards    = list(self.discards)
+        other.diagnostics = list(self.diagnostics)
+        other.compute_statistics()
+        return other
+
+    def checkpoint(self, path):
+        # Atomic: a crash leaves either the previous or the new checkpoint
+        self.results.flush()
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(path + '.tmp', path)
+        return path
+
+    @staticmethod
+    def resume(path):
+        # Results stored after the checkpoint was written are dropped, so they
+        # are redone exactly as in an uninterrupted run
+        with open(path, 'rb') as f:
+            design = pickle.load(f)
+        design.results.truncate(len(design.walltime))
+        return design
+
     def compute_quantile(self):
         if self.samples is not None:
-            estimate = self.samples
             est = parameter_set.Hddm_Parameter_Set()
-            est.bound_mean = np.mean(estimate['bound_mean'] < self.parameter_set.bound_mean)
-            est.drift_mean = np.mean(estimate['drift_mean'] < self.parameter_set.drift_mean)
-            est.nondt_mean = np.mean(estimate['nondt_mean'] < self.parameter_set.nondt_mean)
-            est.bound_sdev = np.mean(estimate['bound_sdev'] < self.parameter_set.bound_sdev)
-            est.drift_sdev = np.mean(estimate['drift_sdev'] < self.parameter_set.drift_sdev)
-            est.nondt_sdev = np.mean(estimate['nondt_sdev'] < self.parameter_set.nondt_sdev)
-            est.betaweight = np.mean(estimate['betaweight'] < self.parameter_set.betaweight)
+            for varname in self.results.hyperparameters:
+                setattr(est, varname, np.mean(self.samples[varname] < getattr(self.parameter_set, varname)))
             self.quantile  = est
         else:
             self.quantile  = None
         return
 
     def compute_statistics(self):
-        error = [(a-b).betaweight for a, b, _ in self.results if a is not None and b is not None]
-        self.statistics['mean_error'] = np.mean(error)
-        self.statistics['mse']        = np.mean(np.array(error)**2)
-        self.statistics['rmse']       = np.sqrt(self.statistics['mse'])
-        self.statistics['mae']        = np.mean(np.abs(np.array(error)))
+        # Betaweight recovery, from the streaming statistics; errors here are
+        # truth - estimate.  With several criteria, the keys of each are
+        # suffixed with the criterion, as in 'rmse_drift'.
+        for k, name in enumerate(self.recovery.names):
+            if name.startswith('betaweight'):
+                suffix = name[len('betaweight'):]
+                self.statistics['mean_error' + suffix] = -self.recovery.bias[k]
+                self.statistics['mse' + suffix]        = self.recovery.mse[k]
+                self.statistics['rmse' + suffix]       = self.recovery.rmse[k]
+                self.statistics['mae' + suffix]        = self.recovery.mae[k]
         return
 
     def report(self, style = 'long'):
+        if 'mean_error' not in self.statistics and style in ['short', 'long']:
+            # Several criteria: the recovery of each of their betaweights
+            print(self.recovery)
+            return
         me    = self.statistics['mean_error']
         mse   = self.statistics['mse']
         rmse  = self.statistics['rmse']
@@ -104,28 +256,85 @@ class Hddm_Design:
             print(f"  MSE  = {mse:.6f}")
             print(f"  RMSE = {rmse:.6f}")
             print(f"  MAE  = {mae:.6f}")
+        if style == 'recovery':
+            print(self.recovery)
+        if style == 'timings' and self.timings is not None:
+            print(self.timings)
 
         return
 
     def sample_parameters(self):
-        self.parameter_set = parameter_set.Hddm_Parameter_Set.random(self.prior, self.n_Participants, self.criterion, self.predictor)
+        self.parameter_set = parameter_set.Hddm_Parameter_Set.random(self.prior, self.n_Participants, self.criterion,
+                                                                     self.predictor, self.rng)
         return
 
     def sample_data(self):
         if not self.parameter_set:
             raise ValueError("You must set or draw a parameter set before sampling data.")
-        self.data = data_set.Hddm_Data().sample(self)
+        key = self._data_key()
+        if key is not None:
+            arrays = self.cache.get(key)
+            if arrays is not None:
+                timing.count('cached_data')
+                self.data = cache.data_from_arrays(arrays, self.predictor, self.rng)
+                return
+        if self.sampling == 'summaries':
+            self.data = data_set.Hddm_Data.sample_summaries(self)
+        elif self.sampling == 'trials':
+            self.data = data_set.Hddm_Data.sample(self)
+        else:
+            raise ValueError(f"Unknown sampling mode '{self.sampling}'.")
+        if key is not None:
+            self.cache.put(key, cache.data_arrays(self.data, self.rng))
         return
 
     def estimate_parameters(self, silent = False):
+        key = self._fit_key()
+        if key is not None:
+            arrays = self.cache.get(key)
+            if arrays is not None:
+                timing.count('cached_fits')
+                self.estimate, self.samples = cache.fit_from_arrays(arrays, self.rng)
+                return
         try:
-            self.estimate, self.samples = ezhbddm.estimate(self.data, self.prior, self.criterion, silent)
+            self.estimate, self.samples = ezhbddm.estimate(self.data, self.prior, self.criterion, silent,
+                                                          self.engine, self.adaptive, self.monitored, self.dtype, self.rng)
         except TypeError as e:
             print(f"An error occurred during parameter estimation: {e}")
             self.estimate = None
             self.samples  = None
+            return
+        if key is not None:
+            self.cache.put(key, cache.fit_arrays(self.estimate, self.samples, self.rng))
         return
 
+    # Cache keys, or None for steps that are not cached, i.e. those drawing
+    # from the global numpy state
+    def _data_key(self):
+        if self.cache is None or self.rng is None:
+            return None
+        return cache.Hddm_Cache.key('data', self.rng.bit_generator.state, self.n_TrialsPerPerson, self.sampling,
+                                    {name: getattr(self.parameter_set, name) for name in parameter_set.INDIVIDUAL},
+                                    cache.sources(cache.DATA_SOURCES))
+
+    def _fit_key(self):
+        if self.cache is None or self.rng is None or self.data is None:
+            return None
+        # The summaries are computed once, and reused by the fit
+        return cache.Hddm_Cache.key('fit', self.rng.bit_generator.state, self.data.summarize(), self.data.X, vars(self.prior),
+                                    self.criterion, self.engine, self.adaptive, self.monitored,
+                                    np.dtype(self.dtype).str, ezhbddm.DRAWS[self.engine], ezhbddm.ADAPTIVE,
+                                    cache.sources(cache.FIT_SOURCES))
+
+    def estimate_batch(self, datasets, rngs, silent = False):
+        # rngs: the replicate generator of each data set
+        try:
+            return ezhbddm.estimate_batch(datasets, self.prior, self.criterion, silent,
+                                          self.engine, self.adaptive, self.monitored, self.dtype, rngs)
+        except TypeError as e:
+            print(f"An error occurred during parameter estimation: {e}")
+            return [(None, None)] * len(datasets)
+
     def __str__(self):
         output = [
             "Hddm_Design Parameters:",
@@ -134,7 +343,9 @@ class Hddm_Design:
             f"Prior:                  {self.prior}",
             f"Parameter Set:          {self.parameter_set}",
             f"Data:                   {self.data}",
-            f"Criterion:              {self.criterion}"
+            f"Criterion:              {self.criterion}",
+            f"Sampling:               {self.sampling}",
+            f"Engine:                 {self.engine}"
         ]
         return '\n'.join(output)
 
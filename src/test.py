@@ -1,7 +1,38 @@
 import unittest
+import copy
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
 import numpy as np
-from parameter_set import Hddm_Parameter_Set
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from parameter_set import Hddm_Parameter_Set, Hddm_Parameter_Batch
 from prior import Hddm_Prior
+from wdm import wdmrnd_batch, ez_moments
+from simulation import Hddm_Design
+from data_set import Hddm_Data, read_trials, prefix_summaries
+import mcmc
+import parameter_set
+import ez
+import ezhbddm
+import diagnostics
+import scheduler
+import work_queue
+import timing
+import nested
+import benchmark
+from recovery import Hddm_Recovery
+import plots
+from plots import Hddm_Grid_Summary, biasplot, rmseplot
+from posterior import Hddm_Posterior
+import results
+from results import Hddm_Results
+from cache import Hddm_Cache
+import cache
 
 class TestPrior(unittest.TestCase):
 
@@ -50,6 +81,595 @@ class TestParameter(unittest.TestCase):
                                             nondt_mean = 1, nondt_sdev = 1, nondt = np.array([1, 1, 1]),
                                             betaweight = 1))
 
+    def test_joint(self):
+        a = Hddm_Parameter_Set.random(Hddm_Prior(), 4, ['drift', 'bound'], np.arange(4) % 2, np.random.default_rng(0))
+        b = Hddm_Parameter_Set.random(Hddm_Prior(), 4, ['drift', 'bound'], np.arange(4) % 2, np.random.default_rng(1))
+        difference = a - b
+        self.assertCountEqual(difference.names(), parameter_set.hyperparameters(['drift', 'bound']))
+        self.assertAlmostEqual(difference.betaweight_drift, a.betaweight_drift - b.betaweight_drift)
+        self.assertIsNone(difference.betaweight)
+        other = copy.copy(a)
+        other.betaweight_bound += 1
+        self.assertNotEqual(a, other)
+        self.assertIn('Betaweight Bound:', str(a))
+
+        batch = Hddm_Parameter_Batch.from_sets([a, b]) - Hddm_Parameter_Batch.from_sets([b, b])
+        self.assertCountEqual(batch.metrics().index, parameter_set.hyperparameters(['drift', 'bound']))
+        self.assertEqual(batch[0], difference)
+
+class TestParameterBatch(unittest.TestCase):
+
+    def test_random(self):
+        batch = Hddm_Parameter_Batch.random(Hddm_Prior(), 1000, 20, 'drift', np.arange(20) % 2,
+                                            np.random.default_rng(0))
+        self.assertEqual(batch.betaweight.shape, (1000,))
+        self.assertEqual(batch.drift.shape, (1000, 20))
+        effect = batch.drift[:, 1::2].mean(axis=1) - batch.drift[:, ::2].mean(axis=1)
+        self.assertGreater(np.corrcoef(effect, batch.betaweight)[0, 1], 0.5)
+
+    def test_sets(self):
+        sets  = [Hddm_Parameter_Set.random(Hddm_Prior(), 4) for _ in range(3)]
+        batch = Hddm_Parameter_Batch.from_sets([sets[0], None, sets[2]])
+        self.assertEqual(batch[0], sets[0])
+        self.assertIsNone(batch[1])
+        self.assertEqual(batch.drift.shape, (3, 4))
+
+        error   = batch - Hddm_Parameter_Batch.from_sets(sets)
+        metrics = error.metrics()
+        self.assertEqual(metrics.loc['betaweight', 'rmse'], 0)
+        self.assertEqual(list(error.ok), [True, False, True])
+
+class TestRecovery(unittest.TestCase):
+
+    def test_merge(self):
+        rng   = np.random.default_rng(1)
+        truth = Hddm_Parameter_Batch.random(Hddm_Prior(), 50, 4, rng = rng)
+        est   = Hddm_Parameter_Batch.random(Hddm_Prior(), 50, 4, rng = rng)
+        quant = Hddm_Parameter_Batch(**{name: rng.random(50) for name in ezhbddm.HYPERPARAMETERS})
+        whole, part_a, part_b = Hddm_Recovery(), Hddm_Recovery(), Hddm_Recovery()
+        for k in range(50):
+            whole.update(truth[k], est[k], quant[k])
+            (part_a if k < 20 else part_b).update(truth[k], est[k], quant[k])
+        whole.update(truth[0], None, None)
+        part_b.update(truth[0], None, None)
+        part_a.merge(part_b)
+
+        metrics = (est - truth).metrics()
+        np.testing.assert_allclose(whole.bias, metrics['me'])
+        np.testing.assert_allclose(whole.rmse, metrics['rmse'])
+        np.testing.assert_allclose(part_a.rmse, whole.rmse)
+        np.testing.assert_allclose(part_a.mae, whole.mae)
+        np.testing.assert_array_equal(part_a.histogram, whole.histogram)
+        self.assertEqual(part_a.failures, 1)
+        k = whole.names.index('betaweight')
+        self.assertAlmostEqual(whole.coverage[1, k], np.mean(np.abs(quant.betaweight - 0.5) <= 0.4))
+
+class TestWdm(unittest.TestCase):
+
+    def test_batch_shapes(self):
+        rt, accuracy, person = wdmrnd_batch(np.array([1.0, 1.5, 2.0]),
+                                            np.array([0.0, 1.0, -1.0]),
+                                            np.array([0.2, 0.3, 0.4]), 50)
+        self.assertEqual(rt.shape, (150,))
+        self.assertEqual(accuracy.dtype, bool)
+        np.testing.assert_array_equal(person, np.repeat([0, 1, 2], 50))
+        self.assertTrue(np.all(rt > np.repeat([0.2, 0.3, 0.4], 50)))
+
+    def test_batch_moments(self):
+        a, v, t = 1.5, 1.0, 0.3
+        rt, accuracy, _ = wdmrnd_batch([a], [v], [t], 20000)
+        ey = np.exp(-a * v)
+        self.assertAlmostEqual(np.mean(accuracy), 1 / (1 + ey), delta=0.02)
+        self.assertAlmostEqual(np.mean(rt), a / (2 * v) * (1 - ey) / (1 + ey) + t, delta=0.02)
+
+class TestData(unittest.TestCase):
+
+    def test_summarize_noncontiguous(self):
+        person   = np.array([12, 5, 12, 5, 12, 40, 40, 5])
+        rt       = np.array([.5, .6, .7, .8, .9, .4, .3, 1.0])
+        accuracy = np.array([1, 1, 1, 0, 1, 1, 0, 1], dtype=bool)
+        data     = Hddm_Data(person, rt, accuracy, None, np.zeros(3))
+        summaries = data.summarize()
+        np.testing.assert_array_equal(summaries['person'],  [5, 12, 40])
+        np.testing.assert_array_equal(summaries['nTrials'], [3, 3, 2])
+        np.testing.assert_array_equal(summaries['correct'], [2, 3, 1])
+        np.testing.assert_allclose(summaries['meanRT'], [.8, .7, .4])
+        np.testing.assert_allclose(summaries['varRT'], [np.var([.6, 1.0]), np.var([.5, .7, .9]), 0], atol=1e-12)
+        _, valid = data.to_jags()
+        np.testing.assert_array_equal(valid, [5, 12])
+
+    def test_read_trials_chunked(self):
+        csv = "session,cond,rt,acc,respX,respY,phase\n" + \
+              "1,1,0.50,1,1,0,1\n1,1,0.70,1,1,0,1\n1,1,0.60,0,1,0,1\n" + \
+              "1,2,0.40,1,1,0,1\n1,2,3.00,1,1,0,1\n1,2,0.80,1,0,0,1\n" + \
+              "2,1,0.90,1,0,1,1\n2,1,0.30,1,0,1,1\n2,1,0.55,1,0,1,2\n"
+        whole   = read_trials(io.StringIO(csv), chunksize = 100).to_data().summaries
+        chunked = read_trials(io.StringIO(csv), chunksize = 2).to_data().summaries
+        for key in whole:
+            np.testing.assert_allclose(whole[key], chunked[key])
+        np.testing.assert_array_equal(whole['subject'],   [1, 1, 2])
+        np.testing.assert_array_equal(whole['condition'], [1, 2, 1])
+        np.testing.assert_array_equal(whole['nTrials'],   [3, 1, 2])
+        np.testing.assert_array_equal(whole['correct'],   [2, 1, 2])
+        np.testing.assert_allclose(whole['meanRT'], [.6, .4, .6])
+
+        # The same file in milliseconds; the bounds stay in seconds
+        lines = [line.split(',') for line in csv.splitlines()]
+        ms    = '\n'.join(','.join(line[:2] + [line[2] if k == 0 else str(float(line[2]) * 1000)] + line[3:])
+                          for k, line in enumerate(lines)) + '\n'
+        scaled = read_trials(io.StringIO(ms), rt_scale = 0.001).to_data().summaries
+        for key in whole:
+            np.testing.assert_allclose(scaled[key], whole[key])
+
+    def test_save_open(self):
+        person   = np.array([3, 1, 3, 1, 3, 7])
+        rt       = np.array([.5, .6, .7, .8, .9, .4])
+        accuracy = np.array([1, 1, 0, 1, 1, 1], dtype=bool)
+        data     = Hddm_Data(person, rt, accuracy, None, np.array([0., 1., 2.]))
+        with tempfile.TemporaryDirectory() as tmp:
+            opened = Hddm_Data.open(data.save(os.path.join(tmp, 'data')))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'data', 'accuracy.bits')))
+            np.testing.assert_array_equal(opened.participants(), [1, 3, 7])
+            rts, acc = opened.person_trials(1)
+            np.testing.assert_allclose(rts, [.5, .7, .9], rtol=1e-6)
+            np.testing.assert_array_equal(acc, [1, 0, 1])
+            self.assertIsInstance(opened.accuracy, np.memmap)
+            for key in ['nTrials', 'correct', 'meanRT', 'varRT']:
+                np.testing.assert_allclose(opened.summarize()[key], data.summarize()[key], rtol=1e-5)
+            self.assertEqual(pickle.loads(pickle.dumps(opened)).path, opened.path)
+            del opened, rts, acc
+
+            # Format 1 kept accuracy bit-packed
+            path = os.path.join(tmp, 'data')
+            np.packbits(np.fromfile(os.path.join(path, 'accuracy.u1'), dtype=np.uint8)).tofile(
+                os.path.join(path, 'accuracy.bits'))
+            os.remove(os.path.join(path, 'accuracy.u1'))
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, format = 1), f)
+            np.testing.assert_array_equal(Hddm_Data.open(path).person_trials(1)[1], [1, 0, 1])
+
+class TestSampling(unittest.TestCase):
+
+    def test_summaries_match_trials(self):
+        design = Hddm_Design(2000, 100, np.arange(0, 2000) % 2, 'drift')
+        design.sample_parameters()
+        design.sample_data()
+        trials, _ = design.data.to_jags()
+        design.sampling = 'summaries'
+        design.sample_data()
+        summaries, _ = design.data.to_jags()
+        self.assertEqual(set(trials.keys()), set(summaries.keys()))
+        for key in ['correct', 'meanRT', 'varRT']:
+            self.assertAlmostEqual(np.mean(trials[key]) / np.mean(summaries[key]), 1, delta=0.05)
+
+class TestMcmc(unittest.TestCase):
+
+    def test_sample(self):
+        np.random.seed(0)
+        design = Hddm_Design(60, 200, np.arange(0, 60) % 2, 'drift', sampling = 'summaries')
+        design.sample_parameters()
+        design.sample_data()
+        data, valid = design.data.to_jags()
+        samples = mcmc.sample(data, design.prior, 'drift', chains = 2, warmup = 400, draws = 200)
+        self.assertEqual(samples['betaweight'].shape, (1, 200, 2))
+        self.assertEqual(samples['drift'].shape, (len(valid), 200, 2))
+        truth = design.parameter_set.drift[valid]
+        self.assertGreater(np.corrcoef(samples['drift'].mean(axis=(1, 2)), truth)[0, 1], 0.8)
+
+    def test_warm(self):
+        ezhbddm._warm.clear()
+        design = Hddm_Design(60, 200, np.arange(0, 60) % 2, 'drift', sampling = 'summaries', engine = 'warm', seed = 5)
+        design.run(1, showProgress = False)
+        model, _ = next(iter(ezhbddm._warm.values()))
+        design.run(1, showProgress = False)
+        self.assertIs(next(iter(ezhbddm._warm.values()))[0], model)
+        valid = np.isfinite(design.estimate.drift)
+        self.assertGreater(np.corrcoef(np.asarray(design.estimate.drift)[valid],
+                                       design.parameter_set.drift[valid])[0, 1], 0.8)
+
+        # A replicate does not depend on the fits before it in the process
+        ezhbddm._warm.clear()
+        alone = design.fork(1).run(1, showProgress = False)
+        np.testing.assert_array_equal(alone.results.column('est_drift_mean'), design.results.column('est_drift_mean')[1:])
+        with self.assertRaises(ValueError):
+            model.reset({key: value[:10] for key, value in model.data.items()}, model.tuning())
+
+class TestDiagnostics(unittest.TestCase):
+
+    def test_iid(self):
+        x = np.random.default_rng(0).normal(size=(2, 1000, 4))
+        np.testing.assert_array_less(diagnostics.rhat(x), 1.01)
+        self.assertTrue(np.all(diagnostics.ess_bulk(x) > 2500))
+        self.assertTrue(np.all(diagnostics.ess_tail(x) > 2000))
+
+    def test_unmixed(self):
+        x = np.random.default_rng(0).normal(size=(1000, 4)) + np.array([0, 0, 0, 2])
+        self.assertGreater(diagnostics.rhat(x), 1.1)
+
+class TestPosterior(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        samples = {name: rng.normal(size=(1, 50, 2)) for name in ezhbddm.HYPERPARAMETERS}
+        samples.update({name: rng.normal(size=(3, 50, 2)) for name in ezhbddm.INDIVIDUAL})
+        self.samples   = samples
+        self.posterior = Hddm_Posterior.from_samples(samples, np.array([4, 17, 30]), ezhbddm.HYPERPARAMETERS,
+                                                     ezhbddm.INDIVIDUAL, np.float32)
+
+    def test_views(self):
+        self.assertEqual(self.posterior['betaweight'].shape, (1, 50, 2))
+        self.assertEqual(self.posterior['drift'].dtype, np.float32)
+        np.testing.assert_allclose(self.posterior['drift_17'], self.samples['drift'][1], rtol=1e-6)
+        self.assertTrue(np.shares_memory(self.posterior['drift_17'], self.posterior.individual))
+        self.assertNotIn('drift_5', self.posterior)
+        np.testing.assert_allclose(self.posterior.mean('bound'), self.samples['bound'].mean(axis=(1, 2)), rtol=1e-5)
+        lower, upper = self.posterior.interval('betaweight')
+        self.assertLess(lower, upper)
+
+    def test_save_open(self):
+        with tempfile.TemporaryDirectory() as path:
+            for name in ['posterior', 'posterior.npz']:
+                self.posterior.save(os.path.join(path, name))
+                posterior = Hddm_Posterior.open(os.path.join(path, name))
+                np.testing.assert_array_equal(posterior['nondt_30'], self.posterior['nondt_30'])
+                np.testing.assert_array_equal(posterior.participants, [4, 17, 30])
+                self.assertEqual(posterior.individual_dims, ('param', 'participant', 'draw', 'chain'))
+                self.assertEqual([len(labels) for labels in posterior.coords(individual = True).values()],
+                                 list(posterior.individual.shape))
+
+class TestResults(unittest.TestCase):
+
+    def test_append_open(self):
+        prior = Hddm_Prior()
+        truth = [Hddm_Parameter_Set.random(prior, 5, 'drift', np.arange(5) % 2) for _ in range(5)]
+        with tempfile.TemporaryDirectory() as path:
+            store = Hddm_Results(os.path.join(path, 'cell'), 5, chunksize = 2)
+            for k, parameters in enumerate(truth):
+                store.append(parameters, None if k == 3 else parameters, parameters, walltime = k)
+            self.assertEqual(store.n_Flushed, 4)
+            store = pickle.loads(pickle.dumps(store))
+            self.assertEqual(len(store), 5)
+
+            np.testing.assert_array_equal(store.column('ok'), [True, True, True, False, True])
+            np.testing.assert_array_equal(store.column('walltime'), np.arange(5))
+            self.assertEqual(store.column('true_drift').shape, (5, 5))
+            self.assertTrue(np.all(np.isnan(store.column('est_betaweight')[3])))
+            store.truncate(2)
+            self.assertEqual(len(Hddm_Results.open(os.path.join(path, 'cell'))), 2)
+            true, est, _ = store[1]
+            self.assertEqual(true.betaweight, truth[1].betaweight)
+
+    def test_relative_path(self):
+        # Relative paths are resolved from the cache directory, not the
+        # working directory
+        with tempfile.TemporaryDirectory() as path:
+            self.addCleanup(setattr, results, 'ROOT', results.ROOT)
+            self.addCleanup(os.chdir, os.getcwd())
+            results.ROOT = path
+            store = Hddm_Results('cell')
+            store.append(Hddm_Parameter_Set.random(Hddm_Prior(), 5), None, None)
+            os.chdir(tempfile.gettempdir())
+            store = pickle.loads(pickle.dumps(store))
+            self.assertEqual(store.path, 'cell')
+            self.assertEqual(len(store), 1)
+            self.assertTrue(os.path.exists(os.path.join(path, 'cell', 'meta.json')))
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            def design(name):
+                return Hddm_Design(10, 40, np.arange(10) % 2, 'drift', sampling = 'summaries', engine = 'numpy',
+                                   results_path = os.path.join(path, name), seed = 7)
+            full = design('full').run(3, showProgress = False)
+
+            # Interrupted after the checkpoint at 2 replicates, with one more stored
+            checkpoint = os.path.join(path, 'part.pkl')
+            design('part').run(2, showProgress = False, checkpoint = checkpoint).run(1, showProgress = False)
+            part = Hddm_Design.resume(checkpoint)
+            self.assertEqual(len(part.results), 2)
+            part.run(1, showProgress = False, checkpoint = checkpoint)
+            np.testing.assert_array_equal(part.results.column('est_betaweight'), full.results.column('est_betaweight'))
+
+class TestSeeds(unittest.TestCase):
+
+    def test_replicate_in_isolation(self):
+        def design():
+            return Hddm_Design(10, 40, np.arange(10) % 2, 'drift', sampling = 'summaries', engine = 'numpy',
+                               seed = 5, name = 'ttest')
+        full = design().run(2, showProgress = False)
+        one  = design().fork(1).run(1, showProgress = False)
+        columns = [name for name in one.results.dtype.names if name != 'walltime']
+        np.testing.assert_array_equal(one.results.read(columns)[0], full.results.read(columns)[1])
+        self.assertNotEqual(design().replicate_rng(0).random(), Hddm_Design(10, 80, 0, 'drift', seed = 5,
+                                                                              name = 'ttest').replicate_rng(0).random())
+
+    def test_batch(self):
+        # Replicates fitted in a batch are fitted with their own generators
+        def design():
+            return Hddm_Design(10, 40, np.arange(10) % 2, 'drift', sampling = 'summaries', engine = 'numpy', seed = 5)
+        single  = design().run(2, showProgress = False)
+        batched = design().run(2, showProgress = False, batch = 2)
+        np.testing.assert_array_equal(batched.results.column('est_betaweight'), single.results.column('est_betaweight'))
+
+class TestScheduler(unittest.TestCase):
+
+    def test_plan(self):
+        designs = [Hddm_Design(p, 40, np.arange(p) % 2, 'drift') for p in [20, 320]]
+        chunks  = scheduler.plan(designs, 60, chunksize = 25)
+        self.assertEqual([(i, start, n) for i, start, n, _ in chunks][:3], [(1, 0, 25), (1, 25, 25), (1, 50, 10)])
+        self.assertEqual(sum(n for _, _, n, _ in chunks), 120)
+
+    def test_run(self):
+        def design():
+            return Hddm_Design(10, 40, np.arange(10) % 2, 'drift', sampling = 'summaries', engine = 'numpy', seed = 3)
+        serial = design().run(3, showProgress = False)
+        chunks = scheduler.run([design()], 3, chunksize = 2, cores = 2, showProgress = False)[0]
+        np.testing.assert_array_equal(chunks.results.column('replicate'), [0, 1, 2])
+        np.testing.assert_array_equal(chunks.results.column('est_betaweight'), serial.results.column('est_betaweight'))
+        self.assertNotIsInstance(chunks.results.buffer[0], np.memmap)
+
+    def test_failed_chunk(self):
+        design = Hddm_Design(10, 20, np.arange(10) % 2, 'drift', sampling = 'unknown', engine = 'ez', seed = 3)
+        with self.assertRaisesRegex(RuntimeError, 'design 0 stops at replicate 0'):
+            scheduler.run([design], 4, chunksize = 2, cores = 2, showProgress = False)
+        self.assertEqual(len(design.results), 0)
+        # With a failures list the report is collected and the run carries on
+        failures = []
+        scheduler.run([design, Hddm_Design(10, 20, np.arange(10) % 2, 'drift', engine = 'ez', seed = 3)], 4,
+                      chunksize = 2, cores = 2, showProgress = False, failures = failures)
+        self.assertEqual(len(failures), 1)
+        self.assertIn('design 0 stops at replicate 0', failures[0])
+
+    def test_slabs(self):
+        design = Hddm_Design(10, 20, np.arange(10) % 2, 'drift', engine = 'ez', seed = 3)
+        with tempfile.TemporaryDirectory() as root:
+            slab = scheduler.allocate([design], 5, root)[0]
+            fork = scheduler.deposit(design.fork(2).run(3, showProgress = False), slab)
+            self.assertEqual(len(pickle.loads(pickle.dumps(fork)).results), 0)
+            design.merge(design.fork(0).run(2, showProgress = False))
+            design.merge(fork, scheduler.rows(slab, fork))
+            np.testing.assert_array_equal(design.results.column('replicate'), np.arange(5))
+            np.testing.assert_array_equal(design.results.column('est_betaweight'),
+                                          Hddm_Design(10, 20, np.arange(10) % 2, 'drift', engine = 'ez', seed = 3)
+                                          .run(5, showProgress = False).results.column('est_betaweight'))
+
+class TestWorkQueue(unittest.TestCase):
+
+    def test_workers(self):
+        def design():
+            return Hddm_Design(10, 40, np.arange(10) % 2, 'drift', sampling = 'summaries', engine = 'numpy', seed = 2)
+        with tempfile.TemporaryDirectory() as root:
+            tasks = work_queue.submit(root, {'drift_ttest/P10_T40': design()}, 3, chunksize = 1)
+            self.assertEqual(len(tasks), 3)
+
+            # A worker died holding the first task a long time ago
+            lease = os.path.join(root, 'leases', tasks[0] + '.lease')
+            open(lease, 'w').close()
+            os.utime(lease, (0, 0))
+
+            workers = [multiprocessing.Process(target = work_queue.work, args = (root, 60, 0.1)) for _ in range(2)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(work_queue.pending(root), [])
+
+            merged = design()
+            self.assertEqual(work_queue.merge(root, {'drift_ttest/P10_T40': merged}), {'drift_ttest/P10_T40': 3})
+            serial = design().run(3, showProgress = False)
+            np.testing.assert_array_equal(merged.results.column('est_betaweight'), serial.results.column('est_betaweight'))
+
+    def test_broken_lease(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'leases'))
+            lease, token = work_queue._claim(root, 'task', 60)
+            os.utime(lease, (0, 0))
+            other, _ = work_queue._claim(root, 'task', 60)    # breaks the stale lease
+            self.assertEqual(other, lease)
+            self.assertFalse(work_queue._touch(lease, token))
+            work_queue._release(lease, token)
+            self.assertTrue(os.path.exists(lease))
+            self.assertIsNone(work_queue._claim(root, 'task', 60))
+
+class TestPlots(unittest.TestCase):
+
+    def test_grid_summary(self):
+        s = np.empty((2, 1), dtype=object)
+        for i, p in enumerate([4, 8]):
+            s[i, 0] = Hddm_Design(p, 20, np.arange(p) % 2, 'drift')
+            for k in range(3 + i):
+                truth = Hddm_Parameter_Set.random(Hddm_Prior(), p)
+                s[i, 0].results.append(truth, None if k == 0 else truth, truth)
+        with tempfile.TemporaryDirectory() as path:
+            summary = Hddm_Grid_Summary.open(Hddm_Grid_Summary.from_grid(s).save(os.path.join(path, 'grid.npz')))
+        x, y = summary.points('betaweight', 1, 0)
+        self.assertEqual(len(x), 3)
+        np.testing.assert_array_equal(x, y)
+        np.testing.assert_array_equal(summary.rmse['drift_mean'], [[0], [0]])
+        np.testing.assert_array_equal(summary.P, [4, 8])
+
+        # The plots of a grid share one summary of it
+        fig, axes = plt.subplots(2, 1)
+        biasplot(s, 'betaweight', 0, 0, axes[0])
+        summary = plots._last[1]
+        rmseplot(s, 'drift_mean', axes[1], title = 'Drift', axlbl = 0)
+        self.assertIs(plots._last[1], summary)
+        plt.close(fig)
+
+class TestEz(unittest.TestCase):
+
+    def test_inverse(self):
+        # Exact moments invert to the parameters, also at drift 0
+        a, v, t = np.array([1.0, 1.5, 2.0]), np.array([0.0, 1.0, -0.5]), np.array([0.2, 0.3, 0.4])
+        Pc, MRT, VRT = ez_moments(a, v, t)
+        bound, drift, nondt = ez.inverse(Pc * 1000, 1000, MRT, VRT)
+        np.testing.assert_allclose(bound, a)
+        np.testing.assert_allclose(drift, v, atol=1e-12)
+        np.testing.assert_allclose(nondt, t)
+        self.assertTrue(np.all(np.isfinite(ez.inverse([0, 20], 20, [0.5, 0.5], [0.01, 0.01]))))
+
+    def test_engine(self):
+        design = Hddm_Design(200, 200, np.arange(200) % 2, 'drift', engine = 'ez', seed = 3)
+        design.run(1, showProgress = False)
+        est, truth = design.estimate, design.parameter_set
+        self.assertIsNone(design.samples)
+        self.assertEqual(len(est.drift), 200)
+        self.assertAlmostEqual(est.betaweight, truth.betaweight, delta=0.2)
+        self.assertAlmostEqual(est.bound_mean, truth.bound_mean, delta=0.2)
+
+        init = ez.init(design.data.to_jags()[0], Hddm_Prior(), 'drift')
+        self.assertTrue(Hddm_Prior().bound_sdev_lower < init['bound_sdev'] < Hddm_Prior().bound_sdev_upper)
+
+class TestNested(unittest.TestCase):
+
+    def cells(self, predictor = lambda p: np.arange(p) % 2):
+        cells = np.empty((2, 2), dtype=object)
+        for i, p in enumerate([20, 40]):
+            for j, t in enumerate([20, 40]):
+                cells[i, j] = Hddm_Design(p, t, predictor(p), 'drift', engine = 'ez', seed = 4, name = 'ttest')
+        return cells
+
+    def test_prefix_summaries(self):
+        rt, accuracy, person = wdmrnd_batch(np.full(5, 1.5), np.full(5, 1.0), np.full(5, 0.3), 40)
+        summaries = prefix_summaries(rt, accuracy, 40, [10, 40])
+        first = (np.arange(rt.size) % 40) < 10
+        expected = Hddm_Data(person[first], rt[first], accuracy[first], 10).summarize()
+        for key in ['nTrials', 'correct', 'meanRT', 'varRT']:
+            np.testing.assert_allclose(summaries[10][key], expected[key])
+
+    def test_grid(self):
+        grid = nested.Hddm_Nested_Grid(self.cells()).run(3, showProgress = False)
+        true = [cell.results.column('true_betaweight') for cell in grid.cells.ravel()]
+        for column in true[1:]:
+            np.testing.assert_array_equal(column, true[0])
+
+        # In chunks, as on several processes
+        other = nested.Hddm_Nested_Grid(self.cells())
+        other.merge(other.fork(0).run(2, showProgress = False))
+        other.merge(other.fork(2).run(1, showProgress = False))
+        for a, b in zip(grid.cells.ravel(), other.cells.ravel()):
+            np.testing.assert_array_equal(a.results.column('est_bound_mean'), b.results.column('est_bound_mean'))
+
+        with self.assertRaises(ValueError):
+            nested.Hddm_Nested_Grid(self.cells(lambda p: np.arange(p) / p))
+
+    def test_failed_chunk(self):
+        grid = nested.Hddm_Nested_Grid(self.cells())
+        grid.largest.prior = None   # fails every replicate
+        failures = []
+        nested.run(grid, 4, chunksize = 2, cores = 2, showProgress = False, failures = failures)
+        self.assertEqual(grid.replicate, 0)
+        self.assertIn('the grid stops at replicate 0', failures[0])
+        with self.assertRaisesRegex(RuntimeError, 'the grid stops at replicate 0'):
+            nested.run(grid, 4, chunksize = 2, cores = 2, showProgress = False)
+
+class TestJoint(unittest.TestCase):
+
+    def test_split(self):
+        criteria = ['bound', 'drift', 'nondt']
+        design = Hddm_Design(40, 100, np.arange(40) % 2, criteria, sampling = 'summaries', engine = 'numpy', seed = 2)
+        design.run(2, showProgress = False)
+        self.assertIn('quantile_betaweight_nondt', design.results.dtype.names)
+        self.assertTrue(np.all(design.results.column('ok')))
+        for criterion in criteria:
+            split = design.split(criterion)
+            np.testing.assert_array_equal(split.results.column('est_betaweight'),
+                                          design.results.column('est_betaweight_' + criterion))
+            np.testing.assert_array_equal(split.recovery.bias, design.recovery.select(
+                parameter_set.hyperparameters(None)[:-1] + ['betaweight_' + criterion]).bias)
+            self.assertIn('rmse_' + criterion, design.statistics)
+        with self.assertRaises(ValueError):
+            split.split('drift')
+
+class TestTiming(unittest.TestCase):
+
+    def test_design(self):
+        design = Hddm_Design(20, 20, np.arange(20) % 2, 'drift', engine = 'ez', seed = 1, timings = True)
+        fork   = design.fork(0)
+        fork.run(2, showProgress = False)
+        design.merge(fork)
+        self.assertEqual(design.timings.counters['replicates'], 2)
+        self.assertEqual(design.timings.counters['trials'], 2 * 20 * 20)
+        self.assertEqual(design.timings.totals['sample_data/wdmrnd'][0], 2)
+        self.assertIn('estimate/to_jags', design.timings.summary().index)
+
+        with tempfile.TemporaryDirectory() as root:
+            opened = timing.Hddm_Timings.open(design.timings.save(os.path.join(root, 'timings.json')))
+            self.assertEqual(opened.counters, design.timings.counters)
+            with open(design.timings.trace(os.path.join(root, 'trace.json'))) as f:
+                events = json.load(f)["traceEvents"]
+            self.assertEqual(len(events), len(design.timings.events))
+
+    def test_disabled(self):
+        self.assertIs(timing.timer('anything'), timing._NULL)
+        self.assertIsNone(Hddm_Design(20, 20, np.zeros(20), 'drift').timings)
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare(self):
+        stats    = benchmark.measure(lambda: np.ones(1000).sum(), 5, units = 1000)
+        self.assertLessEqual(stats["p50"], stats["p99"])
+        baseline = {"cases": {"a": dict(stats), "b": dict(stats, peak_mb = stats["peak_mb"] + 1)}}
+        results  = {"cases": {"a": dict(stats, p50 = 2 * stats["p50"]), "b": dict(stats), "c": dict(stats)}}
+        self.assertEqual([(name, metric) for name, metric, _, _ in benchmark.compare(results, baseline)],
+                         [("a", "p50")])
+
+    def test_agreement(self):
+        result = benchmark.agreement(20, 40, ('numpy', 'warm'))
+        self.assertEqual(set(result["walltime"]), {'numpy', 'warm'})
+        self.assertLess(result["max_diff_sd"]["warm"], 0.5)
+
+class TestEzhbddm(unittest.TestCase):
+
+    def test_batch_code(self):
+        code = ezhbddm.ez_jags_code(Hddm_Prior(), 'bound', 'batch')
+        self.assertIn('for (b in 1:B)', code)
+        self.assertIn('bound_mean[block[p]] + betaweight[block[p]] * X[p]', code)
+        self.assertNotIn('drift_mean[block[p]] + betaweight', code)
+
+class TestCache(unittest.TestCase):
+
+    def test_design(self):
+        with tempfile.TemporaryDirectory() as root:
+            def run(engine, prior = Hddm_Prior()):
+                design = Hddm_Design(10, 20, np.arange(10) % 2, 'drift', prior, engine = engine, seed = 5, name = 'cache',
+                                     cache = Hddm_Cache(root))
+                return design.run(3, showProgress = False)
+            first, second = run('numpy'), run('numpy')
+            self.assertEqual((second.cache.hits, second.cache.misses), (6, 0))
+            for name in ['true_drift_mean', 'est_drift_mean', 'est_betaweight', 'quantile_betaweight']:
+                np.testing.assert_array_equal(first.results.column(name), second.results.column(name))
+            np.testing.assert_array_equal(first.samples.hyper, second.samples.hyper)
+
+            # Another prior draws other parameters, and so other data
+            prior = Hddm_Prior()
+            prior.drift_mean_sdev = 1.0
+            self.assertEqual(run('ez', prior).cache.hits, 0)
+            self.assertEqual(run('ez').cache.hits, 3)
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = Hddm_Cache(root)
+            keys  = [store.put(Hddm_Cache.key('entry', k), {"x": np.random.default_rng(k).random(100)}) for k in range(5)]
+            os.utime(store._path(keys[0]), (0, 0))
+            os.utime(store._path(keys[1]), (1, 1))
+            store.max_bytes = 3000
+            store.put(Hddm_Cache.key('entry', 5), {"x": np.zeros(1)})
+            self.assertLessEqual(store.size, 3000)
+            self.assertIsNone(store.get(keys[0]))
+            self.assertIsNotNone(store.get(keys[4]))
+            self.assertNotEqual(Hddm_Cache.key(1), Hddm_Cache.key('1'))
+
+            # Evicted down to the low-water mark; overwriting does not add up
+            self.assertLessEqual(store.size, cache.LOW_WATER * 3000)
+            size = store.size
+            store.put(keys[4], {"x": np.random.default_rng(4).random(100)})
+            self.assertEqual(store.size, size)
+
+            # Unpickling does not scan the store
+            self.assertIsNone(pickle.loads(pickle.dumps(store)).size)
+
 
 if __name__ == '__main__':
     unittest.main()
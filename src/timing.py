@@ -0,0 +1,113 @@
+# Optional timing instrumentation
+
+#   Code marks its phases with `with timing.timer('name'):` and counts things
+#   with timing.count('name', n).  Nothing is recorded unless an Hddm_Timings
+#   is active (`with timing.recording(timings):`); then timers nest, so that
+#   'compile' inside 'estimate' is recorded as 'estimate/compile'.  When no
+#   recorder is active a timer is a shared null context, so the
+#   instrumentation costs one function call.
+#
+#   Hddm_Design keeps one Hddm_Timings per cell when created with
+#   timings = True.  They pickle with the design and merge like its results,
+#   so the timings of chunks run by other processes add up.  Export with
+#   save() (JSON) or trace() (Chrome trace, for chrome://tracing or Perfetto).
+
+import contextlib
+import json
+import os
+import time
+import pandas as pd
+
+_NULL   = contextlib.nullcontext()
+_active = None
+
+class Hddm_Timings:
+    def __init__(self, max_events = 100000):
+        self.totals     = {}    # path: [calls, seconds]
+        self.counters   = {}
+        self.events     = []    # (path, start, duration, pid), in microseconds
+        self.max_events = max_events
+        self.stack      = []
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        self.stack.append(name)
+        path  = '/'.join(self.stack)
+        wall  = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            total = self.totals.setdefault(path, [0, 0.0])
+            total[0] += 1
+            total[1] += elapsed
+            if len(self.events) < self.max_events:
+                self.events.append((path, wall * 1e6, elapsed * 1e6, os.getpid()))
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        for path, (calls, seconds) in other.totals.items():
+            total = self.totals.setdefault(path, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        for name, n in other.counters.items():
+            self.count(name, n)
+        self.events += other.events[:max(self.max_events - len(self.events), 0)]
+        return self
+
+    def summary(self):
+        paths = sorted(self.totals)
+        table = pd.DataFrame({"calls":   [self.totals[path][0] for path in paths],
+                              "seconds": [self.totals[path][1] for path in paths]}, index = paths)
+        table["mean"] = table["seconds"] / table["calls"]
+        return table
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({"totals": self.totals, "counters": self.counters}, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        return path
+
+    @staticmethod
+    def open(path):
+        with open(path) as f:
+            meta = json.load(f)
+        timings = Hddm_Timings()
+        timings.totals   = meta["totals"]
+        timings.counters = meta["counters"]
+        return timings
+
+    def trace(self, path):
+        # Complete ('X') events; the viewer nests them by time, per process
+        events = [{"name": name.rsplit('/', 1)[-1], "cat": name.split('/', 1)[0], "ph": "X",
+                   "ts": start, "dur": duration, "pid": pid, "tid": 0, "args": {"path": name}}
+                  for name, start, duration, pid in self.events]
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+    def __str__(self):
+        lines = [self.summary().to_string(float_format = lambda x: f"{x:.4f}")]
+        lines += [f"{name:<24}{n:>12}" for name, n in sorted(self.counters.items())]
+        return '\n'.join(lines)
+
+def timer(name):
+    return _NULL if _active is None else _active.timer(name)
+
+def count(name, n = 1):
+    if _active is not None:
+        _active.count(name, n)
+
+@contextlib.contextmanager
+def recording(timings):
+    # Makes timings (or None, to record nothing) the active recorder
+    global _active
+    previous, _active = _active, timings
+    try:
+        yield timings
+    finally:
+        _active = previous
@@ -1,16 +1,150 @@
 # Wrapper for simple DDM simulator
 
 import ctypes
+import os
 import numpy as np
 
-# You may need to compile ../c/wdm.so with:
-#   gcc -shared -o wdm.so wdm.c
+# The C library is loaded from c/wdm.so next to this file; compile it in
+# src/ with:
+#   gcc -O2 -shared -fPIC -o c/wdm.so c/wdm.c -lm
+#
+# The C library is only needed for wdmrnd().  wdmrnd_batch() is a pure NumPy
+# port of the same algorithm, so worker processes do not need to load it.
 
-wdm = ctypes.CDLL('c/wdm.so')
-wdm.rnd.argtypes = [ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int]
-wdm.rnd.restype = ctypes.POINTER(ctypes.c_double)
+_wdm  = None
+_libc = None
+
+def _library():
+    global _wdm, _libc
+    if _wdm is None:
+        _wdm = ctypes.CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'c', 'wdm.so'))
+        _wdm.rnd.argtypes = [ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int]
+        _wdm.rnd.restype  = ctypes.POINTER(ctypes.c_double)
+        _libc = ctypes.CDLL(None)
+        _libc.free.argtypes = [ctypes.c_void_p]
+        _libc.free.restype  = None
+    return _wdm
 
 def wdmrnd(a, v, t, n):
-    y = np.ctypeslib.as_array(wdm.rnd(a, t, 0.5, v, n), shape=(n,))
+    wdm = _library()
+    ptr = wdm.rnd(a, t, 0.5, v, n)
+    y   = np.ctypeslib.as_array(ptr, shape=(n,)).copy()
+    _libc.free(ptr)
     return abs(y), (y > 0)
 
+
+# Constants of the random walk, as in c/wdm.c
+_DT           = 1e-15
+_D            = .005
+_SERIES_BLOCK = (4, 32)
+
+def _exit_times(s1, F):
+    # Alternating series of the first exit time density, summed in blocks of
+    # terms until the last term of each row drops below _DT.  Most rows
+    # converge within the first few terms, so the first block is short.
+    tnew    = np.zeros(s1.size)
+    log_s1  = np.log(s1)
+    pending = np.arange(s1.size)
+    u0      = 1
+    while pending.size:
+        block = _SERIES_BLOCK[u0 > 1]
+        u     = np.arange(u0, u0 + block)
+        tt    = 2 * u + 1
+        sign  = np.where(u % 2, -1.0, 1.0)
+        terms = sign * tt * np.exp(F[pending, None] * tt**2 * log_s1[pending, None])
+        tnew[pending] += terms.sum(axis=1)
+        pending = pending[np.abs(terms[:, -1]) > _DT]
+        u0   += block
+    return 1 + s1**-F * tnew
+
+def wdmrnd_batch(a, v, t, n, bias = 0.5, rng = None):
+    # Simulates n trials for each of len(a) participants at once.  Returns
+    # preallocated rt, accuracy and person arrays of length sum(n).
+    rng = np.random if rng is None else rng
+
+    a = np.atleast_1d(np.asarray(a, dtype=float))
+    n = np.broadcast_to(np.asarray(n, dtype=int), a.shape)
+
+    person   = np.repeat(np.arange(a.size), n)
+    rt       = np.empty(person.size)
+    accuracy = np.empty(person.size, dtype=bool)
+
+    a   = a[person] / 10.0
+    v   = np.broadcast_to(np.asarray(v, dtype=float), n.shape)[person] / 10.0
+    ter = np.broadcast_to(np.asarray(t, dtype=float), n.shape)[person]
+    z   = a * bias
+
+    Aupper    = a - z
+    Alower    = -z
+    startpos  = np.zeros(person.size)
+    totaltime = np.zeros(person.size)
+    radius    = np.fmin(np.abs(Aupper), np.abs(Alower))
+
+    active = np.arange(person.size)
+    while active.size:
+        r      = radius[active]
+        va     = v[active]
+        lam    = 0.25 * va * va / _D + 0.25 * _D * np.pi**2 / (r * r)
+        F      = 1 / (1 + (r * va / (_D * np.pi))**2)
+        prob   = 1 / (1 + np.exp(-r * va / _D))
+        dir_   = np.where(rng.random(active.size) < prob, 1.0, -1.0)
+
+        s1      = np.empty(active.size)
+        pending = np.arange(active.size)
+        while pending.size:
+            s1_try = 0.00001 + 0.99998 * rng.random(pending.size)
+            s2_try = 0.00001 + 0.99998 * rng.random(pending.size)
+            accept = s2_try <= _exit_times(s1_try, F[pending])
+            s1[pending[accept]] = s1_try[accept]
+            pending = pending[~accept]
+
+        totaltime[active] += np.abs(np.log(s1)) / lam
+        pos   = startpos[active] + dir_ * r
+        upper = pos + _DT > Aupper[active]
+        lower = ~upper & (pos - _DT < Alower[active])
+
+        done = active[upper | lower]
+        rt[done]       = totaltime[done] + ter[done]
+        accuracy[done] = upper[upper | lower]
+
+        active = active[~(upper | lower)]
+        pos    = pos[~(upper | lower)]
+        startpos[active] = pos
+        radius[active]   = np.fmin(np.abs(Aupper[active] - pos), np.abs(Alower[active] - pos))
+
+    return rt, accuracy, person
+
+
+def ez_moments(a, v, t):
+    # Forward equations from EZ Diffusion: probability correct, mean and
+    # variance of the correct response times.  Written in terms of x = a*v
+    # with series expansions near x = 0, where the usual forms cancel.
+    a, v, t = np.broadcast_arrays(np.asarray(a, dtype=float),
+                                  np.asarray(v, dtype=float),
+                                  np.asarray(t, dtype=float))
+    x     = a * v
+    small = np.abs(x) < 1e-2
+    xs    = np.where(small, 1.0, x)
+    y     = x / 2
+    tanh_ratio = np.where(small, 1 - y**2 / 3 + 2 * y**4 / 15, np.tanh(xs / 2) / (xs / 2))
+    sinh_ratio = np.where(small, 1 / 6 + x**2 / 120 + x**4 / 5040, (np.sinh(xs) - xs) / xs**3)
+
+    Pc  = 1 / (1 + np.exp(-x))
+    MRT = a**2 / 4 * tanh_ratio + t
+    VRT = a**4 / 4 * sinh_ratio / np.cosh(y)**2
+    return Pc, MRT, VRT
+
+def ezrnd(a, v, t, n, rng = None):
+    # Draws the EZ summary statistics of n trials directly: number correct is
+    # binomial, the mean correct RT normal and the (ddof=0) variance of the
+    # correct RTs a scaled chi-square, each given the number correct
+    rng = np.random if rng is None else rng
+    Pc, MRT, VRT = ez_moments(a, v, t)
+    n = np.broadcast_to(np.asarray(n, dtype=int), Pc.shape)
+
+    correct = rng.binomial(n, Pc)
+    c       = np.maximum(correct, 1)
+    mean_rt = np.where(correct > 0, MRT + np.sqrt(VRT / c) * rng.normal(size=Pc.shape), np.nan)
+    var_rt  = np.where(correct > 1, VRT * rng.chisquare(np.maximum(correct - 1, 1)) / c, np.nan)
+    var_rt  = np.where(correct == 1, 0.0, var_rt)
+    return correct, mean_rt, var_rt
@@ -0,0 +1,174 @@
+# Work queue for running simulation designs on several hosts
+
+#   The queue is a directory on a filesystem shared by all hosts:
+#
+#     cells/<cell>.pkl             the design of each cell, without results
+#     tasks/<cell>__<start>.json   chunks of replicates of a cell
+#     leases/<task>.lease          claims, created exclusively and touched
+#                                  after every replicate
+#     shards/<task>.pkl            finished chunks
+#
+#   submit() writes cells and tasks, any number of work() processes claim and
+#   run tasks, and merge() appends the shards to the designs in replicate
+#   order.  A lease that has not been touched for `timeout` seconds belongs to
+#   a dead worker and is broken by the next worker that comes along.  Every
+#   lease holds a token of the worker that created it, and workers only touch
+#   and remove leases that still hold their token; a worker whose lease was
+#   broken gives the task up.  Since replicates are seeded (see
+#   Hddm_Design.replicate_rng), a chunk that ends up being run twice gives the
+#   same shard.
+
+import json
+import os
+import pickle
+import socket
+import sys
+import time
+import uuid
+
+def _cell_file(key):
+    return key.replace('/', '__')
+
+def _write_atomic(path, write):
+    tmp = path + f'.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def submit(root, designs, replicates, chunksize = 25):
+    # designs: dict of cell name to Hddm_Design; replicates the design already
+    # has are not submitted again
+    for directory in ['cells', 'tasks', 'leases', 'shards']:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    tasks = []
+    for key, design in designs.items():
+        if design.seed is None:
+            raise ValueError(f"Design {key} needs a seed to be run on several hosts.")
+        cell = _cell_file(key)
+        _write_atomic(os.path.join(root, 'cells', cell + '.pkl'), lambda f: pickle.dump(design.fork(0), f))
+        for start in range(design.results.offset + len(design.results), replicates, chunksize):
+            task = f'{cell}__{start:07d}'
+            _write_atomic(os.path.join(root, 'tasks', task + '.json'),
+                          lambda f: f.write(json.dumps({"cell": cell, "start": start,
+                                                        "n": min(chunksize, replicates - start)}).encode()))
+            tasks.append(task)
+    return tasks
+
+def _claim(root, task, timeout):
+    lease = os.path.join(root, 'leases', task + '.lease')
+    try:
+        if time.time() - os.path.getmtime(lease) < timeout:
+            return None
+        # Expired: move it out of the way; only one worker succeeds
+        os.rename(lease, lease + f'.{uuid.uuid4().hex}.expired')
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}'
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return lease, token
+
+def _owns(lease, token):
+    try:
+        with open(lease) as f:
+            return f.read().strip() == token
+    except FileNotFoundError:
+        return False
+
+def _touch(lease, token):
+    # Heartbeat; False if the lease was broken and now belongs to another worker
+    if not _owns(lease, token):
+        return False
+    os.utime(lease)
+    return True
+
+def _release(lease, token):
+    if _owns(lease, token):
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+def pending(root):
+    tasks = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(root, 'tasks')) if name.endswith('.json'))
+    return [task for task in tasks if not os.path.exists(os.path.join(root, 'shards', task + '.pkl'))]
+
+def work(root, timeout = 600, poll = 10, wait = True):
+    # Runs tasks until none are left; with wait, also waits for tasks leased
+    # by other workers, in case their leases expire.  Returns the tasks run.
+    done  = []
+    cells = {}
+    while True:
+        tasks = pending(root)
+        if not tasks:
+            return done
+
+        claimed = False
+        for task in tasks:
+            claim = _claim(root, task, timeout)
+            if claim is None:
+                continue
+            lease, token = claim
+            claimed = True
+            if os.path.exists(os.path.join(root, 'shards', task + '.pkl')):
+                _release(lease, token)
+                continue
+
+            with open(os.path.join(root, 'tasks', task + '.json')) as f:
+                spec = json.load(f)
+            if spec["cell"] not in cells:
+                with open(os.path.join(root, 'cells', spec["cell"] + '.pkl'), 'rb') as f:
+                    cells[spec["cell"]] = pickle.load(f)
+
+            shard = cells[spec["cell"]].fork(spec["start"])
+            for k in range(spec["n"]):
+                shard.run(1, showProgress = False)
+                if k + 1 < spec["n"] and not _touch(lease, token):
+                    break   # the new owner of the lease runs the chunk
+            else:
+                shard.data    = None
+                shard.samples = None
+                _write_atomic(os.path.join(root, 'shards', task + '.pkl'), lambda f: pickle.dump(shard, f))
+                _release(lease, token)
+                done.append(task)
+
+        if not claimed:
+            if not wait:
+                return done
+            time.sleep(poll)
+
+def merge(root, designs, checkpoint = True):
+    # Appends the shards that follow on each design's replicates; returns the
+    # number of replicates merged per cell
+    merged = {}
+    for key, design in designs.items():
+        cell   = _cell_file(key)
+        shards = sorted(name for name in os.listdir(os.path.join(root, 'shards'))
+                        if name.startswith(cell + '__') and name.endswith('.pkl'))
+        merged[key] = 0
+        for name in shards:
+            with open(os.path.join(root, 'shards', name), 'rb') as f:
+                shard = pickle.load(f)
+            if shard.results.offset < design.results.offset + len(design.results):
+                continue
+            if shard.results.offset > design.results.offset + len(design.results):
+                break
+            design.merge(shard)
+            merged[key] += len(shard.results)
+
+        design.results.flush()
+        if len(design.results):
+            design.compute_statistics()
+        if checkpoint and merged[key] and design.results.path is not None:
+            design.checkpoint(design.results.directory + '.pkl')
+    return merged
+
+
+if __name__ == '__main__':
+    # python work_queue.py <queue directory> [lease timeout in seconds]
+    work(sys.argv[1], timeout = float(sys.argv[2]) if len(sys.argv) > 2 else 600)